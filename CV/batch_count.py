@@ -0,0 +1,434 @@
+"""Offline vehicle counts for archived footage.
+
+Counts one lane's recording as fast as the hardware allows, with no MQTT, no
+windows and no pause on red: the video is split into frame-range segments,
+segments run in a process pool (one YOLO model per worker, frames inferred in
+batches) and the per-interval counts are written to CSV and, optionally, to
+the veiculos table with the time the footage was shot.
+
+    python batch_count.py --lane lane_1 --start 2024-03-01T06:00 --workers 4
+    python batch_count.py recording.mp4 --mask mask.png --limits 100 297 650 297 --interval 300
+
+With --detection-cache the raw detections are recorded the first time and
+replayed afterwards, so sweeping --limits, --max-distance or --conf-threshold
+over the same footage skips decoding and YOLO entirely:
+
+    python batch_count.py --lane lane_1 --detection-cache
+    python batch_count.py --lane lane_1 --detection-cache --max-distance 45
+
+Each worker gets its own slice of the cores (resources.plan_batch), pinned
+there unless --no-pinning is given; PyTorch, OpenCV, FFmpeg and BLAS in the
+worker are sized to that slice, so workers do not fight over cores.
+
+Segment boundaries: every segment after the first starts OVERLAP_SECONDS
+early and runs its tracker over that warm-up without reporting anything, so a
+car already in the counting band at the boundary keeps being the same track
+and is not counted again. Crossings the warm-up still misses (detector
+dropouts right at the boundary) are matched against the previous segment's
+last crossings by position and time and discarded.
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import queue
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import cv2
+
+import semaforos
+from clocks import parse_start
+from semaforos import (LANES_CONFIG, STANDARD_WIDTH, STANDARD_HEIGHT, VEHICLE_CLASSES, CONF_THRESHOLD,
+                       MAX_DISTANCE, FRAME_SKIP, DETECTION_CACHE_DIR, DETECTOR_BACKEND, detector_model_path)
+from tracking import CentroidTracker, detections_from_array
+from detectors import BACKENDS, make_detector
+from detection_cache import DetectionCache
+from resources import available_cores, plan_batch, limit_blas, open_capture, format_cores
+
+# ==================== CONFIGURATION ====================
+
+SEGMENT_SECONDS = 600      # video seconds per pool task
+OVERLAP_SECONDS = 2.0      # tracker warm-up before each segment boundary
+BATCH_SIZE = 16            # frames per model call
+INTERVAL_SECONDS = 60      # one output row per interval
+OUTPUT_PATTERN = 'counts_{lane_id}.csv'
+
+# ==================== WORKER ====================
+
+_detector = None
+_detector_args = None
+_cores = None
+
+
+def _init_worker(backend, model_path, device, core_slices, pinning):
+    """Takes this worker's slice of cores from core_slices and sizes every
+    thread pool to it (pinned there when pinning); the detector loads on first
+    use, so a segment replayed entirely from the detection cache never loads it"""
+    global _detector_args, _cores
+    try:
+        _cores = core_slices.get_nowait()
+    except queue.Empty:
+        _cores = available_cores()
+    if pinning and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, _cores)
+    limit_blas(1)
+    cv2.setNumThreads(1)
+    _detector_args = (backend, model_path, device, len(_cores))
+
+
+def _get_detector():
+    global _detector
+    if _detector is None:
+        _detector = make_detector(*_detector_args)
+    return _detector
+
+
+def count_segment(task):
+    """Tracks one frame range and returns its crossings and per-interval occupancy.
+
+    Only frames in [first, last) are reported; [warmup_from, first) just
+    primes the tracker. With a detection cache, cached frames are only
+    grabbed (not decoded) and skip the model; a segment whose frames are all
+    cached is replayed without opening the video at all.
+    """
+    started = time.perf_counter()
+    started_cpu = time.process_time()
+    warmup_from, first, last, stride = task['warmup_from'], task['first'], task['last'], task['stride']
+    fps, interval = task['fps'], task['interval']
+    needed = [i for i in range(warmup_from, last) if i % stride == 0]
+
+    cache = recorder = None
+    if task['cache_dir']:
+        cache = DetectionCache(task['cache_dir'], task['cache_key'], task['cache_meta'])
+        recorder = cache.recorder()
+    replaying = cache is not None and task['cache_mode'] == 'replay'
+
+    tracker = CentroidTracker(task['limits'], task['max_distance'])
+    crossings = []   # (frame, cx, cy)
+    occupancy = {}   # interval index -> [frames, sum of cars, max cars]
+    counts = {'cached': 0, 'inferred': 0}
+
+    def track(index, rows):
+        detections = detections_from_array(rows, VEHICLE_CLASSES, task['conf_threshold'])
+        crossed = tracker.update(detections)
+        if index < first:
+            return
+        crossings.extend((index, cx, cy) for _, cx, cy in crossed)
+        slot = occupancy.setdefault(int(index / fps // interval), [0, 0, 0])
+        slot[0] += 1
+        slot[1] += len(detections)
+        slot[2] = max(slot[2], len(detections))
+
+    if replaying and all(cache.get(i) is not None for i in needed):
+        for index in needed:
+            track(index, cache.get(index))
+        counts['cached'] = len(needed)
+        return _segment_result(task, crossings, occupancy, counts, started, started_cpu)
+
+    cap = open_capture(task['video_path'], len(_cores or [1]))
+    cap.set(cv2.CAP_PROP_POS_FRAMES, warmup_from)
+    mask = None
+    if task['mask_path'] and os.path.exists(task['mask_path']):
+        mask = cv2.resize(cv2.imread(task['mask_path']), (STANDARD_WIDTH, STANDARD_HEIGHT))
+
+    pending = []     # [index, rows or None, image], in frame order
+    to_infer = 0
+
+    def flush():
+        images = [p[2] for p in pending if p[1] is None]
+        if images:
+            results = iter(_get_detector().detect(images))
+            for p in pending:
+                if p[1] is None:
+                    p[1] = next(results)
+                    if recorder is not None:
+                        recorder.add(p[0], p[1])
+            counts['inferred'] += len(images)
+        for index, rows, _ in pending:
+            track(index, rows)
+        pending.clear()
+
+    frame_index = warmup_from
+    try:
+        while frame_index < last:
+            rows = cache.get(frame_index) if replaying and frame_index % stride == 0 else None
+            if frame_index % stride or rows is not None:
+                # Skipped and cached frames are only grabbed, never decoded
+                if not cap.grab():
+                    break
+                if rows is not None:
+                    pending.append([frame_index, rows, None])
+                    counts['cached'] += 1
+                frame_index += 1
+                continue
+            success, img = cap.read()
+            if not success:
+                break
+            img = cv2.resize(img, (STANDARD_WIDTH, STANDARD_HEIGHT))
+            if mask is not None:
+                img = cv2.bitwise_and(img, mask)
+            pending.append([frame_index, None, img])
+            to_infer += 1
+            frame_index += 1
+            if to_infer == task['batch_size'] or len(pending) >= 8 * task['batch_size']:
+                flush()
+                to_infer = 0
+        flush()
+    finally:
+        cap.release()
+        if recorder is not None:
+            recorder.close()
+
+    return _segment_result(task, crossings, occupancy, counts, started, started_cpu)
+
+
+def _segment_result(task, crossings, occupancy, counts, started, started_cpu):
+    return {
+        'first': task['first'],
+        'last': task['last'],
+        'crossings': crossings,
+        'occupancy': occupancy,
+        'cached': counts['cached'],
+        'inferred': counts['inferred'],
+        'seconds': time.perf_counter() - started,
+        'cpu_seconds': time.process_time() - started_cpu,
+    }
+
+# ==================== STITCHING AND OUTPUT ====================
+
+
+def plan_segments(total_frames, fps, segment_seconds, overlap_seconds):
+    """[(warmup_from, first, last)] covering [0, total_frames)"""
+    length = max(1, int(segment_seconds * fps))
+    overlap = int(overlap_seconds * fps)
+    return [(max(0, first - overlap), first, min(first + length, total_frames))
+            for first in range(0, total_frames, length)]
+
+
+def stitch_crossings(segments, fps, overlap_seconds, max_distance=MAX_DISTANCE):
+    """Crossings of all segments in frame order, without boundary duplicates"""
+    window = max(1, int(overlap_seconds * fps))
+    stitched = []
+    duplicates = 0
+    previous = []
+    for segment in sorted(segments, key=lambda s: s['first']):
+        boundary = segment['first']
+        candidates = [c for c in previous if c[0] >= boundary - window]
+        for crossing in segment['crossings']:
+            frame, cx, _ = crossing
+            if frame < boundary + window:
+                match = next((c for c in candidates
+                              if frame - c[0] <= window and abs(cx - c[1]) < max_distance), None)
+                if match is not None:
+                    candidates.remove(match)
+                    duplicates += 1
+                    continue
+            stitched.append(crossing)
+        previous = segment['crossings']
+    return stitched, duplicates
+
+
+def interval_rows(lane_id, segments, crossings, fps, interval, start):
+    """One row per interval: crossings, cumulative total and occupancy stats"""
+    occupancy = {}
+    for segment in segments:
+        for slot, (frames, cars, peak) in segment['occupancy'].items():
+            merged = occupancy.setdefault(slot, [0, 0, 0])
+            merged[0] += frames
+            merged[1] += cars
+            merged[2] = max(merged[2], peak)
+
+    per_slot = {}
+    for frame, _, _ in crossings:
+        slot = int(frame / fps // interval)
+        per_slot[slot] = per_slot.get(slot, 0) + 1
+
+    rows = []
+    total = 0
+    for slot in sorted(set(occupancy) | set(per_slot)):
+        frames, cars, peak = occupancy.get(slot, (0, 0, 0))
+        total += per_slot.get(slot, 0)
+        rows.append({
+            'lane_id': lane_id,
+            'interval_start': datetime.fromtimestamp(start + slot * interval).isoformat(timespec='seconds'),
+            'interval_end': datetime.fromtimestamp(start + (slot + 1) * interval).isoformat(timespec='seconds'),
+            'crossings': per_slot.get(slot, 0),
+            'total_count': total,
+            'avg_cars': round(cars / frames, 2) if frames else 0.0,
+            'max_cars': peak,
+            'frames': frames,
+            '_end_ts': start + (slot + 1) * interval,
+        })
+    return rows
+
+
+def write_csv(path, rows):
+    fields = [k for k in rows[0] if not k.startswith('_')] if rows else ['lane_id']
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def write_database(rows):
+    """Backfills veiculos with one row per interval, timestamped at its end"""
+    if not semaforos.initialize_database():
+        return 0
+    if not semaforos.USE_FIREBASE:
+        semaforos.ensure_database_schema()
+    written = 0
+    for row in rows:
+        semaforos.send_to_database(row['lane_id'], row['total_count'], row['max_cars'], row['avg_cars'],
+                                   recorded_at=row['_end_ts'])
+        written += 1
+    return written
+
+# ==================== MAIN PROGRAM ====================
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Count vehicles in archived video, in parallel")
+    parser.add_argument('video', nargs='?', help="video file (default: the lane's video_path)")
+    parser.add_argument('--lane', help="lane_id from LANES_CONFIG to take video, mask and limits from")
+    parser.add_argument('--lane-id', help="lane_id written to the output (default: --lane or the file name)")
+    parser.add_argument('--mask', help="mask image (overrides the lane's)")
+    parser.add_argument('--limits', nargs=4, type=int, metavar=('X1', 'Y1', 'X2', 'Y2'),
+                        help="counting line (overrides the lane's)")
+    parser.add_argument('--start', help="wall time of the first frame, epoch seconds or ISO "
+                                        "(default: lane recording_start, else file mtime minus duration)")
+    parser.add_argument('--workers', type=int, default=max(1, len(available_cores()) // 2))
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--segment-seconds', type=float, default=SEGMENT_SECONDS)
+    parser.add_argument('--overlap-seconds', type=float, default=OVERLAP_SECONDS)
+    parser.add_argument('--interval', type=float, default=INTERVAL_SECONDS, help="seconds per output row")
+    parser.add_argument('--stride', type=int, default=FRAME_SKIP, help="process every Nth frame")
+    parser.add_argument('--backend', choices=BACKENDS, default=DETECTOR_BACKEND)
+    parser.add_argument('--model', help="model file (default: the backend's from semaforos.py)")
+    parser.add_argument('--device', help="torch device (cpu, 0, cuda:0) or ONNX Runtime execution provider")
+    parser.add_argument('--no-pinning', action='store_true',
+                        help="size the thread pools to each worker's cores but do not pin the workers to them")
+    parser.add_argument('--max-distance', type=float, default=MAX_DISTANCE, help="tracker matching radius (px)")
+    parser.add_argument('--conf-threshold', type=float, default=CONF_THRESHOLD)
+    parser.add_argument('--detection-cache', nargs='?', const=DETECTION_CACHE_DIR, metavar='DIR',
+                        help=f"record/replay raw detections (default dir: {DETECTION_CACHE_DIR})")
+    parser.add_argument('--cache-mode', choices=('record', 'replay'), default='replay',
+                        help="replay: use cached detections, infer and record the rest; "
+                             "record: infer every frame, record what is not cached")
+    parser.add_argument('--output', help=f"CSV path (default: {OUTPUT_PATTERN})")
+    parser.add_argument('--database', action='store_true', help="also write the rows to the configured database")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    model_path = args.model or detector_model_path(args.backend)
+
+    config = {}
+    if args.lane:
+        config = next((c for c in LANES_CONFIG if c['lane_id'] == args.lane), None)
+        if config is None:
+            print(f"❌ Unknown lane '{args.lane}'")
+            return 1
+    video_path = args.video or config.get('video_path')
+    mask_path = args.mask or config.get('mask_path')
+    limits = args.limits or config.get('limits')
+    lane_id = args.lane_id or args.lane or os.path.splitext(os.path.basename(video_path or ''))[0]
+    if not video_path or not limits:
+        print("❌ Give a video and --limits, or a --lane from LANES_CONFIG")
+        return 1
+    if not os.path.exists(video_path):
+        print(f"❌ Video '{video_path}' not found!")
+        return 1
+
+    cap = cv2.VideoCapture(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    if fps <= 0 or total_frames <= 0:
+        print(f"❌ Could not read frame rate/frame count of '{video_path}'")
+        return 1
+    duration = total_frames / fps
+
+    start_value = args.start or config.get('recording_start')
+    start = parse_start(start_value) if start_value is not None else os.path.getmtime(video_path) - duration
+    stride = max(1, args.stride)
+    segments = plan_segments(total_frames, fps, args.segment_seconds, args.overlap_seconds)
+    workers = max(1, min(args.workers, len(segments)))
+    core_slices = plan_batch(workers)
+    cores_used = sorted({core for cores in core_slices for core in cores})
+    output = args.output or OUTPUT_PATTERN.format(lane_id=lane_id)
+    cache = None
+    if args.detection_cache:
+        cache = DetectionCache.for_video(args.detection_cache, video_path, mask_path, model_path,
+                                         STANDARD_WIDTH, STANDARD_HEIGHT)
+
+    print("=" * 60)
+    print(f"BATCH COUNT: {lane_id}")
+    print("=" * 60)
+    print(f"Video: {video_path} ({total_frames} frames, {fps:.1f} FPS, {duration / 3600:.2f} h)")
+    print(f"Recording start: {datetime.fromtimestamp(start):%Y-%m-%d %H:%M:%S}")
+    print(f"Segments: {len(segments)} x {args.segment_seconds:g}s, workers: {workers}, "
+          f"batch: {args.batch_size}, stride: {stride}")
+    print(f"CPU: {', '.join(format_cores(cores) for cores in core_slices)}"
+          f"{'' if args.no_pinning else ' (pinned)'}")
+    if workers > len(cores_used):
+        print(f"⚠️  {workers} workers on {len(cores_used)} cores: oversubscribed, try --workers {len(cores_used)}")
+    print(f"Detector: {args.backend} ({model_path})")
+    if cache is not None:
+        print(f"Detection cache ({args.cache_mode}): {cache.path}, {len(cache.chunks)} chunks")
+    print("=" * 60)
+
+    tasks = [{
+        'video_path': video_path,
+        'mask_path': mask_path,
+        'limits': limits,
+        'warmup_from': warmup_from,
+        'first': first,
+        'last': last,
+        'stride': stride,
+        'batch_size': args.batch_size,
+        'fps': fps,
+        'interval': args.interval,
+        'max_distance': args.max_distance,
+        'conf_threshold': args.conf_threshold,
+        'cache_dir': args.detection_cache,
+        'cache_key': cache.key if cache else None,
+        'cache_meta': cache.meta if cache else None,
+        'cache_mode': args.cache_mode,
+    } for warmup_from, first, last in segments]
+    slice_queue = multiprocessing.Queue()
+    for cores in core_slices:
+        slice_queue.put(cores)
+    results = []
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(args.backend, model_path, args.device, slice_queue,
+                                       not args.no_pinning)) as pool:
+        for result in pool.map(count_segment, tasks):
+            results.append(result)
+            done_video = sum((r['last'] - r['first']) / fps for r in results)
+            elapsed = time.perf_counter() - started
+            print(f"✓ Frames {result['first']}-{result['last']}: {len(result['crossings'])} crossings, "
+                  f"{result['inferred']} inferred + {result['cached']} cached frames in {result['seconds']:.1f}s "
+                  f"[{len(results)}/{len(segments)}, {done_video / elapsed:.1f}x real time]")
+
+    crossings, duplicates = stitch_crossings(results, fps, args.overlap_seconds, args.max_distance)
+    rows = interval_rows(lane_id, results, crossings, fps, args.interval, start)
+    write_csv(output, rows)
+    elapsed = time.perf_counter() - started
+
+    print(f"\n✅ {len(crossings)} vehicles counted ({duplicates} boundary duplicates removed)")
+    print(f"📄 {len(rows)} intervals of {args.interval:g}s written to {output}")
+    print(f"⏱️  {duration:.0f}s of video in {elapsed:.1f}s ({duration / elapsed:.1f}x real time)")
+    cores_busy = sum(r['cpu_seconds'] for r in results) / elapsed
+    print(f"🧮 CPU: {cores_busy:.1f} of {len(cores_used)} cores busy ({cores_busy / len(cores_used):.0%})")
+    if args.database:
+        written = write_database(rows)
+        print(f"🗄️  {written} rows written to the database")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,175 @@
+"""Preallocated frame buffers for LaneDetector's hot path.
+
+Every green frame used to allocate a capture frame, a resize output, a masked
+copy and a full last_frame copy. Every red loop allocated a copy of last_frame
+plus an overlay copy: about 0.9 MB each at 640x480, four to six times per
+lane per frame. FrameBuffers owns one set of arrays per lane, and the OpenCV
+calls write into them through their dst arguments:
+
+    read        VideoCapture.read(image) refills the slot's capture buffer
+    resize      cv2.resize(..., dst=slot frame), skipped at the standard size
+    mask        cv2.bitwise_and(..., dst=region)
+    red screen  cv2.addWeighted(red, 0.2, last_frame, 0.8, 0, dst=overlay)
+
+Frames alternate between two slots, so the frame being drawn on never
+overwrites last_frame. Keeping last_frame is then a reference swap, not a
+copy.
+
+Allocation benchmark (tracemalloc, old per-frame pattern vs the buffers):
+
+    python buffers.py                          # first lane of LANES_CONFIG
+    python buffers.py --video v.mp4 --mask m.png --frames 300
+"""
+import argparse
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+RED_OPACITY = 0.2
+
+
+class FrameBuffers:
+    def __init__(self, width, height, slots=2):
+        self.size = (width, height)
+        shape = (height, width, 3)
+        self.frames = [np.empty(shape, np.uint8) for _ in range(slots)]
+        self.captured = [None] * slots   # whatever size the source delivers
+        self.region = np.empty(shape, np.uint8)
+        self.overlay = np.empty(shape, np.uint8)
+        self.red = np.empty(shape, np.uint8)
+        self.red[:] = (0, 0, 255)
+        self.slot = 0
+
+    def read(self, cap):
+        """(success, frame) with the next frame at the standard size, in the
+        next slot. The previous frame stays untouched until the one after"""
+        self.slot = (self.slot + 1) % len(self.frames)
+        if self.captured[self.slot] is None:
+            success, captured = cap.read()
+        else:
+            success, captured = cap.read(self.captured[self.slot])
+        if not success:
+            return False, None
+        frame = self.frames[self.slot]
+        if captured.shape[1] != self.size[0] or captured.shape[0] != self.size[1]:
+            self.captured[self.slot] = captured
+            cv2.resize(captured, self.size, dst=frame)
+            return True, frame
+        if not captured.flags.writeable:
+            # Frame cache views are read-only: copy into the slot to draw on it
+            np.copyto(frame, captured)
+            return True, frame
+        self.captured[self.slot] = captured
+        return True, captured
+
+    def masked(self, frame, mask):
+        """frame & mask in the region buffer; frame itself without a mask (the
+        detector only reads it, and drawing starts after detection)"""
+        if mask is None:
+            return frame
+        return cv2.bitwise_and(frame, mask, dst=self.region)
+
+    def red_overlay(self, frame):
+        """frame under the red-light tint, in the overlay buffer"""
+        return cv2.addWeighted(self.red, RED_OPACITY, frame, 1 - RED_OPACITY, 0, dst=self.overlay)
+
+# ==================== ALLOCATION BENCHMARK ====================
+
+
+def legacy_green(cap, mask, width, height):
+    """The green-frame buffer handling before FrameBuffers"""
+    success, img = cap.read()
+    if not success:
+        return None
+    if img.shape[1] != width or img.shape[0] != height:
+        img = cv2.resize(img, (width, height))
+    region = cv2.bitwise_and(img, mask) if mask is not None else img.copy()
+    return img.copy(), region
+
+
+def legacy_red(last_frame):
+    """The red-light frame handling before FrameBuffers"""
+    display = last_frame.copy()
+    overlay = display.copy()
+    cv2.rectangle(overlay, (0, 0), (display.shape[1], display.shape[0]), (0, 0, 255), -1)
+    cv2.addWeighted(overlay, RED_OPACITY, display, 1 - RED_OPACITY, 0, display)
+    return display
+
+
+def measure(step, frames):
+    """Per call: mean seconds, and tracemalloc's peak above the memory held
+    before the call (the transient allocations)"""
+    peaks, started = [], time.perf_counter()
+    for _ in range(frames):
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        if step() is False:
+            break
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    steady = sorted(peaks)[len(peaks) // 2] if peaks else 0
+    return {'frames': len(peaks), 'seconds': (time.perf_counter() - started) / max(1, len(peaks)),
+            'peak_bytes': steady}
+
+
+def allocation_report(video_path, mask, width, height, frames):
+    tracemalloc.start()
+    results = {}
+    try:
+        cap = cv2.VideoCapture(video_path)
+        kept = {}
+
+        def old_green():
+            out = legacy_green(cap, mask, width, height)
+            if out is None:
+                return False
+            kept['last'] = out[0]
+        results['green, before'] = measure(old_green, frames)
+        results['red, before'] = measure(lambda: legacy_red(kept['last']), frames)
+        cap.release()
+
+        cap = cv2.VideoCapture(video_path)
+        buffers = FrameBuffers(width, height)
+
+        def new_green():
+            success, frame = buffers.read(cap)
+            if not success:
+                return False
+            buffers.masked(frame, mask)
+            kept['last'] = frame
+        measure(new_green, 2)   # first pass through each slot allocates the capture buffers
+        results['green, buffers'] = measure(new_green, frames)
+        results['red, buffers'] = measure(lambda: buffers.red_overlay(kept['last']), frames)
+        cap.release()
+    finally:
+        tracemalloc.stop()
+    return results
+
+
+def print_report(results, width, height):
+    frame_bytes = width * height * 3
+    print(f"{'path':<16} {'frames':>6} {'ms/frame':>9} {'alloc/frame':>12} {'frame buffers':>14}")
+    for name, r in results.items():
+        print(f"{name:<16} {r['frames']:>6} {r['seconds'] * 1000:>9.2f} "
+              f"{r['peak_bytes'] / 2**20:>10.2f}MB {r['peak_bytes'] / frame_bytes:>14.1f}")
+
+
+def main():
+    import semaforos
+    parser = argparse.ArgumentParser(description="Per-frame allocations before and after FrameBuffers")
+    parser.add_argument('--video', default=semaforos.LANES_CONFIG[0]['video_path'])
+    parser.add_argument('--mask', default=semaforos.LANES_CONFIG[0]['mask_path'])
+    parser.add_argument('--frames', type=int, default=300)
+    args = parser.parse_args()
+
+    width, height = semaforos.STANDARD_WIDTH, semaforos.STANDARD_HEIGHT
+    mask = cv2.imread(args.mask) if args.mask else None
+    if mask is not None:
+        mask = cv2.resize(mask, (width, height))
+    results = allocation_report(args.video, mask, width, height, args.frames)
+    print_report(results, width, height)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""Clocks for the lane detector.
+
+Everything in LaneDetector that depends on time (rolling average window,
+database update interval, FPS counter, frame_ts) reads self.clock instead of
+time.time(), so recorded footage can be processed faster than real time and
+still produce the same windows and row timestamps as a live run.
+
+    WallClock       live cameras (default)
+    VideoClock      recorded files: recording start + CAP_PROP_POS_MSEC
+    SimulatedClock  advanced by hand, for offline tools and replays
+
+SourcePacer plays a recorded file at its own frame rate on the wall clock,
+the way a camera would deliver it.
+"""
+import time
+from datetime import datetime
+
+import cv2
+
+
+class WallClock:
+    wall = True
+
+    def now(self):
+        return time.time()
+
+
+class VideoClock:
+    """Time of the frame last read from cap.
+
+    start is the wall time of the first frame (epoch seconds). When the video
+    loops back to the beginning the clock keeps going forward, as if the
+    recording continued.
+    """
+    wall = False
+
+    def __init__(self, cap=None, start=0.0):
+        self.cap = cap
+        self.start = float(start)
+        self.offset = 0.0
+        self.last_position = 0.0
+
+    def attach(self, cap):
+        self.cap = cap
+
+    def now(self):
+        position = self.cap.get(cv2.CAP_PROP_POS_MSEC) / 1000 if self.cap is not None else 0.0
+        if position < self.last_position:
+            fps = self.cap.get(cv2.CAP_PROP_FPS)
+            period = 1 / fps if fps > 0 else 0.0
+            if position <= period:
+                # Restarted from the top; short seeks back are not a loop
+                self.offset += self.last_position + period
+        self.last_position = position
+        return self.start + self.offset + position
+
+
+class SimulatedClock:
+    wall = False
+
+    def __init__(self, start=None):
+        self.current = float(start if start is not None else datetime(2024, 1, 1).timestamp())
+
+    def now(self):
+        return self.current
+
+    def advance(self, seconds):
+        self.current += max(0.0, seconds)
+
+    def set(self, timestamp):
+        if timestamp < self.current:
+            raise ValueError(f"Simulated clock cannot go back: {timestamp} < {self.current}")
+        self.current = float(timestamp)
+
+
+class SourcePacer:
+    """Wall-clock schedule for a file source: the frame at media time m is
+    due at anchor + m. Media time comes from CAP_PROP_POS_MSEC, or from the
+    frame position and CAP_PROP_FPS when the container reports no timestamps.
+
+    A lane ahead of the schedule waits (wait_time > 0). A lane behind it
+    skips the overdue frames with catch_up, which grabs them without
+    converting, resizing or detecting, as a camera's frames would be lost.
+    Skips of more than max_grab_seconds seek instead.
+    """
+
+    def __init__(self, fps, max_grab_seconds=2.0, clock=time.monotonic):
+        self.fps = fps if fps and fps > 0 else 30.0
+        self.interval = 1 / self.fps
+        self.max_grab = max(1, int(max_grab_seconds * self.fps))
+        self.clock = clock
+        self.anchor = None
+
+    def media_time(self, cap):
+        """Media time (s) of the frame the next read returns"""
+        position = cap.get(cv2.CAP_PROP_POS_FRAMES)
+        if position <= 0:
+            return 0.0
+        msec = cap.get(cv2.CAP_PROP_POS_MSEC)
+        return msec / 1000 + self.interval if msec > 0 else position * self.interval
+
+    def reset(self, cap):
+        """Makes the next frame due now: at start, after a pause and when the video loops"""
+        self.anchor = self.clock() - self.media_time(cap)
+
+    def wait_time(self, cap):
+        """Seconds until the next frame is due; 0 or less when it is due or late"""
+        if self.anchor is None:
+            self.reset(cap)
+        return self.anchor + self.media_time(cap) - self.clock()
+
+    def catch_up(self, cap):
+        """Skips the frames whose time has already passed, so the next read
+        is the frame due now. Returns how many were skipped"""
+        behind = int(-self.wait_time(cap) * self.fps)
+        if behind <= 0:
+            return 0
+        if behind > self.max_grab:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, cap.get(cv2.CAP_PROP_POS_FRAMES) + behind)
+        else:
+            for _ in range(behind):
+                if not cap.grab():
+                    break
+        return behind
+
+
+def parse_start(value):
+    """Recording start as epoch seconds; accepts numbers or ISO strings"""
+    if value is None:
+        return time.time()
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return datetime.fromisoformat(value).timestamp()
+    return float(value)
+
+
+def make_clock(mode, recording_start=None):
+    if mode == 'wall':
+        return WallClock()
+    if mode == 'video':
+        return VideoClock(start=parse_start(recording_start))
+    if mode == 'simulated':
+        return SimulatedClock(parse_start(recording_start))
+    raise ValueError(f"Unknown clock mode: {mode}")
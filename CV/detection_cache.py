@@ -0,0 +1,212 @@
+"""On-disk cache of raw YOLO detections.
+
+Tuning the tracker, the counting line, MAX_DISTANCE or WINDOW_SIZE does not
+change what the model sees, so each frame's detections can be recorded once
+and replayed into the tracking and counting stage without running YOLO.
+
+One directory per cache key (video fingerprint, mask fingerprint, model and
+resolution: anything that changes the detections themselves):
+
+    <cache_dir>/<key>/meta.json
+    <cache_dir>/<key>/<first>-<end>.boxes.npy    float32 (rows, 6) x1 y1 x2 y2 conf cls
+    <cache_dir>/<key>/<first>-<end>.offsets.npy  int64 (end - first + 1,)
+    <cache_dir>/<key>/<first>-<end>.missing.npy  int64, frames inside the chunk
+                                                 never run through the model
+
+Frame f of a chunk has rows boxes[offsets[f - first]:offsets[f - first + 1]].
+Frames skipped by FRAME_SKIP or --stride are listed as missing, so a replay
+with a smaller stride runs the model on them instead of seeing empty frames.
+Rows are stored unfiltered (every class, everything YOLO returned), so
+VEHICLE_CLASSES and CONF_THRESHOLD can be tuned on replay too, though not
+below the model's own 0.25 default. Chunks are loaded with mmap_mode='r';
+the offsets file is written last, so a chunk without one is ignored.
+"""
+import hashlib
+import json
+import os
+import re
+from bisect import bisect_right
+
+import numpy as np
+
+COLUMNS = ('x1', 'y1', 'x2', 'y2', 'conf', 'cls')
+CHUNK_FRAMES = 9000   # frames per chunk written by the live recorder
+FINGERPRINT_SAMPLE = 1 << 20
+
+_CHUNK_NAME = re.compile(r'^(\d+)-(\d+)\.offsets\.npy$')
+
+
+def file_fingerprint(path, sample=FINGERPRINT_SAMPLE):
+    """Size plus the first, middle and last `sample` bytes: hashing a whole
+    day of video on every start would cost more than the cache saves"""
+    if not path or not os.path.exists(path):
+        return 'none'
+    size = os.path.getsize(path)
+    digest = hashlib.sha1(str(size).encode())
+    with open(path, 'rb') as f:
+        for offset in (0, max(0, size // 2 - sample // 2), max(0, size - sample)):
+            f.seek(offset)
+            digest.update(f.read(sample))
+    return digest.hexdigest()
+
+
+def cache_key(video_path, mask_path, model_path, width, height):
+    parts = [file_fingerprint(video_path), file_fingerprint(mask_path),
+             os.path.basename(str(model_path)), f'{width}x{height}']
+    return hashlib.sha1('|'.join(parts).encode()).hexdigest()[:20]
+
+
+class DetectionCache:
+    """Read side: frame index -> detection rows, from any chunk covering it"""
+
+    def __init__(self, cache_dir, key, meta=None):
+        self.key = key
+        self.path = os.path.join(cache_dir, key)
+        self.meta = meta or {}
+        self.chunks = []      # sorted (first, end, base path)
+        self._loaded = {}     # base path -> (boxes, offsets, missing frames)
+        self._last = None
+        self.refresh()
+
+    @classmethod
+    def for_video(cls, cache_dir, video_path, mask_path, model_path, width, height):
+        meta = {
+            'video_path': video_path,
+            'mask_path': mask_path,
+            'model': os.path.basename(str(model_path)),
+            'width': width,
+            'height': height,
+            'columns': COLUMNS,
+        }
+        return cls(cache_dir, cache_key(video_path, mask_path, model_path, width, height), meta)
+
+    def refresh(self):
+        chunks = []
+        if os.path.isdir(self.path):
+            for name in os.listdir(self.path):
+                match = _CHUNK_NAME.match(name)
+                if match:
+                    first, end = int(match.group(1)), int(match.group(2))
+                    chunks.append((first, end, os.path.join(self.path, f'{match.group(1)}-{match.group(2)}')))
+        self.chunks = sorted(chunks)
+        self._firsts = [c[0] for c in self.chunks]
+
+    def _chunk(self, frame):
+        if self._last is not None and self._last[0] <= frame < self._last[1]:
+            return self._last
+        for i in range(bisect_right(self._firsts, frame) - 1, -1, -1):
+            if frame < self.chunks[i][1]:
+                self._last = self.chunks[i]
+                return self._last
+        return None
+
+    def _arrays(self, base):
+        arrays = self._loaded.get(base)
+        if arrays is None:
+            missing = set()
+            if os.path.exists(base + '.missing.npy'):
+                missing = set(np.load(base + '.missing.npy').tolist())
+            arrays = self._loaded[base] = (np.load(base + '.boxes.npy', mmap_mode='r'),
+                                           np.load(base + '.offsets.npy', mmap_mode='r'),
+                                           missing)
+        return arrays
+
+    def covers(self, first, end):
+        """True when every frame in [first, end) is inside some chunk (missing ones included)"""
+        frame = first
+        while frame < end:
+            chunk = self._chunk(frame)
+            if chunk is None:
+                return False
+            frame = chunk[1]
+        return True
+
+    def get(self, frame):
+        """Rows for frame, or None when it was never run through the model"""
+        chunk = self._chunk(frame)
+        if chunk is None:
+            return None
+        first, _, base = chunk
+        boxes, offsets, missing = self._arrays(base)
+        if frame in missing:
+            # Overlapping chunks: a later run with a smaller stride may have it
+            for other in self.chunks:
+                if other[0] <= frame < other[1] and other[2] != base:
+                    boxes, offsets, missing = self._arrays(other[2])
+                    if frame not in missing:
+                        first = other[0]
+                        self._last = other
+                        break
+            else:
+                return None
+        i = frame - first
+        return boxes[offsets[i]:offsets[i + 1]]
+
+    def recorder(self, chunk_frames=CHUNK_FRAMES):
+        return DetectionRecorder(self, chunk_frames)
+
+
+class DetectionRecorder:
+    """Write side: collects consecutive frames and saves them as chunks.
+
+    Frames already on disk are skipped, so a looping video is recorded once.
+    A short jump forward (frame skip) is recorded as missing frames; a jump
+    back or past the chunk end (seek, loop) closes the current chunk.
+    """
+
+    def __init__(self, cache, chunk_frames=CHUNK_FRAMES):
+        self.cache = cache
+        self.chunk_frames = chunk_frames
+        self.first = None
+        self.next_frame = None
+        self.rows = []
+        self.offsets = [0]
+        self.missing = []
+
+    def add(self, frame, rows):
+        if self.first is not None and frame != self.next_frame:
+            if self.next_frame < frame < self.first + self.chunk_frames:
+                for skipped in range(self.next_frame, frame):
+                    self.missing.append(skipped)
+                    self.offsets.append(self.offsets[-1])
+            else:
+                self.flush()
+        if self.first is None:
+            if self.cache.get(frame) is not None:
+                return
+            self.first = frame
+        self.rows.append(np.asarray(rows, np.float32).reshape(-1, len(COLUMNS)))
+        self.offsets.append(self.offsets[-1] + len(self.rows[-1]))
+        self.next_frame = frame + 1
+        if self.next_frame - self.first >= self.chunk_frames:
+            self.flush()
+
+    def flush(self):
+        if self.first is None:
+            return None
+        os.makedirs(self.cache.path, exist_ok=True)
+        meta_path = os.path.join(self.cache.path, 'meta.json')
+        if not os.path.exists(meta_path):
+            with open(meta_path, 'w', encoding='utf-8') as f:
+                json.dump(self.cache.meta, f, indent=2)
+
+        base = os.path.join(self.cache.path, f'{self.first:09d}-{self.next_frame:09d}')
+        boxes = np.concatenate(self.rows) if self.rows else np.empty((0, len(COLUMNS)), np.float32)
+        np.save(base + '.boxes.npy', boxes)
+        if self.missing:
+            np.save(base + '.missing.npy', np.asarray(self.missing, np.int64))
+        # Offsets last, through a temporary name: their presence marks the chunk complete
+        with open(base + '.offsets.tmp', 'wb') as f:
+            np.save(f, np.asarray(self.offsets, np.int64))
+        os.replace(base + '.offsets.tmp', base + '.offsets.npy')
+
+        self.first = None
+        self.next_frame = None
+        self.rows = []
+        self.offsets = [0]
+        self.missing = []
+        self.cache.refresh()
+        return base
+
+    def close(self):
+        return self.flush()
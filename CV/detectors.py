@@ -0,0 +1,436 @@
+"""Detector backends behind LaneDetector's model call.
+
+Every backend takes a list of BGR images and returns, per image, float32 rows
+(x1, y1, x2, y2, conf, cls) in that image's pixels, the same rows
+tracking.result_array() builds from an ultralytics result. Tracking, the
+detection cache and batch_count.py do not care which backend made them.
+
+    torch        ultralytics YOLO on PyTorch (MODEL_PATH, the original path)
+    onnxruntime  exported ONNX model on ONNX Runtime; FP32 or INT8, any
+                 execution provider (CPU, OpenVINO, ...)
+    opencv       exported ONNX model on OpenCV DNN, no extra dependency
+
+Exporting, INT8 calibration on frames from every lane, and a parity/speed
+report across backends:
+
+    python detectors.py export --model yolov8n.pt              # -> yolov8n.onnx
+    python detectors.py quantize --onnx yolov8n.onnx           # -> yolov8n_int8.onnx
+    python detectors.py report torch onnxruntime:yolov8n.onnx onnxruntime:yolov8n_int8.onnx opencv:yolov8n.onnx
+"""
+import argparse
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+
+from tracking import result_array, empty_rows
+
+BACKENDS = ('torch', 'onnxruntime', 'opencv')
+IMAGE_SIZE = 640
+STRIDE = 32
+CONF = 0.25      # ultralytics predict defaults, so every backend filters alike
+IOU = 0.7
+MAX_DET = 300
+
+
+class Detector:
+    name = ''
+    backend = ''
+
+    def detect(self, images):
+        """[rows] for each image in images"""
+        raise NotImplementedError
+
+    def warmup(self, shape, batch=1, runs=2):
+        """Runs black frames through the model so graph building, kernel
+        selection and buffer allocation happen before the first real frame.
+        Returns the seconds it took"""
+        start = time.perf_counter()
+        images = [np.zeros(shape, np.uint8)] * batch
+        for _ in range(runs):
+            self.detect(images)
+        return time.perf_counter() - start
+
+
+class TorchDetector(Detector):
+    backend = 'torch'
+
+    def __init__(self, model_path, device=None, threads=None, conf=CONF, iou=IOU):
+        import torch
+        from ultralytics import YOLO
+        if threads:
+            torch.set_num_threads(threads)
+        self.model = YOLO(model_path)
+        self.name = os.path.basename(str(model_path))
+        self.kwargs = {'conf': conf, 'iou': iou, 'verbose': False, 'stream': False}
+        if device:
+            self.kwargs['device'] = device
+
+    def detect(self, images):
+        return [result_array(r) for r in self.model(list(images), **self.kwargs)]
+
+
+def letterbox(img, size=IMAGE_SIZE, auto=False, stride=STRIDE):
+    """Resize keeping aspect ratio and pad with gray, like ultralytics' LetterBox.
+    auto pads only up to a multiple of stride (for models with dynamic H/W).
+    Returns (image, gain, (pad_left, pad_top))"""
+    h, w = img.shape[:2]
+    gain = min(size / h, size / w)
+    new_w, new_h = int(round(w * gain)), int(round(h * gain))
+    dw, dh = size - new_w, size - new_h
+    if auto:
+        dw, dh = dw % stride, dh % stride
+    dw, dh = dw / 2, dh / 2
+    if (new_w, new_h) != (w, h):
+        img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    img = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(114, 114, 114))
+    return img, gain, (left, top)
+
+
+def postprocess(prediction, gain, pad, shape, conf=CONF, iou=IOU, max_det=MAX_DET):
+    """One image of raw YOLOv8 output (4 + classes, anchors) -> rows.
+    Per-class NMS, best class per box, boxes back in original pixels"""
+    pred = prediction.T
+    scores = pred[:, 4:]
+    cls = scores.argmax(1)
+    best = scores[np.arange(len(scores)), cls]
+    keep = best > conf
+    if not keep.any():
+        return empty_rows()
+    xywh, best, cls = pred[keep, :4], best[keep], cls[keep]
+
+    xyxy = np.empty_like(xywh)
+    xyxy[:, :2] = xywh[:, :2] - xywh[:, 2:] / 2
+    xyxy[:, 2:] = xywh[:, :2] + xywh[:, 2:] / 2
+    boxes = np.column_stack([xyxy[:, :2], xywh[:, 2:]])
+    indices = np.asarray(cv2.dnn.NMSBoxesBatched(boxes.tolist(), best.tolist(), cls.tolist(), conf, iou),
+                         dtype=np.int64).reshape(-1)
+    indices = indices[np.argsort(-best[indices], kind='stable')][:max_det]
+
+    xyxy = xyxy[indices]
+    xyxy[:, [0, 2]] = ((xyxy[:, [0, 2]] - pad[0]) / gain).clip(0, shape[1])
+    xyxy[:, [1, 3]] = ((xyxy[:, [1, 3]] - pad[1]) / gain).clip(0, shape[0])
+    return np.column_stack([xyxy, best[indices], cls[indices]]).astype(np.float32)
+
+
+class _OnnxDetector(Detector):
+    """Pre/post-processing shared by the backends that run an exported model"""
+    auto = False      # stride-aligned letterbox instead of a square input
+    batched = False   # whole list in one forward pass
+
+    def __init__(self, model_path, conf=CONF, iou=IOU, size=IMAGE_SIZE):
+        self.name = os.path.basename(str(model_path))
+        self.conf = conf
+        self.iou = iou
+        self.size = size
+
+    def detect(self, images):
+        if not images:
+            return []
+        if not self.batched and len(images) > 1:
+            return [rows for img in images for rows in self.detect([img])]
+        boxed = [letterbox(img, self.size, self.auto) for img in images]
+        blob = cv2.dnn.blobFromImages([b[0] for b in boxed], 1 / 255, swapRB=True)
+        output = self._forward(blob)
+        return [postprocess(pred, gain, pad, img.shape, self.conf, self.iou)
+                for pred, (_, gain, pad), img in zip(output, boxed, images)]
+
+    def _forward(self, blob):
+        raise NotImplementedError
+
+
+class OnnxRuntimeDetector(_OnnxDetector):
+    backend = 'onnxruntime'
+
+    def __init__(self, model_path, providers=None, threads=None, **kwargs):
+        import onnxruntime as ort
+        super().__init__(model_path, **kwargs)
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(model_path, options,
+                                            providers=providers or ['CPUExecutionProvider'])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        # Exported with dynamic=True: any batch size and stride-aligned H/W
+        self.batched = not isinstance(model_input.shape[0], int) or model_input.shape[0] > 1
+        self.auto = not all(isinstance(d, int) for d in model_input.shape[2:])
+
+    def _forward(self, blob):
+        return self.session.run(None, {self.input_name: blob})[0]
+
+
+class OpenCVDetector(_OnnxDetector):
+    backend = 'opencv'
+
+    def __init__(self, model_path, threads=None, **kwargs):
+        super().__init__(model_path, **kwargs)
+        if threads:
+            cv2.setNumThreads(threads)
+        self.net = cv2.dnn.readNetFromONNX(model_path)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+
+    def _forward(self, blob):
+        self.net.setInput(blob)
+        return self.net.forward()
+
+
+def make_detector(backend, model_path, device=None, threads=None, **kwargs):
+    if backend == 'torch':
+        return TorchDetector(model_path, device=device, threads=threads, **kwargs)
+    if backend == 'onnxruntime':
+        providers = [device] if device and device.endswith('ExecutionProvider') else None
+        return OnnxRuntimeDetector(model_path, providers=providers, threads=threads, **kwargs)
+    if backend == 'opencv':
+        return OpenCVDetector(model_path, threads=threads, **kwargs)
+    raise ValueError(f"Unknown detector backend: {backend} (expected one of {', '.join(BACKENDS)})")
+
+# ==================== EXPORT, CALIBRATION AND REPORT ====================
+
+
+def sample_lane_frames(lanes, per_lane, width, height):
+    """per_lane evenly spaced frames from each lane's video, resized and
+    masked the way LaneDetector feeds them to the model: [(lane_id, image)]"""
+    samples = []
+    for config in lanes:
+        cap = cv2.VideoCapture(config['video_path'])
+        total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if not cap.isOpened() or total <= 0:
+            print(f"⚠️  [{config['lane_id']}] Video '{config['video_path']}' not readable, skipped")
+            continue
+        mask = None
+        if os.path.exists(config['mask_path']):
+            mask = cv2.resize(cv2.imread(config['mask_path']), (width, height))
+        for index in np.linspace(0, total - 1, num=min(per_lane, total), dtype=int):
+            cap.set(cv2.CAP_PROP_POS_FRAMES, int(index))
+            success, img = cap.read()
+            if not success:
+                continue
+            img = cv2.resize(img, (width, height))
+            samples.append((config['lane_id'], cv2.bitwise_and(img, mask) if mask is not None else img))
+        cap.release()
+    return samples
+
+
+def export_onnx(model_path, size=IMAGE_SIZE):
+    """ONNX copy of an ultralytics model, dynamic batch and H/W"""
+    from ultralytics import YOLO
+    return YOLO(model_path).export(format='onnx', imgsz=size, dynamic=True, simplify=True)
+
+
+def quantize_int8(onnx_path, output_path, samples, size=IMAGE_SIZE):
+    """Static INT8 quantization calibrated on sample frames.
+
+    Only Conv layers are quantized (QDQ, per-channel weights): the detection
+    head concatenates box coordinates in pixels with class scores in 0..1,
+    and one shared INT8 scale for both wipes out the scores. The DFL conv is
+    left in float for the same reason.
+    """
+    import onnx
+    from onnxruntime.quantization import (CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType,
+                                          quantize_static)
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    source = onnx_path
+    prepared = os.path.splitext(output_path)[0] + '_prep.onnx'
+    try:
+        quant_pre_process(onnx_path, prepared)
+        source = prepared
+    except Exception as e:
+        print(f"⚠️  Pre-processing skipped ({e}); quantizing the exported graph as is")
+
+    graph = onnx.load(source).graph
+    model_input = graph.input[0]
+    dims = model_input.type.tensor_type.shape.dim
+    auto = not all(d.HasField('dim_value') for d in dims[2:])
+    excluded = [node.name for node in graph.node if '/dfl/' in node.name]
+
+    class LaneFrames(CalibrationDataReader):
+        def __init__(self):
+            self.frames = iter(samples)
+
+        def get_next(self):
+            sample = next(self.frames, None)
+            if sample is None:
+                return None
+            img = letterbox(sample[1], size, auto)[0]
+            return {model_input.name: cv2.dnn.blobFromImage(img, 1 / 255, swapRB=True)}
+
+    quantize_static(source, output_path, LaneFrames(), quant_format=QuantFormat.QDQ,
+                    op_types_to_quantize=['Conv'], nodes_to_exclude=excluded, per_channel=True,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                    calibrate_method=CalibrationMethod.MinMax)
+    if source == prepared:
+        os.remove(prepared)
+    return output_path
+
+
+def box_iou(a, b):
+    """IoU matrix between (n, 4) and (m, 4) xyxy arrays"""
+    top_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    bottom_right = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.prod((bottom_right - top_left).clip(0), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    return inter / (area_a[:, None] + area_b[None, :] - inter + 1e-9)
+
+
+def compare_rows(reference, rows, min_iou=0.5):
+    """Greedy same-class matches: (matched, missed, extra, sum of IoU, sum of |dconf|)"""
+    if not len(reference) or not len(rows):
+        return 0, len(reference), len(rows), 0.0, 0.0
+    iou = box_iou(np.asarray(reference[:, :4]), np.asarray(rows[:, :4]))
+    iou[reference[:, 5][:, None] != rows[:, 5][None, :]] = 0
+    matched, iou_sum, conf_sum = 0, 0.0, 0.0
+    while True:
+        i, j = np.unravel_index(iou.argmax(), iou.shape)
+        if iou[i, j] < min_iou:
+            break
+        matched += 1
+        iou_sum += iou[i, j]
+        conf_sum += abs(float(reference[i, 4]) - float(rows[j, 4]))
+        iou[i, :] = 0
+        iou[:, j] = 0
+    return matched, len(reference) - matched, len(rows) - matched, iou_sum, conf_sum
+
+
+def backend_report(specs, samples, batch_size, classes, conf_threshold, default_paths):
+    """Detections, latency, throughput and memory per backend; parity is
+    measured against the first spec"""
+    import psutil
+    process = psutil.Process()
+    images = [img for _, img in samples]
+    report = []
+    reference = None
+
+    for spec in specs:
+        backend, _, path = spec.partition(':')
+        path = path or default_paths[backend]
+        entry = {'backend': backend, 'model': path}
+        rss_before = process.memory_info().rss
+        try:
+            detector = make_detector(backend, path)
+            detector.detect(images[:1])  # warm-up: lazy init, allocator, kernel selection
+            latencies = []
+            outputs = []
+            for img in images:
+                start = time.perf_counter()
+                outputs.extend(detector.detect([img]))
+                latencies.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            for i in range(0, len(images), batch_size):
+                detector.detect(images[i:i + batch_size])
+            batched_seconds = time.perf_counter() - start
+        except Exception as e:
+            entry['error'] = str(e)
+            report.append(entry)
+            print(f"❌ {spec}: {e}")
+            continue
+
+        latencies_ms = np.array(latencies) * 1000
+        vehicles = [sum(1 for r in rows if int(r[5]) in classes and r[4] > conf_threshold) for rows in outputs]
+        entry.update({
+            'frames': len(images),
+            'p50_ms': float(np.percentile(latencies_ms, 50)),
+            'p95_ms': float(np.percentile(latencies_ms, 95)),
+            'fps_batch1': len(images) / (latencies_ms.sum() / 1000),
+            f'fps_batch{batch_size}': len(images) / batched_seconds,
+            'rss_mb': (process.memory_info().rss - rss_before) / 2**20,
+            'detections': int(sum(len(rows) for rows in outputs)),
+            'vehicles': int(sum(vehicles)),
+        })
+        if reference is None:
+            reference = (outputs, vehicles)
+        else:
+            totals = np.sum([compare_rows(a, b) for a, b in zip(reference[0], outputs)], axis=0)
+            matched, missed, extra, iou_sum, conf_sum = totals
+            entry.update({
+                'recall': matched / max(matched + missed, 1),
+                'precision': matched / max(matched + extra, 1),
+                'mean_iou': iou_sum / max(matched, 1),
+                'mean_conf_diff': conf_sum / max(matched, 1),
+                'vehicle_count_diff': int(sum(abs(a - b) for a, b in zip(reference[1], vehicles))),
+            })
+        report.append(entry)
+        del detector
+    return report
+
+
+def print_report(report, batch_size):
+    print(f"\n{'backend':<12} {'model':<24} {'p50 ms':>7} {'p95 ms':>7} {'fps b1':>7} "
+          f"{f'fps b{batch_size}':>7} {'RSS MB':>7} {'recall':>7} {'prec':>6} {'IoU':>5} {'|dveh|':>6}")
+    for e in report:
+        if 'error' in e:
+            print(f"{e['backend']:<12} {os.path.basename(e['model']):<24} ❌ {e['error']}")
+            continue
+        parity = (f"{e['recall']:>7.3f} {e['precision']:>6.3f} {e['mean_iou']:>5.3f} {e['vehicle_count_diff']:>6}"
+                  if 'recall' in e else f"{'(reference)':>29}")
+        print(f"{e['backend']:<12} {os.path.basename(e['model']):<24} {e['p50_ms']:>7.1f} {e['p95_ms']:>7.1f} "
+              f"{e['fps_batch1']:>7.1f} {e[f'fps_batch{batch_size}']:>7.1f} {e['rss_mb']:>7.0f} {parity}")
+
+
+def main():
+    import semaforos
+
+    parser = argparse.ArgumentParser(description="Export, quantize and compare detector backends")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export = commands.add_parser('export', help="export the PyTorch model to ONNX")
+    export.add_argument('--model', default=semaforos.MODEL_PATH)
+    export.add_argument('--imgsz', type=int, default=IMAGE_SIZE)
+
+    quantize = commands.add_parser('quantize', help="INT8 calibration on frames from every lane")
+    quantize.add_argument('--onnx', default=semaforos.ONNX_MODEL_PATH)
+    quantize.add_argument('--output', help="default: <onnx>_int8.onnx")
+    quantize.add_argument('--frames-per-lane', type=int, default=32)
+    quantize.add_argument('--imgsz', type=int, default=IMAGE_SIZE)
+
+    report = commands.add_parser('report', help="parity and speed across backends")
+    report.add_argument('specs', nargs='*', metavar='BACKEND[:MODEL]',
+                        help="first one is the reference (default: torch onnxruntime opencv)")
+    report.add_argument('--frames-per-lane', type=int, default=20)
+    report.add_argument('--batch-size', type=int, default=8)
+    report.add_argument('--json', help="also write the report to this file")
+
+    for command in (quantize, report):
+        command.add_argument('--lanes', nargs='*', help="lane_ids to sample (default: all)")
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        path = export_onnx(args.model, args.imgsz)
+        print(f"✅ Exported {args.model} -> {path}")
+        return 0
+
+    lanes = [c for c in semaforos.LANES_CONFIG if not args.lanes or c['lane_id'] in args.lanes]
+    samples = sample_lane_frames(lanes, args.frames_per_lane, semaforos.STANDARD_WIDTH, semaforos.STANDARD_HEIGHT)
+    if not samples:
+        print("❌ No sample frames: check the lanes' video_path")
+        return 1
+    print(f"🎞️  {len(samples)} sample frames from {len({lane for lane, _ in samples})} lane(s)")
+
+    if args.command == 'quantize':
+        output = args.output or os.path.splitext(args.onnx)[0] + '_int8.onnx'
+        quantize_int8(args.onnx, output, samples, args.imgsz)
+        print(f"✅ INT8 model calibrated on {len(samples)} frames: {output} "
+              f"({os.path.getsize(args.onnx) / 2**20:.1f} MB -> {os.path.getsize(output) / 2**20:.1f} MB)")
+        return 0
+
+    specs = args.specs or list(BACKENDS)
+    default_paths = {backend: semaforos.detector_model_path(backend) for backend in BACKENDS}
+    results = backend_report(specs, samples, args.batch_size, semaforos.VEHICLE_CLASSES,
+                             semaforos.CONF_THRESHOLD, default_paths)
+    print_report(results, args.batch_size)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"\n📄 Report written to {args.json}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,149 @@
+"""Pre-decoded frame cache for looping source videos.
+
+The demo deployment plays the same few files forever, and every loop used to
+decode the H.264 stream and resize every frame to the standard resolution
+again. The first time a video is opened with the cache enabled, all of its
+frames are decoded, resized and written once to a raw uint8 file:
+
+    <cache_dir>/<name>_<fingerprint>_<W>x<H>.u8     frames * H * W * 3 bytes, BGR
+    <cache_dir>/<name>_<fingerprint>_<W>x<H>.json   frames, fps, width, height
+
+CachedVideoSource then serves frames straight from a read-only memmap of that
+file: read() returns a view into the page cache, with no decode, resize or
+copy. The views are not writable; copy before drawing on them.
+
+Raw frames are big (640x480 is ~0.9 MB each, ~1.6 GB per minute at 30 FPS),
+so videos above max_mb are played from the file as before.
+"""
+import json
+import os
+
+import cv2
+import numpy as np
+
+from detection_cache import file_fingerprint
+
+
+def cache_paths(video_path, cache_dir, width, height):
+    name = os.path.splitext(os.path.basename(video_path))[0]
+    base = os.path.join(cache_dir, f'{name}_{file_fingerprint(video_path)[:12]}_{width}x{height}')
+    return base + '.u8', base + '.json'
+
+
+def build_frame_cache(video_path, cache_dir, width, height, max_mb):
+    """Decodes and resizes every frame into the raw cache file; returns the
+    meta dict, or None when the video is too big or cannot be read"""
+    data_path, meta_path = cache_paths(video_path, cache_dir, width, height)
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        return None
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    expected = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    frame_bytes = width * height * 3
+    if expected * frame_bytes > max_mb * 1024 * 1024:
+        cap.release()
+        print(f"⚠️  Frame cache skipped for '{video_path}': {expected * frame_bytes / 2**20:.0f} MB > {max_mb} MB")
+        return None
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = data_path + '.tmp'
+    frames = 0
+    try:
+        with open(tmp_path, 'wb') as f:
+            while True:
+                success, img = cap.read()
+                if not success:
+                    break
+                if img.shape[1] != width or img.shape[0] != height:
+                    img = cv2.resize(img, (width, height))
+                f.write(np.ascontiguousarray(img).data)
+                frames += 1
+                if frames * frame_bytes > max_mb * 1024 * 1024:
+                    print(f"⚠️  Frame cache skipped for '{video_path}': more than {max_mb} MB")
+                    os.remove(tmp_path)
+                    return None
+    finally:
+        cap.release()
+    if not frames:
+        os.remove(tmp_path)
+        return None
+
+    meta = {'frames': frames, 'fps': fps, 'width': width, 'height': height, 'video_path': video_path}
+    os.replace(tmp_path, data_path)
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+class CachedVideoSource:
+    """The part of cv2.VideoCapture that LaneDetector and VideoClock use,
+    served from a frame cache file"""
+
+    def __init__(self, data_path, meta):
+        self.meta = meta
+        self.fps = meta['fps']
+        self.frames = np.memmap(data_path, dtype=np.uint8, mode='r',
+                                shape=(meta['frames'], meta['height'], meta['width'], 3))
+        self.position = 0
+
+    def isOpened(self):
+        return self.frames is not None
+
+    def grab(self):
+        if self.position >= len(self.frames):
+            return False
+        self.position += 1
+        return True
+
+    def retrieve(self, image=None):
+        # image is accepted like VideoCapture's, but the view needs no buffer
+        return True, self.frames[self.position - 1].view(np.ndarray)
+
+    def read(self, image=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return float(self.position)
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            # Like OpenCV: time of the last frame read
+            return max(0, self.position - 1) * 1000 / self.fps if self.fps > 0 else 0.0
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return float(len(self.frames))
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.meta['width'])
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.meta['height'])
+        return 0.0
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            self.position = min(max(0, int(value)), len(self.frames))
+            return True
+        return False
+
+    def release(self):
+        self.frames = None
+
+
+def open_cached_video(video_path, cache_dir, width, height, max_mb):
+    """CachedVideoSource for video_path, building the cache on first use;
+    None when the video cannot be cached"""
+    data_path, meta_path = cache_paths(video_path, cache_dir, width, height)
+    meta = None
+    if os.path.exists(data_path) and os.path.exists(meta_path):
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        if os.path.getsize(data_path) != meta['frames'] * height * width * 3:
+            meta = None
+    if meta is None:
+        print(f"🎞️  Building frame cache for '{video_path}'...")
+        meta = build_frame_cache(video_path, cache_dir, width, height, max_mb)
+        if meta is None:
+            return None
+        print(f"✅ Frame cache: {meta['frames']} frames in {data_path}")
+    return CachedVideoSource(data_path, meta)
@@ -0,0 +1,201 @@
+"""Low-overhead metrics for the lane detector, served as Prometheus text.
+
+Stage timings go into fixed-bucket histograms: one cumulative copy for
+Prometheus (histogram_quantile over rate()) and a rolling copy over the last
+WINDOW_SECONDS, exported directly as p50/p95/p99 gauges. Recording is a bisect
+and two list increments under a lock, cheap enough for every frame.
+
+    curl http://localhost:9108/metrics
+"""
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+from threading import Lock, Thread
+
+BUCKETS_S = (0.0005, 0.001, 0.0025, 0.005, 0.0075, 0.01, 0.015, 0.02, 0.03, 0.04, 0.05, 0.075,
+             0.1, 0.15, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+WINDOW_SECONDS = 60
+WINDOW_SLOTS = 12
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class RollingHistogram:
+    def __init__(self, buckets=BUCKETS_S, window=WINDOW_SECONDS, slots=WINDOW_SLOTS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.slot_width = window / slots
+        self.slots = [[0] * (len(buckets) + 1) for _ in range(slots)]
+        self.slot_ids = [-1] * slots
+
+    def observe(self, value, now=None):
+        i = bisect_left(self.buckets, value)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+        slot_id = int((now or time.monotonic()) / self.slot_width)
+        k = slot_id % len(self.slots)
+        if self.slot_ids[k] != slot_id:
+            self.slots[k] = [0] * (len(self.buckets) + 1)
+            self.slot_ids[k] = slot_id
+        self.slots[k][i] += 1
+
+    def window_quantiles(self, quantiles=QUANTILES, now=None):
+        oldest = int((now or time.monotonic()) / self.slot_width) - len(self.slots) + 1
+        window = [0] * (len(self.buckets) + 1)
+        for slot_id, counts in zip(self.slot_ids, self.slots):
+            if slot_id >= oldest:
+                window = [a + b for a, b in zip(window, counts)]
+        total = sum(window)
+        if not total:
+            return {q: 0.0 for q in quantiles}
+
+        result = {}
+        for q in quantiles:
+            target, seen = q * total, 0
+            for i, n in enumerate(window):
+                if seen + n >= target and n:
+                    low = self.buckets[i - 1] if i > 0 else 0.0
+                    high = self.buckets[i] if i < len(self.buckets) else self.buckets[-1] * 2
+                    result[q] = low + (high - low) * (target - seen) / n
+                    break
+                seen += n
+        return result
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+class MetricsRegistry:
+    """Counters, gauges and rolling histograms keyed by name and labels; thread-safe"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.help = {}
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.server = None
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, _labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, _labels(labels))] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _labels(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = RollingHistogram()
+            histogram.observe(seconds)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {k: (list(h.counts), h.sum, h.count, h.window_quantiles())
+                          for k, h in self.histograms.items()}
+
+        def header(name, default_kind):
+            kind, text = self.help.get(name, (default_kind, name))
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for family in sorted({k[0] for k in counters}):
+            header(family, 'counter')
+            for (name, labels), value in sorted(counters.items()):
+                if name == family:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        for family in sorted({k[0] for k in gauges}):
+            header(family, 'gauge')
+            for (name, labels), value in sorted(gauges.items()):
+                if name == family:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        for family in sorted({k[0] for k in histograms}):
+            header(family, 'histogram')
+            for (name, labels), (counts, total, count, _) in sorted(histograms.items()):
+                if name != family:
+                    continue
+                cumulative = 0
+                for bound, n in zip(BUCKETS_S, counts):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {total:.6f}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+            window_name = f"{family}_window"
+            lines.append(f"# HELP {window_name} {family} quantiles over the last {WINDOW_SECONDS}s")
+            lines.append(f"# TYPE {window_name} gauge")
+            for (name, labels), (_, _, _, quantiles) in sorted(histograms.items()):
+                if name == family:
+                    for q, value in quantiles.items():
+                        lines.append(f"{window_name}{_format_labels(labels, [('quantile', q)])} {value:.6f}")
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host='0.0.0.0', routes=None):
+        """Serve /metrics from a daemon thread.
+
+        routes maps extra paths to callables taking the query dict and
+        returning text; they only answer requests from localhost.
+        """
+        registry = self
+        routes = routes or {}
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path, _, query = self.path.partition('?')
+                if path == '/metrics':
+                    text = registry.render()
+                elif path in routes:
+                    if self.client_address[0] not in ('127.0.0.1', '::1'):
+                        self.send_error(403)
+                        return
+                    text = routes[path](dict(parse_qsl(query))) + "\n"
+                else:
+                    self.send_error(404)
+                    return
+                body = text.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+    def shutdown(self):
+        if self.server:
+            self.server.shutdown()
+            self.server = None
+
+
+metrics = MetricsRegistry()
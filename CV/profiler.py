@@ -0,0 +1,152 @@
+"""On-demand sampling profiler for long-running processes.
+
+SIGUSR1 (or GET /profile on the metrics port) starts a capture; the next
+SIGUSR1 stops it, otherwise it stops by itself after max_seconds. While
+running, a background thread samples the stacks of every thread with
+sys._current_frames(), so it sees the frame loop, the telemetry writer and
+the MQTT thread without slowing them down like cProfile would.
+
+Each capture writes two files to output_dir:
+    <prefix>_<time>.folded   one "thread;outer;...;inner count" line per stack,
+                             ready for flamegraph.pl or speedscope
+    <prefix>_<time>.top.txt  top-N functions by own and total samples
+
+    kill -USR1 <pid>        # start
+    kill -USR1 <pid>        # stop and write
+"""
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+
+class SamplingProfiler:
+    def __init__(self, output_dir='profiles', prefix='profile', interval=0.005, max_seconds=60, top_n=30):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.top_n = top_n
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.last_output = None
+        self._labels = {}
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def install_signal(self, signum=getattr(signal, 'SIGUSR1', None)):
+        """Toggle with a signal; returns False where the signal does not exist (Windows).
+        The handler only flips the state; the sampler thread does the printing."""
+        if signum is None:
+            return False
+        signal.signal(signum, lambda *_: self.toggle())
+        return True
+
+    def toggle(self, seconds=None):
+        return self.stop() if self.running else self.start(seconds)
+
+    def start(self, seconds=None):
+        with self.lock:
+            if self.running:
+                return "Profiler already running"
+            seconds = min(seconds or self.max_seconds, self.max_seconds)
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._run, args=(seconds,), name='sampling-profiler', daemon=True)
+            self.thread.start()
+            return f"Profiling started ({self.interval * 1000:.0f}ms interval, stops after {seconds:g}s)"
+
+    def stop(self, wait=False):
+        """Asks the sampler to stop; it writes its files on the way out"""
+        with self.lock:
+            if not self.running:
+                return "Profiler not running"
+            self.stop_event.set()
+            thread = self.thread
+        if wait:
+            thread.join()
+            return f"Profiling stopped, written to {self.last_output}"
+        return "Profiling stopping, writing output"
+
+    def handle_request(self, query):
+        """/profile?action=start|stop|toggle&seconds=N, for the metrics endpoint"""
+        action = query.get('action', 'toggle')
+        try:
+            seconds = float(query['seconds']) if 'seconds' in query else None
+        except ValueError:
+            return f"Invalid seconds: {query['seconds']}"
+        if action == 'start':
+            return self.start(seconds)
+        if action == 'stop':
+            return self.stop(wait=True)
+        return self.toggle(seconds)
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            self._labels[code] = label
+        return label
+
+    def _run(self, seconds):
+        own_id = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        started = time.perf_counter()
+        deadline = started + seconds
+        print(f"🔬 Profiling started ({self.interval * 1000:.0f}ms interval, stops after {seconds:g}s)")
+
+        while not self.stop_event.is_set() and time.perf_counter() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                stacks[';'.join(reversed(stack))] += 1
+            samples += 1
+            self.stop_event.wait(self.interval)
+
+        elapsed = time.perf_counter() - started
+        try:
+            self.last_output = self._write(stacks, samples, elapsed)
+            print(f"🔬 Profile written: {self.last_output}.folded / .top.txt ({samples} samples, {elapsed:.1f}s)")
+        except OSError as e:
+            print(f"❌ Could not write profile: {e}")
+
+    def _write(self, stacks, samples, elapsed):
+        os.makedirs(self.output_dir, exist_ok=True)
+        base = os.path.join(self.output_dir, f"{self.prefix}_{datetime.now():%Y%m%d_%H%M%S}")
+
+        with open(base + '.folded', 'w', encoding='utf-8') as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        own, total = Counter(), Counter()
+        for stack, count in stacks.items():
+            frames = stack.split(';')[1:]
+            if frames:
+                own[frames[-1]] += count
+            for name in set(frames):
+                total[name] += count
+
+        # One sample per thread per tick: percentages are of thread-samples
+        thread_samples = sum(stacks.values()) or 1
+        period = elapsed / max(samples, 1)
+        with open(base + '.top.txt', 'w', encoding='utf-8') as f:
+            f.write(f"{samples} samples in {elapsed:.1f}s, {self.interval * 1000:.0f}ms interval, "
+                    f"{thread_samples} thread-samples\n")
+            for title, counter in (('own', own), ('total', total)):
+                f.write(f"\nTop {self.top_n} by {title} samples\n")
+                f.write(f"{'samples':>8} {'%':>6} {'~s':>7}  function\n")
+                for name, count in counter.most_common(self.top_n):
+                    f.write(f"{count:>8} {count / thread_samples:>6.1%} {count * period:>7.2f}  {name}\n")
+        return base
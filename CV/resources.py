@@ -0,0 +1,164 @@
+"""CPU budget for the lane detector and the batch counter.
+
+Left alone, every library sizes its thread pool to the whole machine:
+PyTorch's intra-op pool, OpenCV's parallel_for pool, FFmpeg's decoder threads
+in each VideoCapture and the BLAS pool each start about one thread per core.
+With several lanes, a 4 or 8-core box runs several times more busy threads
+than it has cores, and they keep preempting each other. A ResourcePlan
+splits the cores into three roles and sizes each pool to its share:
+
+    io         telemetry writer, MQTT loop, metrics server (mostly asleep)
+    decode     FFmpeg decoder threads of the lanes' VideoCaptures
+    inference  the frame loop thread and the detector's thread pool
+
+On Linux, affinity is per thread, and a new thread inherits it from the
+thread that starts it. So pin(role) pins the calling thread just before the
+threads of that role are started. Where sched_setaffinity is not available,
+only the thread counts are applied.
+"""
+import os
+import time
+
+import cv2
+
+BLAS_ENV = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+ROLES = ('io', 'decode', 'inference')
+
+
+def available_cores():
+    """Core ids this process may run on (its affinity mask, not cpu_count)"""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class ResourcePlan:
+    def __init__(self, roles):
+        self.roles = roles   # role -> [core ids]; roles may share cores on small boxes
+
+    @property
+    def all_cores(self):
+        return sorted(set().union(*self.roles.values()))
+
+    def threads(self, role):
+        return len(self.roles[role])
+
+    def decoder_threads(self, lanes):
+        """FFmpeg threads per VideoCapture so all lanes together fit the decode cores"""
+        return max(1, self.threads('decode') // max(1, lanes))
+
+    def pin(self, role):
+        """Pins the calling thread, and the threads it starts from now on, to
+        role's cores. False where the OS has no per-thread affinity"""
+        if not hasattr(os, 'sched_setaffinity'):
+            return False
+        os.sched_setaffinity(0, self.roles[role])
+        return True
+
+    def describe(self):
+        return ", ".join(f"{role}: {format_cores(self.roles[role])}" for role in ROLES)
+
+
+def format_cores(cores):
+    return f"{len(cores)} core{'s' if len(cores) != 1 else ''} [{','.join(str(c) for c in cores)}]"
+
+
+def plan_live(lanes, cores=None, io_cores=1):
+    """Plan for semaforos.py. The frame loop decodes and runs inference for
+    every lane in turn on one thread, so decoding needs far less than the
+    model: a quarter of the compute cores, at most one per lane. Below 4
+    cores, a dedicated I/O core would cost more than it saves, so every role
+    shares every core"""
+    cores = list(cores or available_cores())
+    if len(cores) < 4:
+        return ResourcePlan({role: cores for role in ROLES})
+    io_cores = min(max(1, io_cores), len(cores) - 2)
+    io, compute = cores[-io_cores:], cores[:-io_cores]
+    decode = max(1, min(lanes, len(compute) // 4))
+    return ResourcePlan({'io': io, 'decode': compute[:decode], 'inference': compute[decode:]})
+
+
+def plan_batch(workers, cores=None):
+    """[cores] per batch_count.py worker process. Each worker decodes and
+    infers on its own slice; leftover cores go to the first workers. With more
+    workers than cores, the slices are single cores shared round-robin"""
+    cores = list(cores or available_cores())
+    workers = max(1, workers)
+    if workers >= len(cores):
+        return [[cores[i % len(cores)]] for i in range(workers)]
+    size, extra = divmod(len(cores), workers)
+    slices, start = [], 0
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        slices.append(cores[start:end])
+        start = end
+    return slices
+
+
+def limit_blas(threads):
+    """Caps the BLAS pools of numpy/scipy. Goes through threadpoolctl when it
+    is installed; otherwise sets only the environment variables, which
+    processes started later read. True when the running pools were capped"""
+    for name in BLAS_ENV:
+        os.environ[name] = str(threads)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return False
+    threadpool_limits(threads, user_api='blas')
+    return True
+
+
+def capture_params(threads):
+    """VideoCapture open params setting the decoder thread count (OpenCV >= 4.6)"""
+    if hasattr(cv2, 'CAP_PROP_N_THREADS'):
+        return [cv2.CAP_PROP_N_THREADS, threads]
+    return []
+
+
+def open_capture(path, threads):
+    params = capture_params(threads)
+    if params:
+        return cv2.VideoCapture(path, cv2.CAP_ANY, params)
+    return cv2.VideoCapture(path)
+
+
+class UtilizationMeter:
+    """CPU time used by this process, compared with the cores the plan gives
+    it. Also reports how busy each of those cores is overall, through psutil
+    when it is installed. A low share with busy cores means something else is
+    competing for them; a low share with idle cores means the budget is too
+    big for the work"""
+
+    def __init__(self, cores):
+        self.cores = list(cores)
+        try:
+            import psutil
+            psutil.cpu_percent(percpu=True)   # first call only sets the baseline
+            self.psutil = psutil
+        except ImportError:
+            self.psutil = None
+        self._reset()
+
+    def _reset(self):
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+
+    def sample(self, reset=True):
+        """{'cores_busy', 'utilization', 'per_core'} since the last sample"""
+        wall = time.perf_counter() - self._wall
+        busy = (time.process_time() - self._cpu) / wall if wall > 0 else 0.0
+        per_core = {}
+        if self.psutil is not None:
+            percents = self.psutil.cpu_percent(percpu=True)
+            per_core = {core: percents[core] / 100 for core in self.cores if core < len(percents)}
+        if reset:
+            self._reset()
+        return {'cores_busy': busy, 'utilization': busy / len(self.cores), 'per_core': per_core}
+
+
+def format_utilization(sample, cores):
+    line = f"{sample['cores_busy']:.1f} of {len(cores)} planned cores busy ({sample['utilization']:.0%})"
+    if sample['per_core']:
+        line += "; per core: " + " ".join(f"{core}:{busy:.0%}" for core, busy in sample['per_core'].items())
+    return line
@@ -1,17 +1,24 @@
 import numpy as np
-from ultralytics import YOLO
 import cv2
 import time
-from collections import deque
+from collections import deque, namedtuple
 from datetime import datetime
-import psycopg2
 import os
-import firebase_admin
-from firebase_admin import credentials, db
-from threading import Thread, Lock
-import paho.mqtt.client as mqtt
+from threading import Thread, Lock, Event, Condition
 import json
-import re
+import queue
+from types import MappingProxyType
+from tracing import Tracer
+from metrics import metrics
+from profiler import SamplingProfiler
+from clocks import SourcePacer, make_clock
+from tracking import CentroidTracker, detections_from_array
+from detectors import make_detector
+from buffers import FrameBuffers
+from resources import plan_live, limit_blas, open_capture, UtilizationMeter, format_utilization
+from detection_cache import DetectionCache
+from frame_cache import open_cached_video
+from sources import LiveSource, is_live_source, describe_source
 
 # ==================== CONFIGURATION ====================
 
@@ -30,7 +37,10 @@ STANDARD_WIDTH = 640
 STANDARD_HEIGHT = 480
 
 # Lane configurations - easily add or remove lanes
-# Map lane_id to traffic light letter (A, B, C, D)
+# Map lane_id to traffic light letter (A, B, C, D, ...). Any number of lanes
+# is supported; 'window_position' is optional and defaults to a grid slot.
+# 'video_path' may also be a camera: an rtsp:// or http:// (MJPEG) URL or a
+# V4L2 device such as '/dev/video0' (see sources.py).
 LANES_CONFIG = [
     {
         'lane_id': 'lane_1',
@@ -79,7 +89,105 @@ FIREBASE_CONFIG = {
     'database_url': 'https://projetedb-2224f-default-rtdb.firebaseio.com/'
 }
 
+# Grid used when a lane has no explicit 'window_position'
+WINDOW_GRID_COLUMNS = 2
+WINDOW_GRID_STEP = (650, 450)
+
+# Tracing: frame_ts/trace_id go to veiculos, spans to TRACE_FILE under TRACE_DIR
+# (report with: python ML/rastreamento.py ML/rastros/spans_ml.jsonl CV/traces/spans_cv.jsonl)
+TRACING_ENABLED = True
+TRACE_DIR = 'traces'
+TRACE_FILE = 'spans_cv.jsonl'
+
+# Metrics: per-lane, per-stage timings, queue depth and dropped-frame counters
+# served as Prometheus text on http://<host>:METRICS_PORT/metrics
+METRICS_ENABLED = True
+METRICS_PORT = 9108
+
+# Telemetry rows are written by a background thread so a slow database does not
+# stall the frame loop; when the queue is full the oldest pending row is dropped
+DB_QUEUE_SIZE = 32
+
+# Profiling: SIGUSR1, or GET /profile on METRICS_PORT from localhost, toggles a
+# sampling capture of all threads written to PROFILE_DIR
+PROFILE_DIR = 'profiles'
+PROFILE_INTERVAL = 0.005
+PROFILE_MAX_SECONDS = 60
+
+# Clock behind the rolling average, database interval, FPS counter and frame_ts:
+# 'wall' for live cameras, 'video' to process recordings faster than real time
+# using the footage's own timestamps (set 'recording_start' per lane, epoch
+# seconds or ISO string, so rows get the time the footage was shot)
+CLOCK_MODE = 'wall'
+
+# Detection cache: 'record' runs YOLO on every frame and saves the raw
+# detections under DETECTION_CACHE_DIR (keyed by video, mask and model);
+# 'replay' feeds cached detections to tracking and counting instead of running
+# YOLO, recording whatever is not cached yet; 'off' disables it. Use 'replay'
+# to tune limits, MAX_DISTANCE or WINDOW_SIZE without re-running the model.
+DETECTION_CACHE = 'off'
+DETECTION_CACHE_DIR = 'detection_cache'
+
+# Frame cache: each looping source video is decoded and resized once into a
+# raw memory-mapped file under FRAME_CACHE_DIR and played from there, so later
+# loops cost no decoding. Videos above FRAME_CACHE_MAX_MB (640x480 is ~0.9 MB
+# per frame) are played from the file as before.
+FRAME_CACHE_ENABLED = False
+FRAME_CACHE_DIR = 'frame_cache'
+FRAME_CACHE_MAX_MB = 4096
+
+# Detector backend: 'torch' runs MODEL_PATH on PyTorch; 'onnxruntime' and
+# 'opencv' run ONNX_MODEL_PATH, made with `python detectors.py export` (and
+# `quantize` for INT8). Compare them with `python detectors.py report`.
+DETECTOR_BACKEND = 'torch'
+ONNX_MODEL_PATH = 'yolov8n.onnx'
+
+# Start-up: the detector is loaded in a background thread while the lanes open
+# their videos, then runs DETECTOR_WARMUP_RUNS dummy frames so the first live
+# frame does not pay for graph building and allocations (0 disables it).
+# psycopg2, firebase_admin and paho are only imported by the code that uses them.
+DETECTOR_WARMUP_RUNS = 2
+
+# CPU budget (resources.py): the cores this process may use are split among
+# I/O threads, video decoding and inference, and each thread pool (PyTorch,
+# OpenCV, FFmpeg, BLAS) is sized to its share instead of the whole machine.
+# CPU_CORES limits the cores used (None = all allowed); CPU_PINNING also pins
+# each role's threads to its cores. Utilization is reported every
+# CPU_REPORT_INTERVAL seconds.
+CPU_CORES = None
+CPU_IO_CORES = 1
+CPU_PINNING = True
+CPU_REPORT_INTERVAL = 30
+
+# While every lane is red the main loop sleeps until the traffic state changes,
+# waking every IDLE_GUI_INTERVAL seconds only to service the windows (keys,
+# window close)
+IDLE_GUI_INTERVAL = 0.1
+
+# Red-lane sampling for live cameras: a red lane keeps draining its source
+# and runs detection every RED_SAMPLE_INTERVAL seconds. It reports the queue
+# as current_cars in veiculos and as cv_queue_* gauges, so the controller
+# decides on fresh counts, while full-rate detection stays on the green lane.
+# 0 keeps the recorded-video behaviour: the video pauses on red. It can be
+# set per lane with 'red_sample_interval' in LANES_CONFIG.
+RED_SAMPLE_INTERVAL = 0
+
+# A live lane that turns red before its camera delivered a first frame polls
+# the source every RED_FIRST_FRAME_POLL seconds until one arrives, so the red
+# panel shows the camera instead of staying black for the whole phase
+RED_FIRST_FRAME_POLL = 0.5
+
+# Pacing: video files play at their own frame rate (CAP_PROP_FPS and
+# CAP_PROP_POS_MSEC), as a camera would deliver them. A lane that falls behind
+# skips the frames it has no time for (grabbed, never detected; counted as
+# cv_frames_dropped_total{reason="behind_source"}) and the loop sleeps while
+# every lane is ahead, so capacity measured on recordings predicts a live
+# deployment. Not applied with CLOCK_MODE = 'video', which is meant to run
+# faster than real time, nor to cameras, which pace themselves.
+SOURCE_PACING = True
+
 # Detection parameters
+MODEL_PATH = 'yolov8n.pt'
 VEHICLE_CLASSES = {2, 3, 5, 7}  # car, motorcycle, bus, truck
 FRAME_SKIP = 1
 DATABASE_UPDATE_INTERVAL = 3
@@ -89,26 +197,48 @@ CONF_THRESHOLD = 0.25
 
 # ==================== TRAFFIC LIGHT CONTROLLER ====================
 
+LightState = namedtuple('LightState', ['status', 'duration'])   # 'RED'/'GREEN'/'UNKNOWN', green seconds
+LightTransition = namedtuple('LightTransition', ['letter', 'previous', 'current', 'version'])
+UNKNOWN_LIGHT = LightState('UNKNOWN', 0)
+RED_LIGHT = LightState('RED', 0)
+
+
+class TrafficSnapshot(namedtuple('TrafficSnapshot', ['version', 'states'])):
+    """Traffic light state at one version. Never modified: the controller
+    publishes a new snapshot on every change, so a reader keeps a consistent
+    view of all lanes without taking any lock"""
+    __slots__ = ()
+    
+    def get(self, traffic_letter):
+        return self.states.get(traffic_letter, UNKNOWN_LIGHT)
+
+
 class TrafficLightController:
     def __init__(self):
-        self.traffic_states = {}  # {letter: {'status': 'RED'/'GREEN', 'duration': time}}
-        self.lock = Lock()
+        self.snapshot = TrafficSnapshot(0, MappingProxyType({}))  # replaced, never mutated
+        self.lock = Lock()  # serializes writers; readers just read self.snapshot
+        self.state_changed = Condition(self.lock)
+        self.subscribers = []  # (handle, deliver, letters or None); replaced, never mutated
         self.mqtt_client = None
         self.connected = False
+        self.ready = Event()  # set while connected and subscribed
         
     def initialize_mqtt(self):
+        """Starts connecting in paho's network thread and returns at once; the
+        lanes stay red until the first traffic message, so nothing waits here.
+        Use wait_ready() to block on the connection"""
         try:
+            import paho.mqtt.client as mqtt
             self.mqtt_client = mqtt.Client(client_id=MQTT_CONFIG['client_id'])
             self.mqtt_client.on_connect = self.on_connect
             self.mqtt_client.on_message = self.on_message
             self.mqtt_client.on_disconnect = self.on_disconnect
             
             print(f"Connecting to MQTT broker at {MQTT_CONFIG['broker']}:{MQTT_CONFIG['port']}...")
-            self.mqtt_client.connect(MQTT_CONFIG['broker'], MQTT_CONFIG['port'], 60)
+            # connect_async + loop_start: the network thread connects, and
+            # keeps retrying if the broker is not up yet
+            self.mqtt_client.connect_async(MQTT_CONFIG['broker'], MQTT_CONFIG['port'], 60)
             self.mqtt_client.loop_start()
-            
-            # Wait a bit for connection
-            time.sleep(2)
             return True
         except Exception as e:
             print(f"❌ MQTT connection failed: {e}")
@@ -121,12 +251,20 @@ class TrafficLightController:
             client.subscribe(MQTT_CONFIG['topic'])
             print(f"📡 Subscribed to topic: {MQTT_CONFIG['topic']}")
             self.connected = True
+            self.ready.set()
+            metrics.set('cv_mqtt_connected', 1)
         else:
             print(f"❌ Failed to connect to MQTT, return code {rc}")
     
     def on_disconnect(self, client, userdata, rc):
         print(f"⚠️  Disconnected from MQTT broker (code: {rc})")
         self.connected = False
+        self.ready.clear()
+        metrics.set('cv_mqtt_connected', 0)
+    
+    def wait_ready(self, timeout=None):
+        """True once connected to the broker, False if timeout ran out first"""
+        return self.ready.wait(timeout)
     
     def on_message(self, client, userdata, msg):
         try:
@@ -143,51 +281,97 @@ class TrafficLightController:
         - '{"A": 10.00}' = Lane A green for 10 seconds
         - 'B' or '"B"' = Lane B red
         """
+        message = message.strip()
+        updates = {}
+        
+        # Check if it's a JSON object (green light with duration)
+        if message.startswith('{'):
+            try:
+                data = json.loads(message)
+                for letter, duration in data.items():
+                    updates[letter.strip().upper()] = LightState('GREEN', float(duration))
+            except json.JSONDecodeError as e:
+                print(f"❌ Failed to parse JSON: {e}")
+        # It's a simple lane name (red light)
+        else:
+            # Remove quotes if present
+            updates[message.strip('"\'').strip().upper()] = RED_LIGHT
+        return self.publish(updates)
+    
+    def publish(self, updates):
+        """Applies {letter: LightState} as a new snapshot and notifies the
+        subscribers of every lane that changed. Returns the current snapshot"""
         with self.lock:
-            if not self.traffic_states:
+            previous = self.snapshot
+            states = dict(previous.states)
+            if not states:
                 # Set all lanes to RED initially
                 for config in LANES_CONFIG:
-                    letter = config['traffic_letter']
-                    self.traffic_states[letter] = {'status': 'RED', 'duration': 0}
-            
-            message = message.strip()
-            
-            # Check if it's a JSON object (green light with duration)
-            if message.startswith('{'):
-                try:
-                    data = json.loads(message)
-                    for letter, duration in data.items():
-                        letter = letter.strip().upper()
-                        self.traffic_states[letter] = {'status': 'GREEN', 'duration': float(duration)}
-                        print(f"🟢 Lane {letter}: GREEN for {duration}s")
-                except json.JSONDecodeError as e:
-                    print(f"❌ Failed to parse JSON: {e}")
-            # It's a simple letter (red light)
-            else:
-                # Remove quotes if present
-                letter = message.strip('"\'').strip().upper()
-                if letter.isalpha() and len(letter) == 1:
-                    self.traffic_states[letter] = {'status': 'RED', 'duration': 0}
-                    print(f"🔴 Lane {letter}: RED")
-            
-            # Show current state of all lanes
-            status_summary = ", ".join([f"{k}:{v['status'][0]}" for k, v in sorted(self.traffic_states.items())])
-            print(f"📊 Current state: [{status_summary}]\n")
+                    states[config['traffic_letter']] = RED_LIGHT
+            for letter, state in updates.items():
+                # Red for a lane nobody configured is ignored, green is kept
+                if state.status == 'GREEN' or letter in states:
+                    states[letter] = state
+            version = previous.version + 1
+            transitions = [LightTransition(letter, previous.get(letter), state, version)
+                           for letter, state in states.items() if previous.get(letter) != state]
+            if not transitions:
+                return previous
+            snapshot = self.snapshot = TrafficSnapshot(version, MappingProxyType(states))
+            self.state_changed.notify_all()
+            subscribers = self.subscribers
+        
+        # Printing and callbacks happen outside the lock: readers never wait for them
+        for transition in transitions:
+            if transition.current.status == 'GREEN':
+                print(f"🟢 Lane {transition.letter}: GREEN for {transition.current.duration:g}s")
+            elif transition.previous.status != 'UNKNOWN':
+                print(f"🔴 Lane {transition.letter}: RED")
+        status_summary = ", ".join(f"{k}:{v.status[0]}" for k, v in snapshot.states.items())
+        print(f"📊 Current state: [{status_summary}] (v{version})\n")
+        for _, deliver, letters in subscribers:
+            for transition in transitions:
+                if letters is None or transition.letter in letters:
+                    try:
+                        deliver(transition)
+                    except Exception as e:
+                        print(f"❌ Traffic light subscriber failed: {e}")
+        return snapshot
+    
+    def subscribe(self, callback=None, letters=None):
+        """Delivers a LightTransition for every lane change (only the lanes in
+        letters, when given). With a callback it is called from the MQTT
+        thread and must return quickly; without one, transitions are put on
+        a new queue.Queue. Returns the callback or queue, for unsubscribe()"""
+        handle = callback if callback is not None else queue.Queue()
+        deliver = callback if callback is not None else handle.put
+        with self.lock:
+            self.subscribers = self.subscribers + [(handle, deliver, frozenset(letters) if letters else None)]
+        return handle
+    
+    def unsubscribe(self, handle):
+        with self.lock:
+            # == rather than is: each obj.method access makes a new bound method
+            self.subscribers = [s for s in self.subscribers if s[0] != handle]
+    
+    @property
+    def version(self):
+        return self.snapshot.version
     
     def is_green(self, traffic_letter):
-        """Check if a lane's traffic light is green"""
+        """Check if a lane's traffic light is green (no data yet = stopped)"""
+        return self.snapshot.get(traffic_letter).status == 'GREEN'
+    
+    def wait_for_change(self, version, timeout=None):
+        """Blocks until the traffic state is newer than version, or timeout;
+        returns the current version"""
         with self.lock:
-            if not self.traffic_states:
-                # If no MQTT data yet, keep lanes stopped (waiting for traffic control)
-                return False
-            
-            state = self.traffic_states.get(traffic_letter, {'status': 'RED'})
-            return state.get('status') == 'GREEN'
+            self.state_changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
     
     def get_status(self, traffic_letter):
         """Get current status and duration for a lane"""
-        with self.lock:
-            return self.traffic_states.get(traffic_letter, {'status': 'UNKNOWN', 'duration': 0})
+        return self.snapshot.get(traffic_letter)._asdict()
     
     def cleanup(self):
         if self.mqtt_client:
@@ -202,6 +386,9 @@ traffic_controller = TrafficLightController()
 
 database_enabled = False
 db_lock = Lock()
+tracer = Tracer(os.path.join(TRACE_DIR, TRACE_FILE) if TRACING_ENABLED else None)
+profiler = SamplingProfiler(PROFILE_DIR, 'cv', PROFILE_INTERVAL, PROFILE_MAX_SECONDS)
+resource_plan = plan_live(len(LANES_CONFIG), CPU_CORES, CPU_IO_CORES)
 
 def initialize_database():
     global database_enabled
@@ -213,6 +400,7 @@ def initialize_database():
 
 def initialize_postgresql():
     try:
+        import psycopg2
         conn = psycopg2.connect(**DB_CONFIG)
         conn.close()
         print("✅ Connected to PostgreSQL successfully")
@@ -227,6 +415,8 @@ def initialize_firebase():
         if not os.path.exists(firebase_key_path):
             print("❌ Firebase key not found. Logging disabled.")
             return False
+        import firebase_admin
+        from firebase_admin import credentials
         cred = credentials.Certificate(firebase_key_path)
         firebase_admin.initialize_app(cred, {
             'databaseURL': FIREBASE_CONFIG['database_url']
@@ -237,25 +427,27 @@ def initialize_firebase():
         print(f"❌ Firebase initialization failed: {e}")
         return False
 
-def send_to_database(lane_id, total, current_cars, avg):
+def send_to_database(lane_id, total, current_cars, avg, frame_ts=None, trace_id=None, recorded_at=None):
+    """recorded_at (epoch s) overrides the row time when not running on the wall clock"""
     if not database_enabled:
         return
     with db_lock:
         if USE_FIREBASE:
-            send_to_firebase(lane_id, total, current_cars, avg)
+            send_to_firebase(lane_id, total, current_cars, avg, frame_ts, trace_id, recorded_at)
         else:
-            send_to_postgresql(lane_id, total, current_cars, avg)
+            send_to_postgresql(lane_id, total, current_cars, avg, frame_ts, trace_id, recorded_at)
 
-def send_to_postgresql(lane_id, total, current_cars, avg):
+def send_to_postgresql(lane_id, total, current_cars, avg, frame_ts=None, trace_id=None, recorded_at=None):
     try:
+        import psycopg2
         conn = psycopg2.connect(**DB_CONFIG)
         cursor = conn.cursor()
         insert_query = """
-        INSERT INTO veiculos (lane_id, current_cars, rolling_average, total_count, timestamp) 
-        VALUES (%s, %s, %s, %s, NOW())
+        INSERT INTO veiculos (lane_id, current_cars, rolling_average, total_count, timestamp, frame_ts, trace_id) 
+        VALUES (%s, %s, %s, %s, COALESCE(to_timestamp(%s), NOW()), %s, %s)
         RETURNING id, timestamp"""
         avg = min(max(avg, 0.0), 999.99)
-        cursor.execute(insert_query, (lane_id, current_cars, avg, total))
+        cursor.execute(insert_query, (lane_id, current_cars, avg, total, recorded_at, frame_ts, trace_id))
         result = cursor.fetchone()
         conn.commit()
         cursor.close()
@@ -269,6 +461,7 @@ def send_to_postgresql(lane_id, total, current_cars, avg):
 
 def ensure_database_schema():
     try:
+        import psycopg2
         conn = psycopg2.connect(**DB_CONFIG)
         cursor = conn.cursor()
         
@@ -279,6 +472,8 @@ def ensure_database_schema():
             'rolling_average': 'numeric(5,2) NOT NULL',
             'total_count': 'integer NOT NULL',
             'lane_id': 'character varying(20)',
+            'frame_ts': 'double precision',  # frame capture time (epoch s), for tracing
+            'trace_id': 'character varying(32)',
         }
         
         cursor.execute("""
@@ -303,77 +498,246 @@ def ensure_database_schema():
         print(f"❌ Error ensuring schema: {e}")
         return False
 
-def send_to_firebase(lane_id, total_crossed, current_cars, avg_cars):
+def send_to_firebase(lane_id, total_crossed, current_cars, avg_cars, frame_ts=None, trace_id=None, recorded_at=None):
     try:
+        from firebase_admin import db
         if not hasattr(send_to_firebase, 'session_ids'):
             send_to_firebase.session_ids = {}
         if lane_id not in send_to_firebase.session_ids:
             send_to_firebase.session_ids[lane_id] = f"session_{int(time.time())}"
         
+        now = recorded_at if recorded_at is not None else time.time()
         ref = db.reference(f'/car_detection/{lane_id}/{send_to_firebase.session_ids[lane_id]}')
         data = {
-            'timestamp': int(time.time()),
-            'datetime': datetime.now().isoformat(),
+            'timestamp': int(now),
+            'datetime': datetime.fromtimestamp(now).isoformat(),
             'lane_id': lane_id,
             'total_count': total_crossed,
             'current_cars': current_cars,
-            'rolling_average': round(avg_cars, 2)
+            'rolling_average': round(avg_cars, 2),
+            'frame_ts': frame_ts,
+            'trace_id': trace_id
         }
-        ref.child(str(int(time.time()))).set(data)
+        ref.child(str(int(now))).set(data)
     except Exception as e:
         print(f"❌ [Firebase] [{lane_id}] Error: {e}")
 
+
+class TelemetryWriter:
+    """Writes telemetry rows from a bounded queue in a background thread"""
+
+    def __init__(self, maxsize=DB_QUEUE_SIZE):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self._run, name='telemetry-writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, lane_id, total, current_cars, avg, frame_ts=None, trace_id=None, recorded_at=None):
+        row = (lane_id, total, current_cars, avg, frame_ts, trace_id, recorded_at, time.perf_counter())
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            try:
+                dropped = self.queue.get_nowait()
+                metrics.inc('cv_telemetry_dropped_total', lane=dropped[0])
+            except queue.Empty:
+                pass
+            self.queue.put_nowait(row)
+        metrics.set('cv_db_queue_depth', self.queue.qsize())
+
+    def _run(self):
+        while True:
+            row = self.queue.get()
+            if row is None:
+                break
+            lane_id, total, current_cars, avg, frame_ts, trace_id, recorded_at, queued_at = row
+            metrics.set('cv_db_queue_depth', self.queue.qsize())
+            metrics.observe('cv_stage_seconds', time.perf_counter() - queued_at, lane=lane_id, stage='db_queue_wait')
+
+            write_start = time.time()
+            start = time.perf_counter()
+            send_to_database(lane_id, total, current_cars, avg, frame_ts, trace_id, recorded_at)
+            metrics.observe('cv_stage_seconds', time.perf_counter() - start, lane=lane_id, stage='db_write')
+            write_end = time.time()
+            if trace_id:
+                tracer.span(trace_id, 'db_write', write_start, write_end, lane_id=lane_id)
+                if recorded_at is None:  # frame_ts is wall time only on the wall clock
+                    tracer.span(trace_id, 'frame_to_write', frame_ts, write_end, lane_id=lane_id)
+
+    def stop(self):
+        """Writes what is still queued, then stops the thread"""
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join(timeout=10)
+            self.thread = None
+
+
+telemetry_writer = TelemetryWriter()
+
+
+def describe_metrics():
+    metrics.describe('cv_stage_seconds', 'histogram', 'Time spent per lane in each processing stage')
+    metrics.describe('cv_frames_read_total', 'counter', 'Frames read from the video source')
+    metrics.describe('cv_frames_processed_total', 'counter', 'Frames that went through detection')
+    metrics.describe('cv_frames_dropped_total', 'counter', 'Frames not processed, by reason')
+    metrics.describe('cv_telemetry_dropped_total', 'counter', 'Telemetry rows dropped because the write queue was full')
+    metrics.describe('cv_db_queue_depth', 'gauge', 'Telemetry rows waiting to be written')
+    metrics.describe('cv_lane_green', 'gauge', '1 while the lane signal is green')
+    metrics.describe('cv_light_transitions_total', 'counter', 'Red/green changes of the lane signal, by new state')
+    metrics.describe('cv_source_up', 'gauge', '1 while the lane\'s live source is streaming')
+    metrics.describe('cv_source_reconnects_total', 'counter', 'Live source reconnections, by reason (lost, stalled)')
+    metrics.describe('cv_source_frames_overwritten_total', 'counter', 'Live frames replaced by a newer one before the lane read them')
+    metrics.describe('cv_red_samples_total', 'counter', 'Frames detected on a red lane (red-lane sampling)')
+    metrics.describe('cv_queue_cars', 'gauge', 'Vehicles queued at the red lane, from the last sample')
+    metrics.describe('cv_queue_occupancy', 'gauge', 'Share of the masked lane area covered by queued vehicles')
+    metrics.describe('cv_detection_cache_total', 'counter', 'Detection cache lookups in replay mode, by result')
+    metrics.describe('cv_tracked_objects', 'gauge', 'Objects currently tracked in the lane')
+    metrics.describe('cv_mqtt_connected', 'gauge', '1 while connected to the MQTT broker')
+    metrics.describe('cv_startup_seconds', 'gauge', 'Seconds spent in each start-up step')
+    metrics.describe('cv_cpu_cores_busy', 'gauge', 'CPU time used by the process per second of wall time')
+    metrics.describe('cv_cpu_utilization', 'gauge', 'cv_cpu_cores_busy over the cores planned for the process')
+    metrics.describe('cv_cpu_core_busy', 'gauge', 'Busy share of each planned core, all processes included')
+
 # ==================== LANE DETECTOR CLASS ====================
 
+def detector_model_path(backend=DETECTOR_BACKEND):
+    return MODEL_PATH if backend == 'torch' else ONNX_MODEL_PATH
+
+
+class DetectorLoader:
+    """Loads and warms up the detector in a background thread, so importing
+    the backend, reading the weights and the first inferences overlap the
+    lanes opening their videos and masks"""
+
+    def __init__(self, backend=DETECTOR_BACKEND, model_path=None, warmup_runs=DETECTOR_WARMUP_RUNS, threads=None):
+        self.backend = backend
+        self.model_path = model_path or detector_model_path(backend)
+        self.warmup_runs = warmup_runs
+        self.threads = threads
+        self.detector = None
+        self.error = None
+        self.thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        print(f"\nLoading {self.backend} detector ({self.model_path}) in the background...")
+        self.thread.start()
+        return self
+
+    def _run(self):
+        try:
+            t = time.perf_counter()
+            self.detector = make_detector(self.backend, self.model_path, threads=self.threads)
+            elapsed = time.perf_counter() - t
+            metrics.set('cv_startup_seconds', elapsed, step='detector_load')
+            print(f"✅ Detector loaded in {elapsed:.1f}s")
+            if self.warmup_runs:
+                elapsed = self.detector.warmup((STANDARD_HEIGHT, STANDARD_WIDTH, 3), runs=self.warmup_runs)
+                metrics.set('cv_startup_seconds', elapsed, step='detector_warmup')
+                print(f"🔥 Detector warmed up in {elapsed:.1f}s ({self.warmup_runs} dummy frames)")
+        except Exception as e:
+            self.error = e
+
+    def result(self):
+        """Waits for the thread; the detector, or the exception that stopped it"""
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.detector
+
+def default_window_position(index):
+    """Grid position for the index-th lane window"""
+    row, col = divmod(index, WINDOW_GRID_COLUMNS)
+    return (col * WINDOW_GRID_STEP[0], row * WINDOW_GRID_STEP[1])
+
+
 class LaneDetector:
-    def __init__(self, config, model, traffic_controller):
+    def __init__(self, config, detector, traffic_controller, clock=None):
         self.lane_id = config['lane_id']
         self.traffic_letter = config['traffic_letter']
         self.video_path = config['video_path']
         self.mask_path = config['mask_path']
         self.limits = config['limits']
-        self.window_position = config['window_position']
+        self.window_position = config.get('window_position') or default_window_position(
+            LANES_CONFIG.index(config) if config in LANES_CONFIG else 0
+        )
         self.window_name = f'Lane {self.traffic_letter}: {self.lane_id}'
         
-        self.model = model
+        self.detector = detector
         self.traffic_controller = traffic_controller
+        # Cameras (RTSP, HTTP MJPEG, V4L2) instead of files: see sources.py
+        self.live = is_live_source(self.video_path)
+        self.clock = clock or make_clock('wall' if self.live else CLOCK_MODE, config.get('recording_start'))
         self.cap = None
         self.mask = None
         self.running = False
         self.paused = False
         
         # Tracking variables
-        self.tracked_objects = {}
-        self.next_id = 0
-        self.total_count = []
+        self.tracker = CentroidTracker(self.limits, MAX_DISTANCE)
         self.detection_history = deque()
+        self.detection_cache = None
+        self.detection_recorder = None
         
         # Performance tracking
         self.frame_count = 0
         self.processed_frames = 0
-        self.start_time = time.time()
+        self.behind_frames = 0  # skipped by the pacer, green only
+        self.start_time = None
         self.last_database_update = 0
         
-        # Store last frame for display when paused
+        # Store last frame for display when paused; frames live in self.buffers
         self.last_frame = None
+        self.buffers = FrameBuffers(STANDARD_WIDTH, STANDARD_HEIGHT)
+        self.red_rendered = None  # what the window shows while red, see process_frame
+        self.red_sample_interval = config.get('red_sample_interval', RED_SAMPLE_INTERVAL)
+        self.last_red_sample = None
+        self.first_frame_poll_at = 0.0
+        self.lane_area = STANDARD_WIDTH * STANDARD_HEIGHT  # unmasked pixels, for queue occupancy
+        self.pacer = None
+        self.red_grab_interval = 0.0
+        self.next_work_at = 0.0  # time.monotonic() when the lane next has a frame to process
         
     def initialize(self):
-        if not os.path.exists(self.video_path):
+        if self.live:
+            # Connects (and reconnects) in its own thread; the lane shows no frames until then
+            self.cap = LiveSource(self.video_path, name=self.lane_id,
+                                  threads=resource_plan.decoder_threads(len(LANES_CONFIG))).start()
+            print(f"📡 [{self.lane_id}] Live source {describe_source(self.video_path)}")
+        elif not os.path.exists(self.video_path):
             print(f"❌ [{self.lane_id}] Video '{self.video_path}' not found!")
             return False
         
-        self.cap = cv2.VideoCapture(self.video_path)
+        if FRAME_CACHE_ENABLED and not self.live:
+            self.cap = open_cached_video(self.video_path, FRAME_CACHE_DIR, STANDARD_WIDTH, STANDARD_HEIGHT,
+                                         FRAME_CACHE_MAX_MB)
+        if self.cap is None:
+            self.cap = open_capture(self.video_path, resource_plan.decoder_threads(len(LANES_CONFIG)))
         if not self.cap.isOpened():
             print(f"❌ [{self.lane_id}] Could not open video")
             return False
+        if hasattr(self.clock, 'attach'):
+            self.clock.attach(self.cap)
+        self.start_time = self.clock.now()
         
         if os.path.exists(self.mask_path):
             self.mask = cv2.imread(self.mask_path)
             self.mask = cv2.resize(self.mask, (STANDARD_WIDTH, STANDARD_HEIGHT))
+            self.lane_area = max(1, cv2.countNonZero(cv2.cvtColor(self.mask, cv2.COLOR_BGR2GRAY)))
             print(f"✅ [{self.lane_id}] Mask loaded and resized to {STANDARD_WIDTH}x{STANDARD_HEIGHT}")
         else:
             print(f"⚠️  [{self.lane_id}] No mask found - continuing without mask")
         
+        if DETECTION_CACHE != 'off' and self.live:
+            print(f"⚠️  [{self.lane_id}] Detection cache disabled: live frames never repeat")
+        elif DETECTION_CACHE != 'off':
+            self.detection_cache = DetectionCache.for_video(DETECTION_CACHE_DIR, self.video_path, self.mask_path,
+                                                            detector_model_path(), STANDARD_WIDTH, STANDARD_HEIGHT)
+            self.detection_recorder = self.detection_cache.recorder()
+            print(f"📼 [{self.lane_id}] Detection cache '{DETECTION_CACHE}': {self.detection_cache.path} "
+                  f"({len(self.detection_cache.chunks)} chunks)")
+        
         cv2.namedWindow(self.window_name, cv2.WINDOW_NORMAL)
         cv2.resizeWindow(self.window_name, STANDARD_WIDTH, STANDARD_HEIGHT)
         cv2.moveWindow(self.window_name, *self.window_position)
@@ -381,207 +745,350 @@ class LaneDetector:
         fps = self.cap.get(cv2.CAP_PROP_FPS)
         total_frames = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
         print(f"✅ [{self.lane_id}] (Lane {self.traffic_letter}) Initialized: {fps:.1f} FPS, {total_frames} frames")
+        # Red sampling without a pacer drains a wall-clock file one grab per
+        # frame period; on the video clock grabbing is what advances time
+        self.red_grab_interval = 1 / fps if fps > 0 and self.clock.wall else 0.0
+        if SOURCE_PACING and not self.live and self.clock.wall:
+            self.pacer = SourcePacer(fps)
+            print(f"⏯️  [{self.lane_id}] Paced at {self.pacer.fps:.1f} FPS")
+        
+        # Red/green edges arrive from the controller; each frame reads its snapshot
+        self.traffic_controller.subscribe(self.on_light_change, letters=[self.traffic_letter])
+        metrics.set('cv_lane_green', int(self.traffic_controller.is_green(self.traffic_letter)), lane=self.lane_id)
         
         self.running = True
         return True
     
-    def euclidean_distance(self, a, b):
-        return np.sqrt((a[0] - b[0])**2 + (a[1] - b[1])**2)
+    def on_light_change(self, transition):
+        """Controller callback (MQTT thread) for this lane's red/green edges"""
+        metrics.set('cv_lane_green', int(transition.current.status == 'GREEN'), lane=self.lane_id)
+        if transition.current.status != transition.previous.status:
+            metrics.inc('cv_light_transitions_total', lane=self.lane_id, to=transition.current.status.lower())
     
     def update_rolling_average(self, current_count):
-        current_time = time.time()
+        current_time = self.clock.now()
         self.detection_history.append((current_time, current_count))
         cutoff_time = current_time - WINDOW_SIZE
         while self.detection_history and self.detection_history[0][0] < cutoff_time:
             self.detection_history.popleft()
         return sum(count for _, count in self.detection_history) / len(self.detection_history) if self.detection_history else 0.0
     
+    def stage_done(self, stage, start):
+        """Records the time since start for this lane's stage and returns now"""
+        now = time.perf_counter()
+        metrics.observe('cv_stage_seconds', now - start, lane=self.lane_id, stage=stage)
+        return now
+    
+    def detect(self, img, frame_index, t):
+        """Detection rows for img; returns (rows, (detect_start, detect_end) or
+        None when they came from the cache, t)"""
+        # Cached detections replace the mask and inference stages
+        if DETECTION_CACHE == 'replay':
+            rows = self.detection_cache.get(frame_index)
+            metrics.inc('cv_detection_cache_total', lane=self.lane_id, result='miss' if rows is None else 'hit')
+            if rows is not None:
+                return rows, None, self.stage_done('cache_read', t)
+        
+        # Apply mask if available
+        imgRegion = self.buffers.masked(img, self.mask)
+        t = self.stage_done('mask', t)
+        
+        # Run detection
+        detect_start = time.time()
+        rows = self.detector.detect([imgRegion])[0]
+        detect_end = time.time()
+        t = self.stage_done('inference', t)
+        tracer.observe('detection', (detect_end - detect_start) * 1000)
+        if self.detection_recorder is not None:
+            self.detection_recorder.add(frame_index, rows)
+        return rows, (detect_start, detect_end), t
+    
+    def render_red(self, frame, status_msg, queue_cars=None):
+        """frame under the red overlay with the lane's status, in the overlay buffer"""
+        # RED overlay, drawn into the lane's overlay buffer (frame stays clean)
+        if frame is not None:
+            display_frame = self.buffers.red_overlay(frame)
+        else:
+            # Blank frame if video can't be read
+            display_frame = self.buffers.red_overlay(np.zeros((STANDARD_HEIGHT, STANDARD_WIDTH, 3), dtype=np.uint8))
+        
+        # Add status text
+        text_size = cv2.getTextSize(status_msg, cv2.FONT_HERSHEY_SIMPLEX, 1.0, 3)[0]
+        text_x = (display_frame.shape[1] - text_size[0]) // 2
+        text_y = display_frame.shape[0] // 2
+        cv2.putText(display_frame, status_msg, (text_x, text_y), 
+                   cv2.FONT_HERSHEY_SIMPLEX, 1.0, (255, 255, 255), 3)
+        cv2.putText(display_frame, f'Lane {self.traffic_letter}', (50, 30), 
+                   cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 2)
+        
+        # Show stats even when paused
+        cv2.putText(display_frame, f'Total: {len(self.tracker.counted)}', (50, 60), 
+                   cv2.FONT_HERSHEY_SIMPLEX, 0.7, (200, 200, 200), 2)
+        if queue_cars is not None:
+            cv2.putText(display_frame, f'Queue: {queue_cars}', (50, 85), 
+                       cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 255), 2)
+        return display_frame
+    
+    def submit_telemetry(self, current_cars, avg_cars, frame_ts, detection_span, t):
+        """Database update every DATABASE_UPDATE_INTERVAL; the write itself runs in telemetry_writer"""
+        current_time = self.clock.now()
+        if current_time - self.last_database_update >= DATABASE_UPDATE_INTERVAL:
+            trace_id = tracer.new_trace_id() if TRACING_ENABLED else None
+            if database_enabled:
+                telemetry_writer.submit(self.lane_id, len(self.tracker.counted), current_cars, avg_cars,
+                                        frame_ts, trace_id, None if self.clock.wall else frame_ts)
+            if trace_id and detection_span is not None:
+                tracer.span(trace_id, 'detection', *detection_span, histogram=False, lane_id=self.lane_id)
+            self.last_database_update = current_time
+            t = self.stage_done('db_enqueue', t)
+        return t
+    
+    def poll_first_frame(self):
+        """Red before the camera's first frame: try the source again every
+        RED_FIRST_FRAME_POLL seconds; the frame it brings is rendered once"""
+        now = time.monotonic()
+        if now >= self.first_frame_poll_at:
+            self.first_frame_poll_at = now + RED_FIRST_FRAME_POLL
+            success, frame = self.buffers.read(self.cap)
+            if success:
+                self.last_frame = frame
+                return
+        self.next_work_at = self.first_frame_poll_at
+    
+    def sample_red(self, light):
+        """Red lane on a live camera: drain the source between samples and
+        count the queue every red_sample_interval seconds"""
+        now = self.clock.now()
+        if self.last_red_sample is not None and now - self.last_red_sample < self.red_sample_interval:
+            remaining = self.red_sample_interval - (now - self.last_red_sample)
+            if self.pacer is not None or self.live:
+                # The frames in between are skipped when the next sample is due
+                # (a live source's reader thread drains the camera meanwhile)
+                self.next_work_at = time.monotonic() + remaining
+                return True
+            # Only grab (no colour conversion, resize or model) so the next sample is a fresh frame
+            self.cap.grab()
+            self.next_work_at = time.monotonic() + min(remaining, self.red_grab_interval)
+            return True
+        
+        self.next_work_at = 0.0
+        if self.pacer is not None:
+            self.pacer.catch_up(self.cap)
+        t = time.perf_counter()
+        success, img = self.buffers.read(self.cap)
+        if not success:
+            self.read_failed()
+            return True
+        frame_ts = self.last_red_sample = self.frame_time()
+        frame_index = int(self.cap.get(cv2.CAP_PROP_POS_FRAMES)) - 1
+        t = self.stage_done('read', t)
+        metrics.inc('cv_red_samples_total', lane=self.lane_id)
+        
+        rows, detection_span, t = self.detect(img, frame_index, t)
+        queued = detections_from_array(rows, VEHICLE_CLASSES, CONF_THRESHOLD)
+        # Queue estimate: vehicles in the lane and the share of the lane their boxes cover.
+        # No tracking at this rate; nothing should cross the line on red
+        covered = sum(w * h for _, _, _, _, w, h, _ in queued)
+        metrics.set('cv_queue_cars', len(queued), lane=self.lane_id)
+        metrics.set('cv_queue_occupancy', min(1.0, covered / self.lane_area), lane=self.lane_id)
+        avg_cars = self.update_rolling_average(len(queued))
+        t = self.stage_done('extraction', t)
+        
+        for cx, cy, x1, y1, w, h, conf in queued:
+            cv2.rectangle(img, (x1, y1), (x1 + w, y1 + h), (255, 0, 255), 2)
+        self.last_frame = img
+        display_frame = self.render_red(img, '🔴 RED LIGHT - SAMPLING', len(queued))
+        t = self.stage_done('paused_drawing', t)
+        t = self.submit_telemetry(len(queued), avg_cars, frame_ts, detection_span, t)
+        
+        cv2.imshow(self.window_name, display_frame)
+        self.stage_done('display', t)
+        return True
+    
+    def read_failed(self):
+        if self.live:
+            # No new frame yet: the camera is slower than the loop, or reconnecting
+            metrics.inc('cv_frames_dropped_total', lane=self.lane_id, reason='no_frame')
+            return
+        print(f"[{self.lane_id}] Video ended - restarting...")
+        metrics.inc('cv_frames_dropped_total', lane=self.lane_id, reason='read_failure')
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        self.frame_count = 0
+        if self.pacer is not None:
+            self.pacer.reset(self.cap)
+    
+    def frame_time(self):
+        """frame_ts: capture time for cameras (so traces include the frame's age), else the lane clock"""
+        if self.live and self.cap.frame_time is not None:
+            return self.cap.frame_time
+        return self.clock.now()
+    
     def process_frame(self):
-        # Check traffic light status
-        is_green = self.traffic_controller.is_green(self.traffic_letter)
-        traffic_status = self.traffic_controller.get_status(self.traffic_letter)
+        # Check traffic light status (one lock-free read of the current snapshot)
+        light = self.traffic_controller.snapshot.get(self.traffic_letter)
+        is_green = light.status == 'GREEN'
         
         # If red light, pause video and display last frame with status
         if not is_green:
-            if self.last_frame is not None:
-                display_frame = self.last_frame.copy()
-            else:
+            self.paused = True
+            if self.red_sample_interval:
+                return self.sample_red(light)
+            self.next_work_at = float('inf')
+            if self.live and self.last_frame is None:
+                self.poll_first_frame()
+            # The red screen only depends on the message and the frozen frame:
+            # render and show it once, HighGUI keeps painting it after that
+            red_key = (light.status == 'UNKNOWN', self.last_frame is not None)
+            if red_key == self.red_rendered:
+                return True
+            
+            t = time.perf_counter()
+            if self.last_frame is None and not self.live:
                 # No frame yet - read one frame to initialize
-                success, frame = self.cap.read()
+                success, frame = self.buffers.read(self.cap)
                 if success:
-                    frame = cv2.resize(frame, (STANDARD_WIDTH, STANDARD_HEIGHT))
-                    display_frame = frame.copy()
-                    self.last_frame = frame.copy()
+                    self.last_frame = frame
                     # Move back one frame so we can resume from here
                     current_pos = self.cap.get(cv2.CAP_PROP_POS_FRAMES)
                     self.cap.set(cv2.CAP_PROP_POS_FRAMES, max(0, current_pos - 1))
-                else:
-                    # Create blank frame if video can't be read
-                    display_frame = np.zeros((STANDARD_HEIGHT, STANDARD_WIDTH, 3), dtype=np.uint8)
-            
-            # Add RED overlay
-            overlay = display_frame.copy()
-            cv2.rectangle(overlay, (0, 0), (display_frame.shape[1], display_frame.shape[0]), 
-                         (0, 0, 255), -1)
-            cv2.addWeighted(overlay, 0.2, display_frame, 0.8, 0, display_frame)
             
             # Determine message
-            if traffic_status['status'] == 'UNKNOWN':
+            if light.status == 'UNKNOWN':
                 status_msg = '⏳ WAITING FOR TRAFFIC CONTROL'
             else:
                 status_msg = '🔴 RED LIGHT - STOPPED'
-            
-            # Add status text
-            text_size = cv2.getTextSize(status_msg, cv2.FONT_HERSHEY_SIMPLEX, 1.0, 3)[0]
-            text_x = (display_frame.shape[1] - text_size[0]) // 2
-            text_y = display_frame.shape[0] // 2
-            cv2.putText(display_frame, status_msg, (text_x, text_y), 
-                       cv2.FONT_HERSHEY_SIMPLEX, 1.0, (255, 255, 255), 3)
-            cv2.putText(display_frame, f'Lane {self.traffic_letter}', (50, 30), 
-                       cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 2)
-            
-            # Show stats even when paused
-            cv2.putText(display_frame, f'Total: {len(self.total_count)}', (50, 60), 
-                       cv2.FONT_HERSHEY_SIMPLEX, 0.7, (200, 200, 200), 2)
+            display_frame = self.render_red(self.last_frame, status_msg)
+            t = self.stage_done('paused_drawing', t)
             
             cv2.imshow(self.window_name, display_frame)
-            self.paused = True
+            self.stage_done('display', t)
+            self.red_rendered = (light.status == 'UNKNOWN', self.last_frame is not None)
             return True
         
         # Transitioning from RED to GREEN - mark as no longer paused
         if self.paused:
             print(f"🟢 [{self.lane_id}] Traffic light turned GREEN - resuming video")
             self.paused = False
+            self.red_rendered = None
+            if self.pacer is not None and not self.red_sample_interval:
+                # The video stood still on red: its schedule restarts from here
+                self.pacer.reset(self.cap)
+            self.last_red_sample = None
+        
+        # Paced file: wait for the frame's time, or skip the ones already past it
+        self.next_work_at = 0.0
+        if self.pacer is not None:
+            wait = self.pacer.wait_time(self.cap)
+            if wait > 0:
+                self.next_work_at = time.monotonic() + wait
+                return True
+            behind = self.pacer.catch_up(self.cap)
+            if behind:
+                self.behind_frames += behind
+                metrics.inc('cv_frames_dropped_total', behind, lane=self.lane_id, reason='behind_source')
         
         # GREEN LIGHT - Process video normally
-        success, img = self.cap.read()
+        t = time.perf_counter()
+        success, img = self.buffers.read(self.cap)
         if not success:
-            print(f"[{self.lane_id}] Video ended - restarting...")
-            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
-            self.frame_count = 0
+            self.read_failed()
             return True
         
-        img = cv2.resize(img, (STANDARD_WIDTH, STANDARD_HEIGHT))
+        frame_ts = self.frame_time()
+        frame_index = int(self.cap.get(cv2.CAP_PROP_POS_FRAMES)) - 1
+        # read includes the resize into the frame buffer when the source is not at the standard size
+        t = self.stage_done('read', t)
+        metrics.inc('cv_frames_read_total', lane=self.lane_id)
         
         self.frame_count += 1
         if self.frame_count % FRAME_SKIP != 0:
-            self.last_frame = img.copy()
+            metrics.inc('cv_frames_dropped_total', lane=self.lane_id, reason='frame_skip')
+            self.last_frame = img
             return True
         
         self.processed_frames += 1
+        metrics.inc('cv_frames_processed_total', lane=self.lane_id)
         
-        # Apply mask if available
-        if self.mask is not None:
-            imgRegion = cv2.bitwise_and(img, self.mask)
-        else:
-            imgRegion = img.copy()
-        
-        # Run detection
-        results = self.model(imgRegion, stream=False, verbose=False)
-        current_detections = []
-        
-        if results and len(results) > 0:
-            r = results[0]
-            boxes = r.boxes
-            if boxes is not None:
-                for box in boxes:
-                    x1, y1, x2, y2 = map(int, box.xyxy[0])
-                    conf = float(box.conf[0])
-                    cls = int(box.cls[0])
-                    
-                    if cls in VEHICLE_CLASSES and conf > CONF_THRESHOLD:
-                        w, h = x2 - x1, y2 - y1
-                        cx, cy = x1 + w // 2, y1 + h // 2
-                        current_detections.append((cx, cy, x1, y1, w, h, conf))
+        rows, detection_span, t = self.detect(img, frame_index, t)
+        current_detections = detections_from_array(rows, VEHICLE_CLASSES, CONF_THRESHOLD)
+        t = self.stage_done('extraction', t)
         
         # Update rolling average
         avg_cars = self.update_rolling_average(len(current_detections))
         
         # Object tracking
-        new_tracked_objects = {}
-        used_ids = set()
+        crossed = self.tracker.update(current_detections)
+        metrics.set('cv_tracked_objects', len(self.tracker.tracked_objects), lane=self.lane_id)
+        t = self.stage_done('tracking', t)
         
+        # Draw detections
         for cx, cy, x1, y1, w, h, conf in current_detections:
-            best_id = None
-            min_dist = MAX_DISTANCE
-            
-            for obj_id, (prev_cx, prev_cy) in self.tracked_objects.items():
-                if obj_id not in used_ids:
-                    dist = self.euclidean_distance((cx, cy), (prev_cx, prev_cy))
-                    if dist < min_dist:
-                        best_id = obj_id
-                        min_dist = dist
-            
-            if best_id is None:
-                best_id = self.next_id
-                self.next_id += 1
-            
-            new_tracked_objects[best_id] = (cx, cy)
-            used_ids.add(best_id)
-            
-            # Draw detection
-            x2, y2 = x1 + w, y1 + h
-            cv2.rectangle(img, (x1, y1), (x2, y2), (255, 0, 255), 2)
+            cv2.rectangle(img, (x1, y1), (x1 + w, y1 + h), (255, 0, 255), 2)
             cv2.putText(img, f'{conf:.2f}', (x1, max(35, y1)), 
                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
-            
-            # Line crossing detection
-            if self.limits[0] < cx < self.limits[2] and self.limits[1] - 15 < cy < self.limits[1] + 15:
-                if best_id not in self.total_count:
-                    self.total_count.append(best_id)
-                    cv2.line(img, (self.limits[0], self.limits[1]), 
-                            (self.limits[2], self.limits[3]), (0, 255, 0), 5)
-        
-        self.tracked_objects = new_tracked_objects
+        if crossed:
+            cv2.line(img, (self.limits[0], self.limits[1]), 
+                    (self.limits[2], self.limits[3]), (0, 255, 0), 5)
         
         # Draw counting line
         cv2.line(img, (self.limits[0], self.limits[1]), 
                 (self.limits[2], self.limits[3]), (0, 0, 255), 3)
         
         # Display information with traffic light status
-        status_color = (0, 255, 0) if traffic_status['status'] == 'GREEN' else (0, 0, 255)
-        status_text = f"🟢 GREEN" if traffic_status['status'] == 'GREEN' else "🔴 RED"
+        status_color = (0, 255, 0) if light.status == 'GREEN' else (0, 0, 255)
+        status_text = f"🟢 GREEN" if light.status == 'GREEN' else "🔴 RED"
         
         cv2.putText(img, f'Lane {self.traffic_letter} - {status_text}', (50, 30), 
                    cv2.FONT_HERSHEY_SIMPLEX, 0.8, status_color, 2)
-        cv2.putText(img, f'Total: {len(self.total_count)}', (50, 60), 
+        cv2.putText(img, f'Total: {len(self.tracker.counted)}', (50, 60), 
                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 255), 2)
         cv2.putText(img, f'Current: {len(current_detections)}', (50, 85), 
                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
         cv2.putText(img, f'Avg: {avg_cars:.1f}', (50, 110), 
                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 0), 2)
         
-        if self.processed_frames > 0:
-            elapsed = time.time() - self.start_time
+        elapsed = self.clock.now() - self.start_time
+        if self.processed_frames > 0 and elapsed > 0:
             fps = self.processed_frames / elapsed
             cv2.putText(img, f'FPS: {fps:.1f}', (50, 135), 
                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
         
         # Add green duration if available
-        if traffic_status['status'] == 'GREEN' and traffic_status['duration'] > 0:
-            cv2.putText(img, f"Duration: {traffic_status['duration']:.1f}s", (50, 160), 
+        if light.status == 'GREEN' and light.duration > 0:
+            cv2.putText(img, f"Duration: {light.duration:.1f}s", (50, 160), 
                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
+        t = self.stage_done('drawing', t)
         
-        # Database update (only when green)
-        current_time = time.time()
-        if current_time - self.last_database_update >= DATABASE_UPDATE_INTERVAL:
-            send_to_database(self.lane_id, len(self.total_count), len(current_detections), avg_cars)
-            self.last_database_update = current_time
+        # Database update (green, or red lanes being sampled)
+        t = self.submit_telemetry(len(current_detections), avg_cars, frame_ts, detection_span, t)
         
-        # Store frame and display
-        self.last_frame = img.copy()
+        # Store frame (the next read goes to the other buffer) and display
+        self.last_frame = img
         cv2.imshow(self.window_name, img)
+        self.stage_done('display', t)
         
         return True
     
     def cleanup(self):
+        self.traffic_controller.unsubscribe(self.on_light_change)
         if self.cap:
             self.cap.release()
+        if self.detection_recorder is not None:
+            self.detection_recorder.close()
         cv2.destroyWindow(self.window_name)
-        print(f"[{self.lane_id}] Cleanup complete. Total cars: {len(self.total_count)}, Frames: {self.processed_frames}")
+        print(f"[{self.lane_id}] Cleanup complete. Total cars: {len(self.tracker.counted)}, Frames: {self.processed_frames}"
+              + (f", skipped behind source: {self.behind_frames}" if self.pacer is not None else ""))
 
 # ==================== MAIN PROGRAM ====================
 
+def report_utilization(meter):
+    sample = meter.sample()
+    metrics.set('cv_cpu_cores_busy', sample['cores_busy'])
+    metrics.set('cv_cpu_utilization', sample['utilization'])
+    for core, busy in sample['per_core'].items():
+        metrics.set('cv_cpu_core_busy', busy, core=core)
+    print(f"🧮 CPU: {format_utilization(sample, meter.cores)}")
+
 def main():
     print("=" * 60)
     print("MULTI-LANE CAR DETECTION WITH TRAFFIC LIGHT CONTROL")
@@ -590,43 +1097,89 @@ def main():
     print(f"Lanes: {len(LANES_CONFIG)}")
     print(f"MQTT Topic: {MQTT_CONFIG['topic']}")
     print(f"Standard Resolution: {STANDARD_WIDTH}x{STANDARD_HEIGHT}")
+    print(f"CPU plan: {resource_plan.describe()}")
     print("=" * 60)
+    startup = time.perf_counter()
+    
+    # Thread pools sized to the plan; BLAS and OpenCV's own pool get one thread
+    # (the opencv backend sizes OpenCV's pool to the inference cores itself)
+    limit_blas(1)
+    cv2.setNumThreads(1)
+    pin = resource_plan.pin if CPU_PINNING else (lambda role: False)
     
-    # Initialize MQTT traffic controller
+    # Initialize MQTT traffic controller (connects in the background)
+    pin('io')
     print("\n🚦 Initializing traffic light controller...")
     traffic_controller.initialize_mqtt()
     
+    # Load the detector once, while the rest starts up
+    pin('inference')
+    loader = DetectorLoader(threads=resource_plan.threads('inference')).start()
+    pin('io')
+    
     # Initialize database
     initialize_database()
     
     if database_enabled:
         ensure_database_schema()
+        telemetry_writer.start()
     
-    # Load YOLO model once
-    print("\nLoading YOLO model...")
-    model = YOLO("yolov8n.pt")
-    print("✅ YOLO model loaded\n")
+    describe_metrics()
+    if METRICS_ENABLED:
+        try:
+            metrics.serve(METRICS_PORT, routes={'/profile': profiler.handle_request})
+            print(f"📈 Metrics at http://localhost:{METRICS_PORT}/metrics")
+        except OSError as e:
+            print(f"⚠️  Metrics endpoint disabled: {e}")
+    if profiler.install_signal():
+        print(f"🔬 Profiler: kill -USR1 {os.getpid()} to start/stop a capture")
     
-    # Initialize all lanes
+    # Initialize all lanes (their decoder threads start on the decode cores);
+    # they get the detector once it is loaded
+    pin('decode')
     lanes = []
     for config in LANES_CONFIG:
-        lane = LaneDetector(config, model, traffic_controller)
+        lane = LaneDetector(config, None, traffic_controller)
         if lane.initialize():
             lanes.append(lane)
         else:
             print(f"❌ Failed to initialize {config['lane_id']}")
+    pin('inference')
     
-    if not lanes:
-        print("❌ No lanes initialized. Exiting.")
+    try:
+        detector = loader.result()
+    except Exception as e:
+        print(f"❌ Could not load the detector: {e}")
+        detector = None
+    if not lanes or detector is None:
+        if not lanes:
+            print("❌ No lanes initialized. Exiting.")
+        for lane in lanes:
+            lane.cleanup()
+        traffic_controller.cleanup()
+        telemetry_writer.stop()
+        metrics.shutdown()
         return
+    for lane in lanes:
+        lane.detector = detector
     
-    print(f"\n✅ {len(lanes)} lane(s) running")
-    print("🚦 Waiting for MQTT traffic light commands...")
+    elapsed = time.perf_counter() - startup
+    metrics.set('cv_startup_seconds', elapsed, step='ready')
+    print(f"\n✅ {len(lanes)} lane(s) running, ready in {elapsed:.1f}s")
+    if traffic_controller.connected:
+        print("🚦 Waiting for MQTT traffic light commands...")
+    else:
+        print("🚦 MQTT still connecting; lanes stay red until traffic light commands arrive...")
     print("Press 'q' or ESC in any window to exit\n")
     
+    cpu_meter = UtilizationMeter(resource_plan.all_cores)
+    cpu_total = UtilizationMeter(resource_plan.all_cores)
+    last_cpu_report = time.perf_counter()
+    
     # Main processing loop
     try:
         while True:
+            version = traffic_controller.version
             all_ok = True
             for lane in lanes:
                 if not lane.process_frame():
@@ -635,8 +1188,18 @@ def main():
             if not all_ok:
                 break
             
-            # Check for quit command
+            # Every lane red or ahead of its source: sleep until the first one
+            # has a frame due, or the traffic state changes
+            wait = min(lane.next_work_at for lane in lanes) - time.monotonic()
+            if wait > 0:
+                t = time.perf_counter()
+                traffic_controller.wait_for_change(version, min(wait, IDLE_GUI_INTERVAL))
+                metrics.observe('cv_stage_seconds', time.perf_counter() - t, lane='all', stage='idle_wait')
+            
+            # Check for quit command (waitKey also paints the windows)
+            t = time.perf_counter()
             key = cv2.waitKey(1) & 0xFF
+            metrics.observe('cv_stage_seconds', time.perf_counter() - t, lane='all', stage='gui_events')
             if key == ord('q') or key == 27:
                 print("\nExiting...")
                 break
@@ -650,6 +1213,10 @@ def main():
             if window_closed:
                 print("\nWindow closed by user")
                 break
+            
+            if time.perf_counter() - last_cpu_report >= CPU_REPORT_INTERVAL:
+                report_utilization(cpu_meter)
+                last_cpu_report = time.perf_counter()
     
     except KeyboardInterrupt:
         print("\n\nInterrupted by user")
@@ -663,6 +1230,14 @@ def main():
         for lane in lanes:
             lane.cleanup()
         traffic_controller.cleanup()
+        telemetry_writer.stop()
+        if profiler.running:
+            profiler.stop(wait=True)
+        metrics.shutdown()
+        print(f"🧮 CPU over the run: {format_utilization(cpu_total.sample(), cpu_total.cores)}")
+        if TRACING_ENABLED:
+            print(f"\n⏱️  Latency per stage:\n{tracer.summary()}")
+            tracer.close()
         cv2.destroyAllWindows()
         cv2.waitKey(1)
         print("\n✅ All systems stopped successfully")
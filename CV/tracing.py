@@ -0,0 +1,99 @@
+"""Span log and per-stage latency histograms for the lane detector.
+
+Each telemetry write gets a trace_id that is stored in veiculos together with
+the frame capture time (frame_ts). The controller reads both back and links its
+own spans to them, so ML/rastreamento.py can report the full chain from camera
+frame to signal confirmation.
+"""
+import json
+import os
+import uuid
+from threading import Lock
+
+# Upper bounds (ms) of the histogram buckets; same as ML/rastreamento.py
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+
+class LatencyHistogram:
+    def __init__(self, buckets=BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, ms):
+        i = 0
+        while i < len(self.buckets) and ms > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.total += 1
+        self.sum += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding percentile p (0-100)"""
+        if not self.total:
+            return 0.0
+        target = p / 100 * self.total
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= target:
+                return float(bound)
+        return self.max
+
+
+class Tracer:
+    """Writes spans as JSON lines and keeps one histogram per stage; thread-safe"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.histograms = {}
+        self.lock = Lock()
+        self._out = None
+
+    @staticmethod
+    def new_trace_id():
+        return uuid.uuid4().hex
+
+    def observe(self, name, ms):
+        """Histogram only, for stages measured on every frame"""
+        with self.lock:
+            self.histograms.setdefault(name, LatencyHistogram()).record(ms)
+
+    def span(self, trace_id, name, start, end, histogram=True, **attrs):
+        """histogram=False for stages already fed through observe()"""
+        duration_ms = (end - start) * 1000
+        record = {'trace_id': trace_id, 'span': name, 'inicio': start, 'fim': end,
+                  'duracao_ms': round(duration_ms, 3), **attrs}
+        with self.lock:
+            if histogram:
+                self.histograms.setdefault(name, LatencyHistogram()).record(duration_ms)
+            if self.path:
+                try:
+                    if self._out is None:
+                        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                        self._out = open(self.path, 'a', encoding='utf-8')
+                    self._out.write(json.dumps(record) + "\n")
+                    self._out.flush()
+                except OSError as e:
+                    print(f"⚠️  Could not write span to {self.path}: {e}")
+                    self.path = None
+
+    def summary(self):
+        with self.lock:
+            histograms = dict(self.histograms)
+        lines = [f"{'stage':<20} {'n':>7} {'mean':>9} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>9}"]
+        for name, h in sorted(histograms.items()):
+            if h.total:
+                lines.append(f"{name:<20} {h.total:>7} {h.sum / h.total:>7.1f}ms {h.percentile(50):>6.0f}ms "
+                             f"{h.percentile(95):>6.0f}ms {h.percentile(99):>6.0f}ms {h.max:>7.1f}ms")
+        return "\n".join(lines)
+
+    def close(self):
+        with self.lock:
+            if self._out:
+                self._out.close()
+                self._out = None
+
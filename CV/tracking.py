@@ -0,0 +1,90 @@
+"""Detection extraction, centroid tracking and line counting.
+
+Shared by LaneDetector (live) and batch_count.py (archived footage) so both
+count the same way.
+"""
+import math
+
+import numpy as np
+
+# Half height (px) of the band around the counting line
+LINE_BAND = 15
+
+
+def empty_rows():
+    return np.empty((0, 6), np.float32)
+
+
+def result_array(result):
+    """Boxes of one YOLO result as float32 rows (x1, y1, x2, y2, conf, cls), unfiltered"""
+    boxes = result.boxes
+    if boxes is None or len(boxes) == 0:
+        return empty_rows()
+    return boxes.data[:, :6].cpu().numpy().astype(np.float32, copy=False)
+
+
+def detections_from_array(rows, classes, conf_threshold):
+    """(cx, cy, x1, y1, w, h, conf) for each vehicle row of result_array()"""
+    detections = []
+    for x1, y1, x2, y2, conf, cls in rows.tolist():
+        if int(cls) in classes and conf > conf_threshold:
+            x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
+            w, h = x2 - x1, y2 - y1
+            cx, cy = x1 + w // 2, y1 + h // 2
+            detections.append((cx, cy, x1, y1, w, h, conf))
+    return detections
+
+
+def extract_detections(result, classes, conf_threshold):
+    """(cx, cy, x1, y1, w, h, conf) for each vehicle box of one YOLO result"""
+    return detections_from_array(result_array(result), classes, conf_threshold)
+
+
+class CentroidTracker:
+    """Greedy nearest-centroid matching between consecutive frames.
+
+    Each detection takes the closest unused track within max_distance,
+    otherwise a new id. A track is counted once, the first time its centroid
+    is inside the band around the counting line.
+    """
+
+    def __init__(self, limits, max_distance, band=LINE_BAND):
+        self.limits = limits
+        self.max_distance = max_distance
+        self.band = band
+        self.tracked_objects = {}
+        self.next_id = 0
+        self.counted = set()
+
+    def in_band(self, cx, cy):
+        return (self.limits[0] < cx < self.limits[2]
+                and self.limits[1] - self.band < cy < self.limits[1] + self.band)
+
+    def update(self, detections):
+        """Matches this frame's detections; returns (track_id, cx, cy) of new crossings"""
+        new_tracked_objects = {}
+        crossed = []
+
+        for cx, cy, *_ in detections:
+            best_id = None
+            min_dist = self.max_distance
+
+            for obj_id, (prev_cx, prev_cy) in self.tracked_objects.items():
+                if obj_id not in new_tracked_objects:
+                    dist = math.hypot(cx - prev_cx, cy - prev_cy)
+                    if dist < min_dist:
+                        best_id = obj_id
+                        min_dist = dist
+
+            if best_id is None:
+                best_id = self.next_id
+                self.next_id += 1
+
+            new_tracked_objects[best_id] = (cx, cy)
+
+            if self.in_band(cx, cy) and best_id not in self.counted:
+                self.counted.add(best_id)
+                crossed.append((best_id, cx, cy))
+
+        self.tracked_objects = new_tracked_objects
+        return crossed
@@ -0,0 +1,62 @@
+"""Random forests do sklearn avaliadas direto em numpy.
+
+predict/predict_proba de uma floresta pagam validação, joblib e uma chamada
+por árvore a cada uso: ~20 ms por lote de decisões, mesmo com poucas faixas.
+FlorestaNumpy copia os nós de todas as árvores uma vez, depois do treino, e
+desce todas as amostras por todas as árvores juntas, um nível por iteração.
+O resultado é o mesmo do sklearn (que também compara em float32).
+
+Uso:
+    floresta = FlorestaNumpy(modelo_treinado)
+    floresta.predict_proba(X)   # classificador
+    floresta.predict(X)         # regressor
+"""
+import numpy as np
+
+FOLHA = -1  # sklearn.tree._tree.TREE_LEAF
+
+
+class FlorestaNumpy:
+    def __init__(self, floresta):
+        arvores = [estimador.tree_ for estimador in floresta.estimators_]
+        deslocamentos = np.cumsum([0] + [arvore.node_count for arvore in arvores[:-1]])
+        self.raizes = np.asarray(deslocamentos)
+        self.profundidade = max(arvore.max_depth for arvore in arvores)
+        self.classes_ = getattr(floresta, 'classes_', None)
+
+        esquerda, direita = [], []
+        for arvore, deslocamento in zip(arvores, deslocamentos):
+            nos = np.arange(arvore.node_count)
+            folha = arvore.children_left == FOLHA
+            # Folhas apontam para si mesmas: descer mais níveis não as muda
+            esquerda.append(np.where(folha, nos, arvore.children_left) + deslocamento)
+            direita.append(np.where(folha, nos, arvore.children_right) + deslocamento)
+        self.esquerda = np.concatenate(esquerda)
+        self.direita = np.concatenate(direita)
+        self.feature = np.maximum(np.concatenate([arvore.feature for arvore in arvores]), 0)
+        self.limiar = np.concatenate([arvore.threshold for arvore in arvores])
+
+        valores = np.concatenate([arvore.value[:, 0, :] for arvore in arvores])
+        if self.classes_ is not None:
+            # Proporção de cada classe na folha, como DecisionTreeClassifier.predict_proba
+            soma = valores.sum(axis=1, keepdims=True)
+            valores = valores / np.where(soma == 0, 1, soma)
+        self.valores = valores
+
+    def _folhas(self, X):
+        """Nó folha de cada amostra em cada árvore: (amostras, árvores)"""
+        X = np.asarray(X, dtype=np.float32)
+        nos = np.repeat(self.raizes[None, :], len(X), axis=0)
+        linhas = np.arange(len(X))[:, None]
+        for _ in range(self.profundidade):
+            esquerda = X[linhas, self.feature[nos]] <= self.limiar[nos]
+            nos = np.where(esquerda, self.esquerda[nos], self.direita[nos])
+        return nos
+
+    def predict_proba(self, X):
+        return self.valores[self._folhas(X)].mean(axis=1)
+
+    def predict(self, X):
+        if self.classes_ is not None:
+            return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+        return self.valores[self._folhas(X), 0].mean(axis=1)
@@ -0,0 +1,260 @@
+"""Benchmark das políticas de decisão sobre o histórico de veiculos.
+
+Reproduz a telemetria gravada pelo detector (tabela veiculos, exportada para
+CSV) através de decide_fase, com as regras e com o ML, e mede:
+- velocidade: decisões por segundo e latência por decisão (p50/p95/p99);
+- tráfego: veículos-segundo parados no vermelho, fila máxima numa via
+  vermelha e maior tempo que uma via com carros ficou sem verde.
+
+O replay é em malha aberta: as contagens vêm do histórico e não reagem à
+decisão tomada. Para avaliar a dinâmica das filas use o simulador.py.
+
+Exportar o histórico (uma vez):
+    python benchmark_politicas.py --exportar veiculos.csv
+ou, no psql:
+    \\copy (SELECT id, lane_id, current_cars, timestamp FROM veiculos ORDER BY id) TO 'veiculos.csv' CSV HEADER
+
+Rodar e gravar a referência:
+    python benchmark_politicas.py veiculos.csv --salvar-referencia referencia_benchmark.json
+Comparar depois de mudar _calcular_tempo_adaptativo ou a floresta (sai com 1
+se alguma métrica piorar além da tolerância):
+    python benchmark_politicas.py veiculos.csv --referencia referencia_benchmark.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from contextlib import redirect_stdout
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+import firebase_e_broker as controlador
+from relogio import RelogioSimulado
+from simulador import TEMPO_ENTRE_FASES, treinar_com_simulacao
+
+# Quanto cada métrica pode piorar em relação à referência antes de falhar.
+# 'maior' = maior é melhor; 'menor' = menor é melhor.
+TOLERANCIAS = {
+    'decisoes_por_segundo': ('maior', 0.30),
+    'latencia_p95_ms': ('menor', 0.30),
+    'latencia_p99_ms': ('menor', 0.50),
+    'veiculos_segundo_vermelho': ('menor', 0.05),
+    'fila_maxima_vermelho': ('menor', 0.10),
+    'maior_espera_via_s': ('menor', 0.10),
+}
+
+# Diferenças menores que isto são ruído de medição, não regressão
+FOLGA_ABSOLUTA = {'latencia_p95_ms': 0.1, 'latencia_p99_ms': 0.2}
+
+# Limites absolutos de latência por decisão, com ou sem referência
+LATENCIA_MAXIMA_P99_MS = {'regras': 5.0, 'ml': 100.0}
+
+
+def exportar_veiculos(caminho):
+    conn = psycopg2.connect(**controlador.CAR_DETECTION_CONFIG)
+    try:
+        df = pd.read_sql("SELECT id, lane_id, current_cars, timestamp FROM veiculos ORDER BY id", conn)
+    finally:
+        conn.close()
+    df.to_csv(caminho, index=False)
+    print(f"✓ {len(df)} linhas de veiculos exportadas para {caminho}")
+
+
+class HistoricoFaixas:
+    """Contagem de cada faixa em qualquer instante, como o último registro até ali"""
+
+    def __init__(self, df, lane_mapping):
+        df = df[df['lane_id'].isin(list(lane_mapping))].copy()
+        if df.empty:
+            raise ValueError(f"Nenhuma linha do histórico para as faixas {list(lane_mapping)}")
+        # veiculos.timestamp é hora local sem fuso, como o relógio do controlador
+        horarios = pd.to_datetime(df['timestamp'])
+        segundos = (horarios - pd.Timestamp(0)).dt.total_seconds()
+        primeiro = horarios.min()
+        df['t'] = segundos + (primeiro.to_pydatetime().timestamp() - (primeiro - pd.Timestamp(0)).total_seconds())
+        df = df.sort_values(['t', 'id'])
+
+        self.lane_mapping = lane_mapping
+        self.inicio = float(df['t'].iloc[0])
+        self.fim = float(df['t'].iloc[-1])
+        self.faixas = {}
+        for lane_id, grupo in df.groupby('lane_id'):
+            self.faixas[lane_id] = (grupo['t'].to_numpy(), grupo['current_cars'].fillna(0).to_numpy(dtype=int))
+
+    def vias_em(self, t):
+        vias = {s: 0 for s in dict.fromkeys(self.lane_mapping.values())}
+        for lane_id, (tempos, cars) in self.faixas.items():
+            i = np.searchsorted(tempos, t, side='right') - 1
+            if i >= 0:
+                vias[self.lane_mapping[lane_id]] = int(cars[i])
+        return vias
+
+
+def replay(historico, config, politica, max_decisoes=None):
+    """Reproduz o histórico com uma política e devolve as métricas"""
+    estado = controlador.EstadoCruzamento(config)
+    relogio = RelogioSimulado(historico.inicio)
+    controlador.relogio = relogio
+    controlador.usar_ml = politica == 'ml'
+
+    latencias = []
+    estrategias = {}
+    veiculos_segundo = 0.0
+    fila_maxima = 0
+    ultimo_verde = {s: historico.inicio for s in estado.semaforos}
+    maior_espera = 0.0
+
+    t = historico.inicio
+    with open(os.devnull, 'w') as nulo, redirect_stdout(nulo):
+        while t <= historico.fim and (max_decisoes is None or len(latencias) < max_decisoes):
+            relogio.avancar_para(t)
+            vias = historico.vias_em(t)
+
+            inicio = time.perf_counter()
+            semaforo, tempo, estrategia = controlador.decide_fase(estado, vias)
+            latencias.append(time.perf_counter() - inicio)
+            controlador.avanca_rotacao(estado, semaforo)
+            estrategias[estrategia] = estrategias.get(estrategia, 0) + 1
+
+            duracao = tempo + TEMPO_ENTRE_FASES
+            for s, cars in vias.items():
+                if s == semaforo:
+                    continue
+                veiculos_segundo += cars * duracao
+                fila_maxima = max(fila_maxima, cars)
+                if cars > 0:
+                    maior_espera = max(maior_espera, t + duracao - ultimo_verde[s])
+            ultimo_verde[semaforo] = t + duracao
+            t += duracao
+
+    latencias_ms = np.array(latencias) * 1000
+    return {
+        'decisoes': len(latencias),
+        'decisoes_por_segundo': len(latencias) / max(sum(latencias), 1e-9),
+        'latencia_p50_ms': float(np.percentile(latencias_ms, 50)),
+        'latencia_p95_ms': float(np.percentile(latencias_ms, 95)),
+        'latencia_p99_ms': float(np.percentile(latencias_ms, 99)),
+        'veiculos_segundo_vermelho': veiculos_segundo,
+        'fila_maxima_vermelho': fila_maxima,
+        'maior_espera_via_s': maior_espera,
+        'estrategias': estrategias,
+    }
+
+
+def melhor_de(execucoes):
+    """Junta repetições: tráfego é determinístico, velocidade fica com a melhor"""
+    resultado = dict(execucoes[0])
+    resultado['decisoes_por_segundo'] = max(m['decisoes_por_segundo'] for m in execucoes)
+    for nome in ('latencia_p50_ms', 'latencia_p95_ms', 'latencia_p99_ms'):
+        resultado[nome] = min(m[nome] for m in execucoes)
+    return resultado
+
+
+def compara(resultados, referencia):
+    """Lista as métricas que pioraram além da tolerância ou do limite absoluto"""
+    violacoes = []
+    for politica, metricas in resultados.items():
+        limite = LATENCIA_MAXIMA_P99_MS.get(politica)
+        if limite is not None and metricas['latencia_p99_ms'] > limite:
+            violacoes.append(f"{politica}: latencia_p99_ms {metricas['latencia_p99_ms']:.2f} > limite {limite}")
+
+        base = (referencia or {}).get(politica)
+        if not base:
+            continue
+        for nome, (sentido, tolerancia) in TOLERANCIAS.items():
+            atual, anterior = metricas[nome], base.get(nome)
+            if anterior is None or abs(atual - anterior) <= FOLGA_ABSOLUTA.get(nome, 0):
+                continue
+            if sentido == 'maior' and atual < anterior * (1 - tolerancia):
+                violacoes.append(f"{politica}: {nome} caiu de {anterior:.2f} para {atual:.2f} (tolerância {tolerancia:.0%})")
+            elif sentido == 'menor' and atual > anterior * (1 + tolerancia):
+                violacoes.append(f"{politica}: {nome} subiu de {anterior:.2f} para {atual:.2f} (tolerância {tolerancia:.0%})")
+    return violacoes
+
+
+def imprime_resultado(politica, m):
+    print(f"\n📊 Política: {politica} ({m['decisoes']} decisões)")
+    print(f"   Velocidade: {m['decisoes_por_segundo']:.0f} decisões/s")
+    print(f"   Latência: p50 {m['latencia_p50_ms']:.3f}ms, p95 {m['latencia_p95_ms']:.3f}ms, p99 {m['latencia_p99_ms']:.3f}ms")
+    print(f"   Tráfego: {m['veiculos_segundo_vermelho']:.0f} veículos·s no vermelho, "
+          f"fila máxima {m['fila_maxima_vermelho']}, maior espera {m['maior_espera_via_s']:.0f}s")
+    print(f"   Estratégias: {m['estrategias']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark das políticas sobre o histórico de veiculos")
+    parser.add_argument('historico', nargs='?', help="CSV exportado da tabela veiculos")
+    parser.add_argument('--exportar', metavar='CSV', help="exporta veiculos do PostgreSQL e sai")
+    parser.add_argument('--cruzamento', help="id do cruzamento em CRUZAMENTOS (padrão: o primeiro)")
+    parser.add_argument('--politica', choices=['regras', 'ml', 'ambas'], default='ambas')
+    parser.add_argument('--treino', choices=['simulacao', 'banco'], default='simulacao',
+                        help="origem dos dados de treino do ML: simulação determinística ou ml_training_data")
+    parser.add_argument('--max-decisoes', type=int)
+    parser.add_argument('--repeticoes', type=int, default=3,
+                        help="replays por política; a velocidade reportada é a melhor")
+    parser.add_argument('--referencia', help="JSON de uma execução anterior para comparar")
+    parser.add_argument('--salvar-referencia', metavar='JSON', help="grava os resultados desta execução")
+    args = parser.parse_args()
+
+    if args.exportar:
+        exportar_veiculos(args.exportar)
+        return 0
+    if not args.historico:
+        parser.error("informe o CSV do histórico ou --exportar")
+
+    config = controlador.CRUZAMENTOS[0]
+    if args.cruzamento:
+        config = next((c for c in controlador.CRUZAMENTOS if c['id'] == args.cruzamento), None)
+        if config is None:
+            parser.error(f"cruzamento {args.cruzamento} não está em CRUZAMENTOS")
+
+    historico = HistoricoFaixas(pd.read_csv(args.historico), config['lane_mapping'])
+    print(f"📂 Histórico: {(historico.fim - historico.inicio) / 3600:.1f}h de {len(historico.faixas)} faixas")
+
+    politicas = ['regras', 'ml'] if args.politica == 'ambas' else [args.politica]
+    if 'ml' in politicas:
+        with open(os.devnull, 'w') as nulo, redirect_stdout(nulo):
+            if args.treino == 'banco':
+                treinado = controlador.ml_controller.treinar_modelos()
+            else:
+                treinado, _ = treinar_com_simulacao(86400)
+        if not treinado:
+            print("✗ Não foi possível treinar o ML")
+            return 1
+        print(f"🧠 ML treinado ({args.treino})")
+
+    resultados = {}
+    relogio_original, usar_ml_original = controlador.relogio, controlador.usar_ml
+    try:
+        for politica in politicas:
+            resultados[politica] = melhor_de([replay(historico, config, politica, args.max_decisoes)
+                                              for _ in range(max(1, args.repeticoes))])
+            imprime_resultado(politica, resultados[politica])
+    finally:
+        controlador.relogio, controlador.usar_ml = relogio_original, usar_ml_original
+
+    if args.salvar_referencia:
+        with open(args.salvar_referencia, 'w') as f:
+            json.dump(resultados, f, indent=2)
+        print(f"\n💾 Referência gravada em {args.salvar_referencia}")
+
+    referencia = None
+    if args.referencia:
+        with open(args.referencia) as f:
+            referencia = json.load(f)
+
+    violacoes = compara(resultados, referencia)
+    if violacoes:
+        print("\n❌ Regressões acima do limite:")
+        for v in violacoes:
+            print(f"   - {v}")
+        return 1
+    print("\n✅ Nenhuma regressão acima do limite")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
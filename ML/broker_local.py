@@ -0,0 +1,230 @@
+"""Broker MQTT 3.1.1 mínimo para testes locais, sem Mosquitto.
+
+Atende o que o controlador e os ESP32 usam: CONNECT, SUBSCRIBE com curingas
+(+ e #), PUBLISH QoS 0/1, PING e DISCONNECT. As assinaturas são concedidas
+em QoS 0 e não há mensagens retidas nem sessões persistentes.
+
+Uso:
+    python broker_local.py --porta 1883
+e aponte MQTT_BROKER do controlador (ou --broker da frota_esp32.py) para
+127.0.0.1.
+"""
+import argparse
+import asyncio
+import struct
+import time
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+
+# ==================== CODEC ====================
+
+def codifica_tamanho(n):
+    saida = bytearray()
+    while True:
+        byte, n = n % 128, n // 128
+        saida.append(byte | (0x80 if n else 0))
+        if not n:
+            return bytes(saida)
+
+
+def codifica_string(texto):
+    dados = texto.encode('utf-8') if isinstance(texto, str) else texto
+    return struct.pack('!H', len(dados)) + dados
+
+
+def le_string(corpo, pos):
+    n = struct.unpack_from('!H', corpo, pos)[0]
+    return corpo[pos + 2:pos + 2 + n].decode('utf-8'), pos + 2 + n
+
+
+def pacote(tipo, flags, corpo=b''):
+    return bytes([(tipo << 4) | flags]) + codifica_tamanho(len(corpo)) + corpo
+
+
+async def le_pacote(reader):
+    """Lê um pacote; retorna (tipo, flags, corpo)"""
+    cabecalho = await reader.readexactly(1)
+    tamanho, multiplicador = 0, 1
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        tamanho += (byte & 0x7F) * multiplicador
+        if not byte & 0x80:
+            break
+        multiplicador *= 128
+    corpo = await reader.readexactly(tamanho) if tamanho else b''
+    return cabecalho[0] >> 4, cabecalho[0] & 0x0F, corpo
+
+
+def pacote_connect(client_id, keepalive=0):
+    corpo = codifica_string('MQTT') + bytes([4, 0x02]) + struct.pack('!H', keepalive) + codifica_string(client_id)
+    return pacote(CONNECT, 0, corpo)
+
+
+def pacote_publish(topico, payload, qos=0, packet_id=0):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    corpo = codifica_string(topico)
+    if qos:
+        corpo += struct.pack('!H', packet_id)
+    return pacote(PUBLISH, qos << 1, corpo + payload)
+
+
+def pacote_subscribe(packet_id, topicos):
+    corpo = struct.pack('!H', packet_id) + b''.join(codifica_string(t) + bytes([0]) for t in topicos)
+    return pacote(SUBSCRIBE, 0x02, corpo)
+
+
+def le_publish(flags, corpo):
+    """Retorna (topico, payload, qos, packet_id)"""
+    qos = (flags >> 1) & 0x03
+    topico, pos = le_string(corpo, 0)
+    packet_id = 0
+    if qos:
+        packet_id = struct.unpack_from('!H', corpo, pos)[0]
+        pos += 2
+    return topico, corpo[pos:], qos, packet_id
+
+
+def topico_casa(filtro, topico):
+    partes_filtro, partes_topico = filtro.split('/'), topico.split('/')
+    for i, parte in enumerate(partes_filtro):
+        if parte == '#':
+            return True
+        if i >= len(partes_topico) or (parte != '+' and parte != partes_topico[i]):
+            return False
+    return len(partes_filtro) == len(partes_topico)
+
+
+# ==================== BROKER ====================
+
+class BrokerLocal:
+    def __init__(self, host='127.0.0.1', porta=1883):
+        self.host = host
+        self.porta = porta
+        self.sessoes = {}  # writer -> set de filtros
+        # Índices para a entrega: tópicos exatos num dict, só os curingas são varridos
+        self.exatos = {}  # topico -> set de writers
+        self.curingas = {}  # filtro com + ou # -> set de writers
+        self.servidor = None
+        self.recebidas = 0
+        self.entregues = 0
+
+    async def iniciar(self):
+        self.servidor = await asyncio.start_server(self._atende, self.host, self.porta)
+        self.porta = self.servidor.sockets[0].getsockname()[1]
+        print(f"✅ Broker local ouvindo em {self.host}:{self.porta}")
+
+    async def parar(self):
+        if self.servidor:
+            self.servidor.close()
+            await self.servidor.wait_closed()
+        for writer in list(self.sessoes):
+            writer.close()
+        await asyncio.sleep(0.1)  # deixa as sessões terminarem antes do loop fechar
+
+    def _indice(self, filtro):
+        return self.curingas if '+' in filtro or '#' in filtro else self.exatos
+
+    def _assina(self, writer, filtro):
+        self.sessoes[writer].add(filtro)
+        self._indice(filtro).setdefault(filtro, set()).add(writer)
+
+    def _cancela(self, writer, filtro):
+        self.sessoes[writer].discard(filtro)
+        indice = self._indice(filtro)
+        assinantes = indice.get(filtro)
+        if assinantes is not None:
+            assinantes.discard(writer)
+            if not assinantes:
+                del indice[filtro]
+
+    def _encaminha(self, topico, payload):
+        destinos = set(self.exatos.get(topico, ()))
+        for filtro, assinantes in self.curingas.items():
+            if topico_casa(filtro, topico):
+                destinos |= assinantes
+        if not destinos:
+            return
+        mensagem = pacote_publish(topico, payload)
+        for writer in destinos:
+            writer.write(mensagem)
+        self.entregues += len(destinos)
+
+    async def _atende(self, reader, writer):
+        try:
+            tipo, _, _ = await le_pacote(reader)
+            if tipo != CONNECT:
+                return
+            self.sessoes[writer] = set()
+            writer.write(pacote(CONNACK, 0, b'\x00\x00'))
+
+            while True:
+                tipo, flags, corpo = await le_pacote(reader)
+                if tipo == PUBLISH:
+                    topico, payload, qos, packet_id = le_publish(flags, corpo)
+                    self.recebidas += 1
+                    if qos == 1:
+                        writer.write(pacote(PUBACK, 0, struct.pack('!H', packet_id)))
+                    elif qos == 2:
+                        writer.write(pacote(PUBREC, 0, struct.pack('!H', packet_id)))
+                    self._encaminha(topico, payload)
+                elif tipo == PUBREL:
+                    writer.write(pacote(PUBCOMP, 0, corpo[:2]))
+                elif tipo == SUBSCRIBE:
+                    packet_id = corpo[:2]
+                    pos, concedidos = 2, bytearray()
+                    while pos < len(corpo):
+                        filtro, pos = le_string(corpo, pos)
+                        pos += 1  # QoS pedido; concedemos 0
+                        self._assina(writer, filtro)
+                        concedidos.append(0)
+                    writer.write(pacote(SUBACK, 0, packet_id + bytes(concedidos)))
+                elif tipo == UNSUBSCRIBE:
+                    pos = 2
+                    while pos < len(corpo):
+                        filtro, pos = le_string(corpo, pos)
+                        self._cancela(writer, filtro)
+                    writer.write(pacote(UNSUBACK, 0, corpo[:2]))
+                elif tipo == PINGREQ:
+                    writer.write(pacote(PINGRESP, 0))
+                elif tipo == DISCONNECT:
+                    return
+                # PUBACK/PUBREC/PUBCOMP de clientes: nada a fazer com QoS 0 na entrega
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            for filtro in list(self.sessoes.get(writer, ())):
+                self._cancela(writer, filtro)
+            self.sessoes.pop(writer, None)
+            writer.close()
+
+
+async def executa_broker(host, porta, intervalo_estatisticas):
+    broker = BrokerLocal(host, porta)
+    await broker.iniciar()
+    anterior, inicio = 0, time.monotonic()
+    while True:
+        await asyncio.sleep(intervalo_estatisticas)
+        agora = time.monotonic()
+        taxa = (broker.recebidas - anterior) / (agora - inicio)
+        anterior, inicio = broker.recebidas, agora
+        print(f"📡 {len(broker.sessoes)} conexões, {taxa:.0f} msg/s recebidas, "
+              f"{broker.entregues} entregues no total")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Broker MQTT mínimo para testes locais")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--porta', type=int, default=1883)
+    parser.add_argument('--estatisticas', type=float, default=10, help="intervalo (s) entre os resumos")
+    args = parser.parse_args()
+    try:
+        asyncio.run(executa_broker(args.host, args.porta, args.estatisticas))
+    except KeyboardInterrupt:
+        print("\n🔌 Broker encerrado")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""Features e escolha por faixa, comuns ao controlador e ao ml.py.
+
+Cada fase vira uma linha por faixa, então nada aqui depende do número de
+vias: o mesmo modelo atende cruzamentos de 3, 4 ou 6 vias. As faixas de
+vários cruzamentos vêm concatenadas em arrays planos; inicio[i] é a posição
+da primeira faixa do cruzamento i.
+"""
+import numpy as np
+import pandas as pd
+
+
+def features_faixas(cars, inicio, horas, dias, ciclos):
+    """Features por faixa como {coluna: array}, sem pandas (caminho da predição)"""
+    cars = np.asarray(cars, dtype=float)
+    n_faixas = np.diff(np.append(inicio, len(cars)))
+    grupo = np.repeat(np.arange(len(inicio)), n_faixas)
+
+    total = np.add.reduceat(cars, inicio)[grupo]
+    n = n_faixas[grupo]
+
+    return {
+        'cars_faixa': cars,
+        'cars_antes': total,
+        'n_faixas': n,
+        'relative_density': cars / (total + 1),
+        'cars_media_outras': (total - cars) / np.maximum(n - 1, 1),
+        'hora_dia': np.asarray(horas, dtype=float)[grupo],
+        'dia_semana': np.asarray(dias, dtype=float)[grupo],
+        'cycles_since_open': np.asarray(ciclos, dtype=float),
+    }
+
+
+def monta_features_faixas(cars, inicio, horas, dias, ciclos):
+    """Features por faixa para um conjunto de cruzamentos de tamanhos variados"""
+    return pd.DataFrame(features_faixas(cars, inicio, horas, dias, ciclos))
+
+
+def prob_escolha(modelo, X):
+    """Probabilidade de cada linha ser a faixa escolhida (classe 1)"""
+    classes = list(modelo.classes_)
+    if 1 not in classes:
+        return np.zeros(len(X))
+    return modelo.predict_proba(X)[:, classes.index(1)]
+
+
+def argmax_por_grupo(valores, inicio):
+    """Índice (dentro do grupo) do maior valor de cada grupo de faixas"""
+    n_faixas = np.diff(np.append(inicio, len(valores)))
+    grupo = np.repeat(np.arange(len(inicio)), n_faixas)
+    posicao = np.arange(len(valores)) - np.repeat(inicio, n_faixas)
+    matriz = np.full((len(inicio), n_faixas.max(initial=1)), -np.inf)
+    matriz[grupo, posicao] = valores
+    return np.argmax(matriz, axis=1)
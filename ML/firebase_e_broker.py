@@ -1,7 +1,13 @@
 import paho.mqtt.client as mqtt
+import asyncio
 import json
+import os
+import queue
 import time
-from datetime import datetime, timedelta
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+from datetime import datetime
 import pandas as pd
 import numpy as np
 from sklearn.model_selection import train_test_split
@@ -9,6 +15,13 @@ from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
 from sklearn.metrics import accuracy_score, mean_squared_error
 import psycopg2
 import traceback
+from relogio import RelogioReal
+import rastreamento
+from rastreamento import Rastro, rastreador
+from metricas import metricas
+from perfilador import PerfiladorAmostragem
+from faixas import argmax_por_grupo, features_faixas, monta_features_faixas, prob_escolha
+from arvores import FlorestaNumpy
 
 # Database configurations (unchanged)
 CAR_DETECTION_CONFIG = {
@@ -27,185 +40,258 @@ MLDB_CONFIG = {
     'port': '5432'
 }
 
+# MQTT_BROKER/MQTT_PORTA no ambiente apontam para outro broker, ex. o
+# broker_local.py com a frota_esp32.py nos testes de carga
+MQTT_BROKER = os.environ.get('MQTT_BROKER', "192.168.0.9")
+MQTT_PORTA = int(os.environ.get('MQTT_PORTA', 1883))
+TEMPO_LIMITE_CONFIRMACAO = 35  # s; o ESP32 confirma logo após receber o comando
+
+# Cruzamentos controlados por este processo. Cada um tem seu próprio
+# namespace de tópicos ({id}/comando, {id}/confirmacao) e o mapeamento das
+# faixas da tabela veiculos para as letras dos semáforos. O número de vias
+# vem desse mapeamento: cruzamentos de 3 ou 6 vias usam o mesmo modelo.
+CRUZAMENTOS = [
+    {
+        'id': '3105',
+        'lane_mapping': {'lane_1': 'A', 'lane_2': 'B', 'lane_3': 'C', 'lane_4': 'D'},
+    },
+    # {
+    #     'id': '3106',
+    #     'lane_mapping': {'3106_lane_1': 'A', '3106_lane_2': 'B', '3106_lane_3': 'C'},
+    # },
+]
+TOPICO_COMANDO = '{cruzamento}/comando'
+TOPICO_CONFIRMACAO = '{cruzamento}/confirmacao'
+
+# Modo pipeline: a próxima fase é decidida durante o verde atual e publicada
+# assim que o timer expira, sem leitura/predição entre as fases
+MODO_PIPELINE = True
+ANTECEDENCIA_DECISAO = 2.0  # s antes do fim do verde para a decisão provisória
+
+# Pedidos de decisão que chegam dentro desta janela são resolvidos juntos:
+# uma query de telemetria e um único predict_proba para todos os cruzamentos
+JANELA_LOTE = 0.01  # s
+CICLOS_RETREINO = 20  # fases por cruzamento entre retreinamentos
+INTERVALO_RESUMO_RASTREAMENTO = 300  # s entre os resumos de latência por etapa
+
+# Métricas Prometheus em http://METRICAS_HOST:METRICAS_PORTA/metrics; porta 0 desliga
+METRICAS_HOST = os.environ.get('METRICAS_HOST', '127.0.0.1')
+METRICAS_PORTA = int(os.environ.get('METRICAS_PORTA', 9109))
+
+# Perfilador: SIGUSR1, ou GET /profile na porta de métricas a partir de
+# localhost, alterna uma captura por amostragem gravada em PERFIL_DIRETORIO
+PERFIL_DIRETORIO = os.environ.get('PERFIL_DIRETORIO', 'perfis')
+PERFIL_MAX_SEGUNDOS = 60
+
+# Executores: I/O de banco, predição e treinamento nunca rodam no loop asyncio
+executor_db = ThreadPoolExecutor(max_workers=4, thread_name_prefix='db')
+executor_ml = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ml')
+executor_treino = ThreadPoolExecutor(max_workers=1, thread_name_prefix='treino')
+
+# Relógio das decisões (hora do dia, dia da semana, timestamp dos registros) e
+# dos prazos das fases. O simulador troca por um RelogioSimulado; um replay
+# roda main()/ciclo_cruzamento com relogio.executar_em_tempo_virtual.
+relogio = RelogioReal()
+
+perfilador = PerfiladorAmostragem(PERFIL_DIRETORIO, 'controlador', max_segundos=PERFIL_MAX_SEGUNDOS)
+
 # Global variables
 usar_db_treino = True
 usar_ml = True
-semaforos = ['A', 'B', 'C', 'D']
-topico_envia = '3105/comando'
-topico_recepcao = '3105/confirmacao'
-semaforo_escolhido = None
-semaforo_escolhido_anterior = None
-ultimo_record_id = None
-estado_anterior = None
-tempo_liberacao = None
 ciclos_desde_treinamento = 0
-esperando_feedback = False
-timestamp_comando = None
-dados_antes_comando = None
-feedbacks_recebidos = set()
-proximo_semaforo_rotacao_forçada = 'A'
-last_opened_cycles = {'A': 0, 'B': 0, 'C': 0, 'D': 0}
-opened_this_round = set()
-
-# TrafficMLController, criar_tabela_treinamento, pegardadostreinamento, 
-# enviardadospsql, verificar_dados_coletados, get_vias_dados, 
-# decisao_baseada_regras (unchanged for brevity, same as previous version)
 
 class TrafficMLController:
+    """Modelos por faixa, independentes do número de vias do cruzamento.
+
+    Cada fase vira uma linha por faixa. O classificador estima a chance de
+    cada faixa ser a escolhida e o regressor estima o tempo de verde a partir
+    da linha da faixa escolhida.
+    """
+
     def __init__(self):
         self.semaforo_model = None
         self.tempo_model = None
+        # Os dois modelos em numpy (arvores.py), trocados juntos: é o que a predição usa
+        self.florestas = None
         self.is_trained = False
-        self.feature_columns = ['semaforo_a_cars', 'semaforo_b_cars', 'semaforo_c_cars',
-                               'semaforo_d_cars', 'hora_dia', 'dia_semana', 'cars_antes',
-                               'cars_target_lane', 'relative_density', 'cycles_since_open']
+        self.feature_columns = ['cars_faixa', 'cars_antes', 'n_faixas', 'relative_density',
+                                'cars_media_outras', 'hora_dia', 'dia_semana', 'cycles_since_open']
 
-    def preparar_dados_treinamento(self):
-        dados_completos = pegardadostreinamento()
+    def preparar_dados_treinamento(self, dados_completos=None):
+        if dados_completos is None:
+            dados_completos = pegardadostreinamento()
         print(f"Dados obtidos para treinamento: {len(dados_completos)}")
 
         if len(dados_completos) < 10:
             print(f"Poucos dados para treinamento: {len(dados_completos)}")
-            return None, None, None, None, None, None
+            return None, None
 
         colunas = ['id', 'timestamp', 'semaforo_a_cars', 'semaforo_b_cars',
                    'semaforo_c_cars', 'semaforo_d_cars', 'hora_dia', 'dia_semana',
-                   'semaforo_escolhido', 'tempo_verde', 'cars_antes', 'cars_depois', 'eficiencia']
+                   'semaforo_escolhido', 'tempo_verde', 'cars_antes', 'cars_depois', 'eficiencia',
+                   'faixas', 'cars_por_faixa', 'ciclos_por_faixa']
 
         df = pd.DataFrame(dados_completos, columns=colunas)
         print(f"DataFrame criado com {len(df)} registros")
-
-        def extract_target_cars(row):
-            sem_map = {'A': 'semaforo_a_cars', 'B': 'semaforo_b_cars', 
-                      'C': 'semaforo_c_cars', 'D': 'semaforo_d_cars'}
-            return row[sem_map[row['semaforo_escolhido'].strip()]]
-
-        df['cars_target_lane'] = df.apply(extract_target_cars, axis=1)
-        df['relative_density'] = df['cars_target_lane'] / (df['cars_antes'] + 1)
-        df['cycles_since_open'] = np.random.randint(0, 10, size=len(df))
-
-        X = df[self.feature_columns].copy()
-        semaforo_map = {'A': 0, 'B': 1, 'C': 2, 'D': 3}
-        y_semaforo = df['semaforo_escolhido'].str.strip().map(semaforo_map)
-        y_tempo = df['tempo_verde']
-
-        return train_test_split(X, y_semaforo, y_tempo, test_size=0.2, random_state=42)
-
-    def treinar_modelos(self):
+        metricas.definir('ml_treinamento_registros', len(df))
+
+        # Só registros anteriores às colunas por faixa não têm faixas nem
+        # cars_por_faixa: eram do cruzamento fixo A-D, lidos de semaforo_a..d_cars.
+        # Registros novos gravam apenas os arrays por faixa
+        legado = df[['semaforo_a_cars', 'semaforo_b_cars', 'semaforo_c_cars', 'semaforo_d_cars']].values.tolist()
+        df['faixas'] = [f if f is not None else ['A', 'B', 'C', 'D'] for f in df['faixas']]
+        df['cars_por_faixa'] = [c if c is not None else l for c, l in zip(df['cars_por_faixa'], legado)]
+        df['ciclos_por_faixa'] = [c if c is not None else [0] * len(f)
+                                  for c, f in zip(df['ciclos_por_faixa'], df['faixas'])]
+        df['semaforo_escolhido'] = df['semaforo_escolhido'].str.strip()
+
+        treino, teste = train_test_split(df, test_size=0.2, random_state=42)
+        return self._linhas_por_faixa(treino), self._linhas_por_faixa(teste)
+
+    def _linhas_por_faixa(self, df):
+        n_faixas = df['faixas'].map(len).to_numpy()
+        inicio = np.concatenate([[0], np.cumsum(n_faixas)[:-1]])
+        X = monta_features_faixas(
+            np.concatenate(df['cars_por_faixa'].to_list()), inicio,
+            df['hora_dia'].to_numpy(), df['dia_semana'].to_numpy(),
+            np.concatenate(df['ciclos_por_faixa'].to_list())
+        )
+        faixas = np.concatenate(df['faixas'].to_list())
+        escolhida = (faixas == np.repeat(df['semaforo_escolhido'].to_numpy(), n_faixas)).astype(int)
+        tempo = np.repeat(df['tempo_verde'].to_numpy(), n_faixas)
+        return X, escolhida, tempo, inicio
+
+    def treinar_modelos(self, dados=None):
+        """Treina com as linhas de ml_training_data, ou com dados no mesmo formato"""
+        inicio = time.perf_counter()
+        resultado = 'falha'
         try:
-            data = self.preparar_dados_treinamento()
-            if data[0] is None:
+            treino, teste = self.preparar_dados_treinamento(dados)
+            if treino is None:
+                resultado = 'poucos_dados'
                 return False
 
-            X_train, X_test, y_sem_train, y_sem_test, y_tempo_train, y_tempo_test = data
-            print(f"Treinando com {len(X_train)} amostras...")
-
-            self.semaforo_model = RandomForestClassifier(n_estimators=50, random_state=42)
-            self.semaforo_model.fit(X_train, y_sem_train)
-            self.tempo_model = RandomForestRegressor(n_estimators=100, 
-                                                     max_depth=10,
-                                                     min_samples_split=5,
-                                                     random_state=42)
-            self.tempo_model.fit(X_train, y_tempo_train)
-
-            sem_pred = self.semaforo_model.predict(X_test)
-            tempo_pred = self.tempo_model.predict(X_test)
-
-            sem_accuracy = accuracy_score(y_sem_test, sem_pred)
-            tempo_mse = mean_squared_error(y_tempo_test, tempo_pred)
+            X_train, y_sem_train, y_tempo_train, _ = treino
+            X_test, y_sem_test, y_tempo_test, inicio_test = teste
+            print(f"Treinando com {len(X_train)} linhas por faixa...")
+
+            # Treina em variáveis locais: o loop continua prevendo com os
+            # modelos antigos até a troca no final
+            semaforo_model = RandomForestClassifier(n_estimators=50, random_state=42)
+            semaforo_model.fit(X_train, y_sem_train)
+            escolhidas = y_sem_train == 1
+            tempo_model = RandomForestRegressor(n_estimators=100,
+                                                max_depth=10,
+                                                min_samples_split=5,
+                                                random_state=42)
+            tempo_model.fit(X_train[escolhidas], y_tempo_train[escolhidas])
+
+            # Precisão por fase: a faixa de maior probabilidade é a escolhida?
+            probs = prob_escolha(semaforo_model, X_test)
+            sem_pred = argmax_por_grupo(probs, inicio_test)
+            sem_real = argmax_por_grupo(y_sem_test.astype(float), inicio_test)
+            escolhidas_test = y_sem_test == 1
+            tempo_pred = tempo_model.predict(X_test[escolhidas_test])
+
+            sem_accuracy = accuracy_score(sem_real, sem_pred)
+            tempo_mse = mean_squared_error(y_tempo_test[escolhidas_test], tempo_pred)
 
             print(f"Precisão do modelo de semáforo: {sem_accuracy:.2f}")
             print(f"MSE do modelo de tempo: {tempo_mse:.2f}")
 
+            florestas = (FlorestaNumpy(semaforo_model), FlorestaNumpy(tempo_model))
+            self.semaforo_model, self.tempo_model = semaforo_model, tempo_model
+            self.florestas = florestas
             self.is_trained = True
+            resultado = 'ok'
+            metricas.definir('ml_treinamento_linhas', len(X_train), conjunto='treino')
+            metricas.definir('ml_treinamento_linhas', len(X_test), conjunto='teste')
+            metricas.definir('ml_precisao_semaforo', sem_accuracy)
+            metricas.definir('ml_mse_tempo', tempo_mse)
+            metricas.definir('ml_ultimo_treinamento_timestamp', time.time())
             return True
 
         except Exception as e:
             print(f"Erro ao treinar modelos: {e}")
             traceback.print_exc()
             return False
-
-    def prever_melhor_acao(self, vias_dados, hora_atual, dia_semana, exclude=None, candidates=None):
+        finally:
+            metricas.observar('ml_treinamento_segundos', time.perf_counter() - inicio, resultado=resultado)
+            metricas.incrementar('ml_treinamentos_total', resultado=resultado)
+
+    def prever_melhor_acao(self, vias_dados, hora_atual, dia_semana, exclude=None, candidates=None,
+                           last_opened_cycles=None):
+        return self.prever_melhor_acao_lote(
+            [(vias_dados, hora_atual, dia_semana, exclude, candidates, last_opened_cycles)]
+        )[0]
+
+    def prever_melhor_acao_lote(self, pedidos):
+        """Prevê a próxima fase de vários cruzamentos de uma vez.
+
+        Cada pedido é (vias_dados, hora_atual, dia_semana, exclude, candidates,
+        last_opened_cycles); os cruzamentos podem ter números de vias
+        diferentes. Os dois modelos são avaliados uma única vez sobre todas as
+        faixas, direto em numpy (FlorestaNumpy). Retorna uma lista de
+        (semaforo, tempo), com (None, None) quando a predição falha.
+        """
         if not self.is_trained:
             print("Modelos não estão treinados")
-            return None, None
+            return [(None, None)] * len(pedidos)
 
         try:
-            features_dict = {
-                'semaforo_a_cars': [vias_dados.get('A', 0)],
-                'semaforo_b_cars': [vias_dados.get('B', 0)],
-                'semaforo_c_cars': [vias_dados.get('C', 0)],
-                'semaforo_d_cars': [vias_dados.get('D', 0)],
-                'hora_dia': [hora_atual],
-                'dia_semana': [dia_semana],
-                'cars_antes': [sum(vias_dados.values())],
-                'cars_target_lane': [0],
-                'relative_density': [0],
-                'cycles_since_open': [0]
-            }
-
-            probs = self.semaforo_model.predict_proba(
-                pd.DataFrame({k: v for k, v in features_dict.items() 
-                            if k in ['semaforo_a_cars', 'semaforo_b_cars', 'semaforo_c_cars',
-                                   'semaforo_d_cars', 'hora_dia', 'dia_semana', 'cars_antes']})
-            )[0]
-            
-            sem_map = {0: 'A', 1: 'B', 2: 'C', 3: 'D'}
-            sem_map_inv = {'A': 0, 'B': 1, 'C': 2, 'D': 3}
+            faixas = [list(p[0]) for p in pedidos]
+            n_faixas = np.array([len(f) for f in faixas])
+            inicio = np.concatenate([[0], np.cumsum(n_faixas)[:-1]])
+            cars = np.array([p[0][s] for p, f in zip(pedidos, faixas) for s in f], dtype=float)
+            ciclos = np.array([(p[5] or {}).get(s, 0) for p, f in zip(pedidos, faixas) for s in f], dtype=float)
+
+            features = features_faixas(cars, inicio, [p[1] for p in pedidos],
+                                       [p[2] for p in pedidos], ciclos)
+            semaforo_floresta, tempo_floresta = self.florestas
+            X = np.column_stack([features[coluna] for coluna in self.feature_columns])
+            probs = prob_escolha(semaforo_floresta, X)
 
             bonus = 0.1
-            log_probs = np.log(probs + 1e-10)
-            for i in range(4):
-                lane = sem_map[i]
-                log_probs[i] += bonus * last_opened_cycles[lane]
-
-            if exclude:
-                excl_idx = sem_map_inv[exclude]
-                log_probs[excl_idx] = -np.inf
-
-            if candidates:
-                for i in range(4):
-                    if sem_map[i] not in candidates:
-                        log_probs[i] = -np.inf
-
-            if np.all(log_probs == -np.inf):
-                sem_idx = 0
-            else:
-                log_probs -= np.max(log_probs)
-                probs_adjusted = np.exp(log_probs) / np.sum(np.exp(log_probs))
-                sem_idx = np.argmax(probs_adjusted)
-
-            semaforo_escolhido = sem_map[sem_idx]
-
-            cars_target = vias_dados.get(semaforo_escolhido, 0)
-            total_cars = sum(vias_dados.values())
-            
-            features_dict['cars_target_lane'] = [cars_target]
-            features_dict['relative_density'] = [cars_target / (total_cars + 1)]
-            features_dict['cycles_since_open'] = [last_opened_cycles[semaforo_escolhido]]
-
-            features = pd.DataFrame(features_dict)
-            tempo_pred = self.tempo_model.predict(features)[0]
-            
-            tempo_escolhido = self._calcular_tempo_adaptativo(
-                cars_target, total_cars, tempo_pred, semaforo_escolhido
-            )
-
-            print(f"ML predição: Semáforo {semaforo_escolhido}, Tempo {tempo_escolhido}s")
-            print(f"  └─ Carros na via: {cars_target}, Densidade relativa: {cars_target/(total_cars+1):.2%}")
-            return semaforo_escolhido, tempo_escolhido
+            log_probs = np.log(probs + 1e-10) + bonus * ciclos
+
+            permitido = np.ones(len(cars), dtype=bool)
+            for i, (_, _, _, exclude, candidates, _) in enumerate(pedidos):
+                trecho = slice(inicio[i], inicio[i] + n_faixas[i])
+                if candidates:
+                    permitido[trecho] = [s in candidates for s in faixas[i]]
+                if exclude in faixas[i]:
+                    permitido[inicio[i] + faixas[i].index(exclude)] = False
+            log_probs[~permitido] = -np.inf
+
+            # Cruzamentos sem nenhuma via permitida caem na primeira via, como antes
+            sem_idx = argmax_por_grupo(log_probs, inicio)
+            linha_escolhida = inicio + sem_idx
+            tempos_pred = tempo_floresta.predict(X[linha_escolhida])
+
+            total_cars = np.add.reduceat(cars, inicio)
+            resultados = []
+            for i, linha in enumerate(linha_escolhida):
+                semaforo_escolhido = faixas[i][sem_idx[i]]
+                cars_target = cars[linha]
+                tempo_escolhido = self._calcular_tempo_adaptativo(
+                    cars_target, total_cars[i], tempos_pred[i], ciclos[linha]
+                )
+                print(f"ML predição: Semáforo {semaforo_escolhido}, Tempo {tempo_escolhido}s")
+                print(f"  └─ Carros na via: {cars_target:.0f}, Densidade relativa: {cars_target/(total_cars[i]+1):.2%}")
+                resultados.append((semaforo_escolhido, tempo_escolhido))
+            return resultados
 
         except Exception as e:
             print(f"Erro na predição ML: {e}")
             traceback.print_exc()
-            return None, None
+            return [(None, None)] * len(pedidos)
 
-    def _calcular_tempo_adaptativo(self, cars_target, total_cars, tempo_pred, semaforo):
+    def _calcular_tempo_adaptativo(self, cars_target, total_cars, tempo_pred, cycles):
         tempo_base = max(5, min(30, int(tempo_pred)))
-        
+
         if total_cars > 0:
             density_ratio = cars_target / total_cars
-            
+
             if cars_target == 0:
                 tempo_escolhido = 5
             elif cars_target <= 2:
@@ -216,17 +302,16 @@ class TrafficMLController:
                 tempo_escolhido = min(18, tempo_base)
             else:
                 tempo_escolhido = tempo_base
-            
+
             if density_ratio > 0.5 and cars_target >= 5:
                 tempo_escolhido = min(30, int(tempo_escolhido * 1.2))
-            
-            cycles = last_opened_cycles[semaforo]
+
             if cycles >= 5 and cars_target >= 3:
                 tempo_escolhido = min(30, tempo_escolhido + 3)
-            
+
         else:
             tempo_escolhido = 5
-        
+
         return max(5, min(30, int(tempo_escolhido)))
 
 ml_controller = TrafficMLController()
@@ -249,6 +334,33 @@ def criar_tabela_treinamento():
             conn.commit()
             print("✓ Coluna adicionada")
 
+        # IDs gerados no cliente: o registro é enfileirado antes de existir no banco
+        cursor.execute("""
+            ALTER TABLE ml_training_data
+            ADD COLUMN IF NOT EXISTS registro_uuid UUID
+        """)
+        cursor.execute("""
+            ALTER TABLE ml_training_data
+            ADD COLUMN IF NOT EXISTS cruzamento_id VARCHAR(32)
+        """)
+        # Contagens por faixa para cruzamentos com qualquer número de vias.
+        # Registros novos não preenchem semaforo_a..d_cars, que ficam só nos antigos
+        cursor.execute("""
+            ALTER TABLE ml_training_data
+            ADD COLUMN IF NOT EXISTS faixas TEXT[],
+            ADD COLUMN IF NOT EXISTS cars_por_faixa INTEGER[],
+            ADD COLUMN IF NOT EXISTS ciclos_por_faixa INTEGER[],
+            ALTER COLUMN semaforo_a_cars DROP NOT NULL,
+            ALTER COLUMN semaforo_b_cars DROP NOT NULL,
+            ALTER COLUMN semaforo_c_cars DROP NOT NULL,
+            ALTER COLUMN semaforo_d_cars DROP NOT NULL
+        """)
+        cursor.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS ml_training_data_registro_uuid_idx
+            ON ml_training_data (registro_uuid)
+        """)
+        conn.commit()
+
         cursor.close()
         conn.close()
     except Exception as e:
@@ -261,17 +373,22 @@ def pegardadostreinamento():
 
         print("=== DEBUG DADOS DE TREINAMENTO ===")
 
-        cursor.execute("SELECT COUNT(*) FROM ml_training_data")
-        total_registros = cursor.fetchone()[0]
+        with metricas.cronometro('ml_consulta_sql_segundos', consulta='conta_treinamento'):
+            cursor.execute("SELECT COUNT(*) FROM ml_training_data")
+            total_registros = cursor.fetchone()[0]
         print(f"Total de registros na tabela: {total_registros}")
 
-        cursor.execute("SELECT COUNT(*) FROM ml_training_data WHERE cars_depois IS NOT NULL")
-        registros_completos = cursor.fetchone()[0]
+        with metricas.cronometro('ml_consulta_sql_segundos', consulta='conta_treinamento_completos'):
+            cursor.execute("SELECT COUNT(*) FROM ml_training_data WHERE cars_depois IS NOT NULL")
+            registros_completos = cursor.fetchone()[0]
         print(f"Registros com cars_depois: {registros_completos}")
 
+        inicio_consulta = time.perf_counter()
+        # semaforo_a..d_cars só para registros anteriores às colunas por faixa
         cursor.execute("""
             SELECT id, timestamp, semaforo_a_cars, semaforo_b_cars, semaforo_c_cars, semaforo_d_cars,
-                   hora_dia, dia_semana, semaforo_escolhido, tempo_verde, cars_antes, cars_depois, eficiencia
+                   hora_dia, dia_semana, semaforo_escolhido, tempo_verde, cars_antes, cars_depois, eficiencia,
+                   faixas, cars_por_faixa, ciclos_por_faixa
             FROM ml_training_data
             WHERE cars_depois IS NOT NULL AND eficiencia IS NOT NULL
             ORDER BY timestamp DESC
@@ -279,6 +396,8 @@ def pegardadostreinamento():
         """)
 
         dados = cursor.fetchall()
+        metricas.observar('ml_consulta_sql_segundos', time.perf_counter() - inicio_consulta,
+                          consulta='dados_treinamento')
         cursor.close()
         conn.close()
 
@@ -288,123 +407,218 @@ def pegardadostreinamento():
 
     except Exception as e:
         print(f"Erro ao buscar dados de treinamento: {e}")
+        metricas.incrementar('ml_erros_sql_total', consulta='dados_treinamento')
         return []
 
-def enviardadospsql(dados_treinamento):
-    try:
-        conn = psycopg2.connect(**MLDB_CONFIG)
-        cursor = conn.cursor()
-        query = """
-            INSERT INTO ml_training_data
-            (timestamp, semaforo_a_cars, semaforo_b_cars, semaforo_c_cars, semaforo_d_cars,
-             hora_dia, dia_semana, semaforo_escolhido, tempo_verde, cars_antes)
-            VALUES (to_timestamp(%s), %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING id
-        """
+SQL_INSERE_TREINAMENTO = """
+    INSERT INTO ml_training_data
+    (registro_uuid, cruzamento_id, timestamp, hora_dia, dia_semana, semaforo_escolhido, tempo_verde,
+     cars_antes, faixas, cars_por_faixa, ciclos_por_faixa)
+    VALUES (%s::uuid, %s, to_timestamp(%s), %s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (registro_uuid) DO NOTHING
+"""
 
-        cursor.execute(query, dados_treinamento)
-        record_id = cursor.fetchone()[0]
-        conn.commit()
-        cursor.close()
-        conn.close()
-        print(f"Dados de treinamento salvos, ID: {record_id}")
-        return record_id
-    except Exception as e:
-        print(f"Erro ao salvar dados no PostgreSQL: {e}")
-        return None
+SQL_ATUALIZA_TREINAMENTO = """
+    UPDATE ml_training_data
+    SET cars_depois = %s, eficiencia = %s, feedback_recebido = TRUE
+    WHERE registro_uuid = %s::uuid
+"""
+
+# Rótulo de cada statement nas métricas de latência SQL
+NOMES_CONSULTAS = {SQL_INSERE_TREINAMENTO: 'insere_treinamento', SQL_ATUALIZA_TREINAMENTO: 'atualiza_treinamento'}
+
+class EscritorTreinamento:
+    """Grava os registros de treinamento numa thread própria.
+
+    INSERTs e UPDATEs passam pela mesma fila, na ordem em que foram
+    enfileirados, então a atualização de uma fase nunca chega antes do seu
+    registro. Quem enfileira nunca espera o PostgreSQL.
+    """
+
+    TAMANHO_LOTE = 50
+    MAX_TENTATIVAS = 5
+
+    def __init__(self):
+        self.fila = queue.Queue()
+        self.conn = None
+        self.thread = Thread(target=self._executa, name='escritor-treinamento', daemon=True)
+
+    def iniciar(self):
+        self.thread.start()
+
+    def enviardadospsql(self, record_id, dados_treinamento):
+        self.fila.put((SQL_INSERE_TREINAMENTO, (record_id,) + tuple(dados_treinamento)))
+
+    def atualizar(self, record_id, cars_depois, eficiencia):
+        self.fila.put((SQL_ATUALIZA_TREINAMENTO, (cars_depois, eficiencia, record_id)))
+
+    def parar(self, timeout=5):
+        self.fila.put(None)
+        self.thread.join(timeout)
+
+    def _executa(self):
+        while True:
+            lote = [self.fila.get()]
+            while len(lote) < self.TAMANHO_LOTE:
+                try:
+                    lote.append(self.fila.get_nowait())
+                except queue.Empty:
+                    break
+
+            parar = None in lote
+            lote = [item for item in lote if item is not None]
+            tentativas = 0
+            while lote and not self._grava(lote):
+                tentativas += 1
+                if tentativas >= self.MAX_TENTATIVAS:
+                    print(f"✗ Descartando {len(lote)} operações de treinamento após {tentativas} tentativas")
+                    metricas.incrementar('ml_operacoes_treinamento_descartadas_total', len(lote))
+                    break
+                time.sleep(tentativas)
+            if parar:
+                return
+
+    def _grava(self, lote):
+        try:
+            if self.conn is None or self.conn.closed:
+                self.conn = psycopg2.connect(**MLDB_CONFIG)
+            with self.conn.cursor() as cursor:
+                for query, parametros in lote:
+                    with metricas.cronometro('ml_consulta_sql_segundos', consulta=NOMES_CONSULTAS[query]):
+                        cursor.execute(query, parametros)
+            with metricas.cronometro('ml_consulta_sql_segundos', consulta='commit_treinamento'):
+                self.conn.commit()
+            metricas.definir('ml_fila_escritor_treinamento', self.fila.qsize())
+            print(f"Dados de treinamento salvos ({len(lote)} operações, {self.fila.qsize()} na fila)")
+            return True
+        except Exception as e:
+            print(f"Erro ao salvar dados no PostgreSQL: {e}")
+            metricas.incrementar('ml_erros_sql_total', consulta='grava_treinamento')
+            if self.conn is not None:
+                try:
+                    self.conn.close()
+                except Exception:
+                    pass
+            self.conn = None
+            return False
+
+escritor_treinamento = EscritorTreinamento()
 
 def verificar_dados_coletados():
     if usar_db_treino:
         try:
             conn = psycopg2.connect(**MLDB_CONFIG)
             cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM ml_training_data")
-            total = cursor.fetchone()[0]
-            cursor.execute("SELECT COUNT(*) FROM ml_training_data WHERE cars_depois IS NOT NULL")
-            completos = cursor.fetchone()[0]
+            with metricas.cronometro('ml_consulta_sql_segundos', consulta='conta_treinamento'):
+                cursor.execute("SELECT COUNT(*) FROM ml_training_data")
+                total = cursor.fetchone()[0]
+            with metricas.cronometro('ml_consulta_sql_segundos', consulta='conta_treinamento_completos'):
+                cursor.execute("SELECT COUNT(*) FROM ml_training_data WHERE cars_depois IS NOT NULL")
+                completos = cursor.fetchone()[0]
             cursor.close()
             conn.close()
             print(f"Registros totais: {total}, Registros completos: {completos}")
+            metricas.definir('ml_registros_treinamento', total, tipo='total')
+            metricas.definir('ml_registros_treinamento', completos, tipo='completos')
             return completos
         except Exception as e:
             print(f"Erro ao verificar dados: {e}")
+            metricas.incrementar('ml_erros_sql_total', consulta='conta_treinamento')
             return 0
     return 0
 
-def get_vias_dados():
-    lane_mapping = {
-        'lane_1': 'A',
-        'lane_2': 'B',
-        'lane_3': 'C',
-        'lane_4': 'D'
-    }
-    vias_dados = {'A': 0, 'B': 0, 'C': 0, 'D': 0}
+def get_vias_dados(estados):
+    """Lê a contagem mais recente de cada faixa dos cruzamentos informados.
+
+    Uma única query atende todos os cruzamentos. Retorna
+    {cruzamento_id: vias_dados}, com None para quem não tem dados. Também
+    deixa em estado.telemetria os (lane_id, frame_ts, trace_id) lidos, que o
+    rastreamento liga à decisão.
+    """
+    resultado = {estado.id: None for estado in estados}
+    lane_ids = [lane_id for estado in estados for lane_id in estado.lane_mapping]
+    for estado in estados:
+        estado.telemetria = []
 
     try:
         conn = psycopg2.connect(**CAR_DETECTION_CONFIG)
         cursor = conn.cursor()
 
         query = """
-SELECT lane_id, current_cars, timestamp
+SELECT lane_id, current_cars, timestamp, frame_ts, trace_id
 FROM (
-    SELECT id, lane_id, current_cars, timestamp,
+    SELECT id, lane_id, current_cars, timestamp, frame_ts, trace_id,
            ROW_NUMBER() OVER (PARTITION BY lane_id ORDER BY id DESC) AS rn
     FROM veiculos
+    WHERE lane_id = ANY(%s)
 ) sub
 WHERE rn = 1
 ORDER BY id DESC;
 """
 
-        cursor.execute(query)
-        rows = cursor.fetchall()
-
-        print(f"Resultados da query: {rows}")
+        with metricas.cronometro('ml_consulta_sql_segundos', consulta='telemetria_vias'):
+            cursor.execute(query, (lane_ids,))
+            rows = cursor.fetchall()
+        cursor.close()
+        conn.close()
 
-        latest_timestamp = None
+        print(f"Resultados da query: {len(rows)} faixas")
 
+        por_faixa = {}
         for row in rows:
             lane_id = row[0]
             current_cars = row[1] if row[1] is not None else 0
             timestamp = row[2] if len(row) > 2 else None
+            por_faixa[lane_id] = (current_cars, timestamp, row[3], row[4])
+
+        for estado in estados:
+            vias_dados = {s: 0 for s in estado.semaforos}
+            latest_timestamp = None
+
+            for lane_id, semaforo in estado.lane_mapping.items():
+                if lane_id not in por_faixa:
+                    continue
+                current_cars, timestamp, frame_ts, trace_id = por_faixa[lane_id]
+                vias_dados[semaforo] = current_cars
+                estado.telemetria.append((lane_id, frame_ts, trace_id))
+                if timestamp:
+                    if latest_timestamp is None or timestamp > latest_timestamp:
+                        latest_timestamp = timestamp
+
+            if sum(vias_dados.values()) > 0:
+                print(f"✓ [{estado.id}] Dados reais das vias: {vias_dados}")
+                if latest_timestamp:
+                    age_seconds = (datetime.now() - latest_timestamp).total_seconds()
+                    metricas.definir('ml_idade_telemetria_segundos', round(age_seconds, 3), cruzamento=estado.id)
+                    print(f"📊 [{estado.id}] Idade dos dados: {age_seconds:.1f}s atrás")
+                    if age_seconds > 10:
+                        print(f"⚠️ [{estado.id}] AVISO: Dados podem estar desatualizados!")
+                resultado[estado.id] = vias_dados
+            else:
+                print(f"⚠ [{estado.id}] Nenhum dado encontrado, aguardando novos dados...")
 
-            if timestamp:
-                if latest_timestamp is None or timestamp > latest_timestamp:
-                    latest_timestamp = timestamp
-            if lane_id in lane_mapping:
-                vias_dados[lane_mapping[lane_id]] = current_cars
-
-        cursor.close()
-        conn.close()
-
-        if sum(vias_dados.values()) > 0:
-            print(f"✓ Dados reais das vias: {vias_dados}")
-            if latest_timestamp:
-                age_seconds = (datetime.now() - latest_timestamp).total_seconds()
-                print(f"📊 Idade dos dados: {age_seconds:.1f}s atrás")
-                if age_seconds > 10:
-                    print(f"⚠️ AVISO: Dados podem estar desatualizados!")
-                    return vias_dados
-        else:
-            print("⚠ Nenhum dado encontrado, aguardando novos dados...")
-            return None
-
-        return vias_dados
+        return resultado
 
     except Exception as e:
         print(f"Erro ao buscar dados das vias: {e}")
-        return None
+        metricas.incrementar('ml_erros_sql_total', consulta='telemetria_vias')
+        return resultado
 
-def decisao_baseada_regras(vias_dados, exclude=None, candidates=None):
+def decisao_baseada_regras(vias_dados, exclude=None, candidates=None, last_opened_cycles=None, padrao=None):
+    """padrao: via do próprio cruzamento para quando não há carros nem
+    candidatos (a da rotação forçada); sem ela, a primeira via conhecida"""
     if not vias_dados or sum(vias_dados.values()) == 0:
-        return 'A', 10
+        return padrao or next(iter(candidates or vias_dados or {}), None), 10
 
     if candidates is None:
-        candidates = semaforos
+        candidates = list(vias_dados)
+    if last_opened_cycles is None:
+        last_opened_cycles = {k: 0 for k in vias_dados}
 
     candidates = [c for c in candidates if c != exclude] if exclude else candidates
 
     if not candidates:
-        return 'A', 10
+        return padrao or next(iter(vias_dados)), 10
 
     bonus = 2.0
     effective = {k: vias_dados[k] + bonus * last_opened_cycles[k] for k in candidates}
@@ -432,24 +646,195 @@ def decisao_baseada_regras(vias_dados, exclude=None, candidates=None):
 
     tempo = max(5, min(30, int(tempo)))
     print(f"  └─ Regras: {cars_target} carros → {tempo}s (densidade: {cars_target/(total_cars+0.001):.1%})")
-    
+
     return melhor_semaforo, tempo
 
-def envia_comando_mqtt(client, semaforo_verde, tempo_verde, estrategia):
+class ClienteMQTTAsync:
+    """Cliente MQTT para o loop asyncio.
+
+    A thread de rede do paho continua cuidando do socket e dos keepalives,
+    mas os callbacks apenas repassam os eventos para o loop via
+    call_soon_threadsafe. Nenhum processamento acontece na thread do paho.
+    """
+
+    def __init__(self, host, porta, topicos, keepalive=60):
+        self.host = host
+        self.porta = porta
+        self.topicos = topicos
+        self.keepalive = keepalive
+        self.client = mqtt.Client()
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._on_message
+        self.client.on_subscribe = self._on_subscribe
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+        # mid -> instante do publish(), até o PUBACK
+        self.publicacoes = {}
+        # PUBACKs que chegaram antes do publish() registrar o mid
+        self.acks_antecipados = set()
+        self.lock_publicacoes = Lock()
+        self.loop = None
+        self.mensagens = None
+        self.conectado = None
+
+    async def conectar(self):
+        self.loop = asyncio.get_running_loop()
+        self.mensagens = asyncio.Queue()
+        self.conectado = asyncio.Event()
+        self.client.connect_async(self.host, self.porta, self.keepalive)
+        self.client.loop_start()
+
+    def _on_connect(self, client, userdata, flags, rc):
+        print(f"\n=== MQTT CONNECTION ===")
+        if rc == 0:
+            print("✓ Conectado ao broker MQTT")
+            client.subscribe([(topico, 1) for topico in self.topicos])
+            print(f"✓ Inscrito em {len(self.topicos)} tópicos de confirmação")
+            self.loop.call_soon_threadsafe(self.conectado.set)
+        else:
+            print(f"✗ Falha na conexão MQTT, código: {rc}")
+
+    def _on_disconnect(self, client, userdata, rc):
+        print(f"⚠ Desconectado do broker MQTT (código: {rc})")
+        self.loop.call_soon_threadsafe(self.conectado.clear)
+
+    def _on_subscribe(self, client, userdata, mid, granted_qos):
+        print(f"✓ Inscrição confirmada com QoS {granted_qos}")
+
+    def _on_message(self, client, userdata, message):
+        # O instante de chegada é tomado aqui, antes da fila do loop
+        self.loop.call_soon_threadsafe(
+            self.mensagens.put_nowait, (message.topic, message.payload, time.time())
+        )
+
+    def publish(self, topico, mensagem, qos=1):
+        # O paho apenas enfileira a mensagem; o envio fica com a thread de rede.
+        # client.publish() fica fora do lock: o paho chama _on_publish segurando
+        # o seu próprio mutex, e segurar os dois em ordens opostas trava as threads.
+        inicio = time.perf_counter()
+        resultado = self.client.publish(topico, mensagem, qos=qos)
+        if resultado.rc == mqtt.MQTT_ERR_SUCCESS:
+            with self.lock_publicacoes:
+                antecipado = resultado.mid in self.acks_antecipados
+                if antecipado:
+                    self.acks_antecipados.discard(resultado.mid)
+                else:
+                    if len(self.publicacoes) >= 10000:  # PUBACKs perdidos numa desconexão
+                        self.publicacoes.pop(next(iter(self.publicacoes)))
+                    self.publicacoes[resultado.mid] = inicio
+            if antecipado:
+                metricas.observar('ml_publicacao_mqtt_segundos', time.perf_counter() - inicio)
+        metricas.incrementar('ml_publicacoes_mqtt_total',
+                             resultado='ok' if resultado.rc == mqtt.MQTT_ERR_SUCCESS else 'erro')
+        return resultado
+
+    def _on_publish(self, client, userdata, mid):
+        with self.lock_publicacoes:
+            inicio = self.publicacoes.pop(mid, None)
+            if inicio is None:
+                # O PUBACK venceu o retorno do publish(); ele resolve o mid
+                if len(self.acks_antecipados) >= 1000:
+                    self.acks_antecipados.clear()
+                self.acks_antecipados.add(mid)
+        if inicio is not None:
+            metricas.observar('ml_publicacao_mqtt_segundos', time.perf_counter() - inicio)
+
+    def desconectar(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+class RastreadorConfirmacoes:
+    """Acompanha as confirmações de uma fase como um futuro aguardável."""
+
+    def __init__(self, cruzamento_id):
+        self.cruzamento_id = cruzamento_id
+        self.esperados = set()
+        self.recebidos = set()
+        self.esperando = False
+        self.futuro = None
+        self.iniciado_em = None
+
+    def iniciar(self, esperados):
+        if self.futuro is not None and not self.futuro.done():
+            self.futuro.cancel()
+        self.esperados = set(esperados)
+        self.recebidos.clear()
+        self.futuro = asyncio.get_running_loop().create_future()
+        self.esperando = True
+        self.iniciado_em = time.perf_counter()
+
+    def registrar(self, semaforo):
+        self.recebidos.add(semaforo)
+        metricas.incrementar('ml_confirmacoes_total', cruzamento=self.cruzamento_id)
+        print(f"📊 [{self.cruzamento_id}] Status: {len(self.recebidos)}/{len(self.esperados)} semáforos confirmados {sorted(self.recebidos)}")
+        if self.esperados <= self.recebidos and not self.futuro.done():
+            print(f"✅ [{self.cruzamento_id}] TODOS OS {len(self.esperados)} SEMÁFOROS CONFIRMARAM!")
+            metricas.observar('ml_espera_confirmacao_segundos', time.perf_counter() - self.iniciado_em,
+                              cruzamento=self.cruzamento_id)
+            self.futuro.set_result(set(self.recebidos))
+
+    async def aguardar(self, timeout):
+        """Retorna True se todas as confirmações chegaram dentro do prazo."""
+        try:
+            await asyncio.wait_for(asyncio.shield(self.futuro), timeout)
+            return True
+        except asyncio.TimeoutError:
+            faltando = sorted(self.esperados - self.recebidos)
+            print(f"⚠ [{self.cruzamento_id}] Tempo limite de confirmação excedido, faltando: {faltando}")
+            metricas.incrementar('ml_timeouts_confirmacao_total', cruzamento=self.cruzamento_id)
+            return False
+
+    def encerrar(self):
+        self.esperando = False
+        self.recebidos.clear()
+
+class EstadoCruzamento:
+    """Estado de controle de um cruzamento.
+
+    Reúne o que antes eram variáveis globais do módulo, para que um único
+    processo controle vários cruzamentos.
+    """
+
+    def __init__(self, config):
+        self.id = config['id']
+        self.lane_mapping = config['lane_mapping']
+        self.semaforos = list(dict.fromkeys(self.lane_mapping.values()))
+        self.topico_envia = TOPICO_COMANDO.format(cruzamento=self.id)
+        self.topico_recepcao = TOPICO_CONFIRMACAO.format(cruzamento=self.id)
+
+        self.semaforo_escolhido = None
+        self.semaforo_escolhido_anterior = None
+        self.ultimo_record_id = None
+        self.estado_anterior = None
+        self.tempo_liberacao = None
+        self.timestamp_comando = None
+        self.dados_antes_comando = None
+        self.proximo_semaforo_rotacao_forçada = self.semaforos[0]
+        # Estado por via em arrays alinhados com self.semaforos
+        self.last_opened_cycles = np.zeros(len(self.semaforos), dtype=int)
+        self.opened_this_round = np.zeros(len(self.semaforos), dtype=bool)
+        self.confirmacoes = RastreadorConfirmacoes(self.id)
+        # Rastreamento: telemetria da última leitura e rastro da decisão em curso
+        self.telemetria = []
+        self.rastro_decisao = None
+
+    def ciclos_por_via(self):
+        return dict(zip(self.semaforos, self.last_opened_cycles.tolist()))
+
+def envia_comando_mqtt(client, estado, semaforo_verde, tempo_verde, estrategia):
     """Send MQTT commands with minimal gap between red-all and green"""
-    global topico_envia, semaforos, esperando_feedback, feedbacks_recebidos, timestamp_comando
+    semaforos = estado.semaforos
 
     # Step 1: Red all
     red_all_command = {sem: "L" for sem in semaforos}
     red_all_message = json.dumps(red_all_command)
 
     try:
-        print("--- PASSO 1: Enviando RED-ALL (L) para todas as vias ---")
-        client.publish(topico_envia, red_all_message, qos=1)
-        # Removed time.sleep(0.1) to minimize gap
+        print(f"--- [{estado.id}] PASSO 1: Enviando RED-ALL (L) para todas as vias ---")
+        client.publish(estado.topico_envia, red_all_message, qos=1)
     except Exception as e:
         print(f"Erro ao publicar comando RED-ALL: {e}")
-        return
+        return False
 
     # Step 2: Green for chosen semaphore
     green_command = {sem: "L" for sem in semaforos}
@@ -457,248 +842,478 @@ def envia_comando_mqtt(client, semaforo_verde, tempo_verde, estrategia):
     green_message = json.dumps(green_command)
 
     try:
-        result = client.publish(topico_envia, green_message, qos=1)
+        result = client.publish(estado.topico_envia, green_message, qos=1)
         if result.rc == mqtt.MQTT_ERR_SUCCESS:
-            print(f"--- PASSO 2: Enviando comando GREEN ({semaforo_verde}) ---")
+            print(f"--- [{estado.id}] PASSO 2: Enviando comando GREEN ({semaforo_verde}) ---")
             print(f"✓ Comando enviado ao ESP32: {green_message}")
-            esperando_feedback = True
-            feedbacks_recebidos.clear()
-            timestamp_comando = time.time()  # Record when command was sent
-            print(f"⏳ Aguardando confirmação de todos os semáforos (4/4)...")
+            estado.confirmacoes.iniciar(semaforos)
+            estado.timestamp_comando = relogio.monotonico()  # Record when command was sent
+            print(f"⏳ Aguardando confirmação de todos os semáforos ({len(semaforos)}/{len(semaforos)})...")
+            return True
         else:
             print(f"✗ Erro ao enviar comando GREEN: {result.rc}")
     except Exception as e:
         print(f"Erro ao publicar mensagem GREEN: {e}")
+    return False
+
+def atualiza_ciclos_abertura(estado, semaforo):
+    indice = estado.semaforos.index(semaforo)
+    estado.last_opened_cycles += 1
+    estado.last_opened_cycles[indice] = 0
+    estado.opened_this_round[indice] = True
+
+def contexto_decisao(estado):
+    """Via excluída e candidatos da rotação forçada para a próxima fase"""
+    if estado.opened_this_round.any() and not estado.opened_this_round.all():
+        candidates = [s for s, aberta in zip(estado.semaforos, estado.opened_this_round) if not aberta]
+    else:
+        candidates = estado.semaforos
+    return estado.semaforo_escolhido_anterior, candidates
 
-def publica_mensagem(client, vias_dados):
-    """Publish traffic light command via MQTT with forced rotation"""
-    global semaforo_escolhido, semaforo_escolhido_anterior
-    global ultimo_record_id, estado_anterior, usar_ml, tempo_liberacao
-    global esperando_feedback, timestamp_comando, dados_antes_comando, feedbacks_recebidos
-    global proximo_semaforo_rotacao_forçada, opened_this_round
-
-    print(f"\n=== CICLO DE DECISÃO ===")
+def decide_fase(estado, vias_dados, previsao_ml=None):
+    """Escolhe a próxima fase sem alterar o estado do cruzamento.
 
+    Retorna (semaforo, tempo, estrategia). Pode ser chamada mais de uma vez
+    para a mesma fase: no modo pipeline a decisão provisória é refeita com a
+    telemetria mais recente no fim do verde. previsao_ml, quando informada,
+    vem da predição em lote de LoteDecisoes.
+    """
     # Handle no data case
     if vias_dados is None or sum(vias_dados.values()) == 0:
-        print(f"⚠️ AVISO: Nenhum dado válido disponível. Usando rotação forçada padrão.")
-        semaforo_escolhido = proximo_semaforo_rotacao_forçada
-        tempo_liberacao = 10
-        estrategia = "FALHA DE DADOS / Rotação"
-
-        current_index = semaforos.index(proximo_semaforo_rotacao_forçada)
-        proximo_semaforo_rotacao_forçada = semaforos[(current_index + 1) % len(semaforos)]
-
-        print(f"Decisão ({estrategia}): Semáforo {semaforo_escolhido}, Tempo {tempo_liberacao}s")
-        envia_comando_mqtt(client, semaforo_escolhido, tempo_liberacao, estrategia)
-        semaforo_escolhido_anterior = semaforo_escolhido
-
-        for s in semaforos:
-            if s == semaforo_escolhido:
-                last_opened_cycles[s] = 0
-            else:
-                last_opened_cycles[s] += 1
-
-        opened_this_round.add(semaforo_escolhido)
-        if len(opened_this_round) == 4:
-            opened_this_round.clear()
-
-        return
+        print(f"⚠️ [{estado.id}] AVISO: Nenhum dado válido disponível. Usando rotação forçada padrão.")
+        return estado.proximo_semaforo_rotacao_forçada, 10, "FALHA DE DADOS / Rotação"
 
     # Decision logic
-    estado_anterior = vias_dados.copy()
-    dados_antes_comando = vias_dados.copy()
-    estrategia = "Regras"
-    agora = datetime.now()
-    exclude = semaforo_escolhido_anterior
-
-    print(f"Estado atual das vias: {vias_dados}")
-    print(f"Ciclos desde última abertura: {last_opened_cycles}")
+    print(f"[{estado.id}] Estado atual das vias: {vias_dados}")
+    print(f"[{estado.id}] Ciclos desde última abertura: {estado.ciclos_por_via()}")
 
     # Forced rotation logic
-    if len(opened_this_round) == 4:
-        opened_this_round.clear()
+    exclude, candidates = contexto_decisao(estado)
+    if estado.opened_this_round.all():
         print("✓ Rodada completa, reiniciando ciclo de rotação")
-
-    if opened_this_round:
-        candidates = [s for s in semaforos if s not in opened_this_round]
+    elif estado.opened_this_round.any():
         print(f"Forçando rotação: Candidatos restantes {candidates}")
     else:
-        candidates = semaforos
         print(f"Rodada completa, escolhendo livremente")
 
     if usar_ml and ml_controller.is_trained:
-        semaforo_ml, tempo_ml = ml_controller.prever_melhor_acao(
-            estado_anterior, agora.hour, agora.weekday(), exclude=exclude, candidates=candidates
-        )
+        if previsao_ml is None:
+            agora = relogio.agora_datetime()
+            previsao_ml = ml_controller.prever_melhor_acao(
+                vias_dados, agora.hour, agora.weekday(), exclude=exclude, candidates=candidates,
+                last_opened_cycles=estado.ciclos_por_via()
+            )
+        semaforo_ml, tempo_ml = previsao_ml
         if semaforo_ml and tempo_ml:
-            semaforo_escolhido = semaforo_ml
-            tempo_liberacao = tempo_ml
-            estrategia = "ML Adaptativo"
+            semaforo, tempo, estrategia = semaforo_ml, tempo_ml, "ML Adaptativo"
         else:
-            semaforo_escolhido, tempo_liberacao = decisao_baseada_regras(estado_anterior, exclude=exclude, candidates=candidates)
+            semaforo, tempo = decisao_baseada_regras(vias_dados, exclude=exclude, candidates=candidates,
+                                                     last_opened_cycles=estado.ciclos_por_via(),
+                                                     padrao=estado.proximo_semaforo_rotacao_forçada)
             estrategia = "Regras Adaptativas (ML falhou)"
     else:
-        semaforo_escolhido, tempo_liberacao = decisao_baseada_regras(estado_anterior, exclude=exclude, candidates=candidates)
+        semaforo, tempo = decisao_baseada_regras(vias_dados, exclude=exclude, candidates=candidates,
+                                                 last_opened_cycles=estado.ciclos_por_via(),
+                                                 padrao=estado.proximo_semaforo_rotacao_forçada)
         estrategia = "Regras Adaptativas"
 
-    tempo_liberacao = max(5, min(30, int(tempo_liberacao)))
+    return semaforo, max(5, min(30, int(tempo))), estrategia
+
+class LoteDecisoes:
+    """Agrupa os pedidos de decisão feitos dentro de JANELA_LOTE.
+
+    A telemetria de todos os cruzamentos do lote vem de uma única query e as
+    predições ML de um único predict_proba. Cada pedido recebe
+    (vias_dados, decisao) no futuro devolvido por decidir().
+    """
+
+    def __init__(self, janela=JANELA_LOTE):
+        self.janela = janela
+        self.pendentes = []
+        self.agendado = False
+        self.latencia = 0.0
+
+    def decidir(self, estado):
+        loop = asyncio.get_running_loop()
+        futuro = loop.create_future()
+        self.pendentes.append((estado, futuro, time.perf_counter()))
+        if not self.agendado:
+            self.agendado = True
+            loop.call_later(self.janela, lambda: asyncio.ensure_future(self._processa()))
+        return futuro
+
+    async def _processa(self):
+        pendentes, self.pendentes = self.pendentes, []
+        self.agendado = False
+        loop = asyncio.get_running_loop()
+        inicio = relogio.monotonico()
+        estados = list({estado.id: estado for estado, _, _ in pendentes}.values())
 
-    print(f"\n🚦 Decisão Final ({estrategia}):")
-    print(f"   Semáforo: {semaforo_escolhido}")
-    print(f"   Tempo: {tempo_liberacao}s")
-    print(f"   Carros na via escolhida: {vias_dados[semaforo_escolhido]}")
+        try:
+            inicio_leitura = time.time()
+            vias_por_cruzamento = await loop.run_in_executor(executor_db, get_vias_dados, estados)
+            fim_leitura = time.time()
+            metricas.observar('ml_etapa_decisao_segundos', fim_leitura - inicio_leitura, etapa='leitura')
+            rastros = {}
+            for estado in estados:
+                rastros[estado.id] = Rastro(estado.id, estado.telemetria)
+                rastros[estado.id].lido(inicio_leitura, fim_leitura)
+
+            previsoes = {}
+            if usar_ml and ml_controller.is_trained:
+                agora = relogio.agora_datetime()
+                pedidos = []
+                for estado in estados:
+                    vias_dados = vias_por_cruzamento[estado.id]
+                    if vias_dados and sum(vias_dados.values()) > 0:
+                        exclude, candidates = contexto_decisao(estado)
+                        pedidos.append((estado.id, (vias_dados, agora.hour, agora.weekday(), exclude,
+                                                    candidates, estado.ciclos_por_via())))
+                if pedidos:
+                    inicio_ml = time.time()
+                    resultados = await loop.run_in_executor(
+                        executor_ml, ml_controller.prever_melhor_acao_lote, [p for _, p in pedidos]
+                    )
+                    fim_ml = time.time()
+                    metricas.observar('ml_etapa_decisao_segundos', fim_ml - inicio_ml, etapa='predicao')
+                    previsoes = {cruzamento_id: r for (cruzamento_id, _), r in zip(pedidos, resultados)}
+                    for cruzamento_id, _ in pedidos:
+                        rastros[cruzamento_id].etapa('predicao_ml', inicio_ml, fim_ml)
+                    if len(pedidos) > 1:
+                        print(f"🧮 Lote ML: {len(pedidos)} cruzamentos em um único predict_proba")
+
+            for estado, futuro, pedido_em in pendentes:
+                vias_dados = vias_por_cruzamento[estado.id]
+                rastro = rastros[estado.id]
+                inicio_decisao = time.time()
+                decisao = decide_fase(estado, vias_dados, previsoes.get(estado.id))
+                rastro.decidido_em = time.time()
+                rastro.etapa('decisao', inicio_decisao, rastro.decidido_em)
+                if not futuro.done():
+                    # Só a decisão entregue vira o rastro da fase; uma atualização
+                    # cancelada no modo pipeline não substitui a provisória
+                    estado.rastro_decisao = rastro
+                    futuro.set_result((vias_dados, decisao))
+                metricas.observar('ml_decisao_segundos', time.perf_counter() - pedido_em)
+        except Exception as e:
+            print(f"✗ Erro ao processar lote de decisões: {e}")
+            traceback.print_exc()
+            metricas.incrementar('ml_erros_lote_decisoes_total')
+            for _, futuro, _ in pendentes:
+                if not futuro.done():
+                    futuro.set_exception(e)
 
-    # Save training data
-    if usar_db_treino:
-        agora = datetime.fromtimestamp(time.time())
+        self.latencia = 0.8 * self.latencia + 0.2 * (relogio.monotonico() - inicio)
+
+def publica_mensagem(client, estado, vias_dados, decisao=None):
+    """Publish traffic light command via MQTT with forced rotation"""
+    print(f"\n=== [{estado.id}] CICLO DE DECISÃO ===")
+
+    if decisao is None:
+        decisao = decide_fase(estado, vias_dados)
+    estado.semaforo_escolhido, estado.tempo_liberacao, estrategia = decisao
+    metricas.incrementar('ml_decisoes_total', estrategia=estrategia)
+    dados_validos = vias_dados is not None and sum(vias_dados.values()) > 0
+    estado.ultimo_record_id = None
+
+    if dados_validos:
+        estado.estado_anterior = vias_dados.copy()
+        estado.dados_antes_comando = vias_dados.copy()
+
+        print(f"\n🚦 [{estado.id}] Decisão Final ({estrategia}):")
+        print(f"   Semáforo: {estado.semaforo_escolhido}")
+        print(f"   Tempo: {estado.tempo_liberacao}s")
+        print(f"   Carros na via escolhida: {vias_dados[estado.semaforo_escolhido]}")
+    else:
+        print(f"[{estado.id}] Decisão ({estrategia}): Semáforo {estado.semaforo_escolhido}, Tempo {estado.tempo_liberacao}s")
+
+    # Publish command: sempre antes de qualquer I/O de banco
+    if envia_comando_mqtt(client, estado, estado.semaforo_escolhido, estado.tempo_liberacao, estrategia):
+        if estado.rastro_decisao is not None:
+            estado.rastro_decisao.publicado()
+
+    # Save training data (gravado pelo escritor em segundo plano)
+    if usar_db_treino and dados_validos:
+        estado_anterior = estado.estado_anterior
+        agora = relogio.agora_datetime()
         dados_treinamento = (
-            time.time(),
-            estado_anterior.get('A', 0),
-            estado_anterior.get('B', 0),
-            estado_anterior.get('C', 0),
-            estado_anterior.get('D', 0),
+            estado.id,
+            relogio.agora(),
             agora.hour,
             agora.weekday(),
-            semaforo_escolhido,
-            tempo_liberacao,
-            sum(estado_anterior.values())
+            estado.semaforo_escolhido,
+            estado.tempo_liberacao,
+            sum(estado_anterior.values()),
+            estado.semaforos,
+            [estado_anterior.get(s, 0) for s in estado.semaforos],
+            estado.last_opened_cycles.tolist()
         )
-        ultimo_record_id = enviardadospsql(dados_treinamento)
-
-    # Publish command
-    envia_comando_mqtt(client, semaforo_escolhido, tempo_liberacao, estrategia)
+        estado.ultimo_record_id = str(uuid.uuid4())
+        escritor_treinamento.enviardadospsql(estado.ultimo_record_id, dados_treinamento)
 
     # Update state
-    semaforo_escolhido_anterior = semaforo_escolhido
-    current_index = semaforos.index(semaforo_escolhido)
-    proximo_semaforo_rotacao_forçada = semaforos[(current_index + 1) % len(semaforos)]
+    avanca_rotacao(estado, estado.semaforo_escolhido)
 
-    for s in semaforos:
-        if s == semaforo_escolhido:
-            last_opened_cycles[s] = 0
-        else:
-            last_opened_cycles[s] += 1
+def avanca_rotacao(estado, semaforo):
+    """Atualiza rotação forçada e ciclos depois que a fase foi comandada"""
+    if estado.opened_this_round.all():
+        estado.opened_this_round[:] = False
 
-    opened_this_round.add(semaforo_escolhido)
+    estado.semaforo_escolhido_anterior = semaforo
+    current_index = estado.semaforos.index(semaforo)
+    estado.proximo_semaforo_rotacao_forçada = estado.semaforos[(current_index + 1) % len(estado.semaforos)]
 
-def on_connect(client, userdata, flags, rc):
-    print(f"\n=== MQTT CONNECTION ===")
-    if rc == 0:
-        print("✓ Conectado ao broker MQTT")
-        client.subscribe(topico_recepcao)
-        print(f"✓ Inscrito no tópico: {topico_recepcao}")
-    else:
-        print(f"✗ Falha na conexão MQTT, código: {rc}")
-
-def on_message(client, userdata, message):
-    """Process feedback and only proceed after green duration"""
-    global ultimo_record_id, esperando_feedback, dados_antes_comando, feedbacks_recebidos, semaforo_escolhido
-    global proximo_semaforo_rotacao_forçada, tempo_liberacao, timestamp_comando
+    atualiza_ciclos_abertura(estado, semaforo)
 
+def interpreta_feedback(estado, payload_str):
+    """Retorna o semáforo confirmado numa mensagem do ESP32, ou None."""
+    try:
+        dados_json = json.loads(payload_str)
+        if isinstance(dados_json, dict) and len(dados_json) == 1:
+            semaforo_confirmado = list(dados_json.keys())[0]
+            tempo_confirmado = dados_json[semaforo_confirmado]
+            print(f"✓ [{estado.id}] Confirmação do semáforo VERDE: {semaforo_confirmado} ({tempo_confirmado}s)")
+            return semaforo_confirmado
+    except json.JSONDecodeError:
+        if payload_str in estado.semaforos:
+            print(f"✓ [{estado.id}] Confirmação do semáforo VERMELHO: {payload_str}")
+            return payload_str
+    print(f"⚠ [{estado.id}] Formato de mensagem não reconhecido: {payload_str}")
+    return None
+
+def on_message(estados_por_topico, topico, payload, recebido_em=None):
+    """Registra a confirmação recebida; nunca bloqueia o loop"""
     try:
-        payload_str = message.payload.decode().strip()
-        print(f"\n=== FEEDBACK ESP32 ===")
+        estado = estados_por_topico.get(topico)
+        if estado is None:
+            print(f"⚠ Mensagem em tópico desconhecido: {topico}")
+            metricas.incrementar('ml_feedback_ignorado_total', motivo='topico_desconhecido')
+            return
+
+        payload_str = payload.decode().strip()
+        print(f"\n=== [{estado.id}] FEEDBACK ESP32 ===")
         print(f"Mensagem recebida: {payload_str}")
 
-        if not esperando_feedback:
+        if not estado.confirmacoes.esperando:
             print(f"⚠ Feedback recebido mas não estava esperando feedback (ignorando)")
+            metricas.incrementar('ml_feedback_ignorado_total', motivo='fora_de_fase')
             return
 
-        semaforo_confirmado = None
-        tempo_confirmado = None
-
-        try:
-            dados_json = json.loads(payload_str)
-            if isinstance(dados_json, dict) and len(dados_json) == 1:
-                semaforo_confirmado = list(dados_json.keys())[0]
-                tempo_confirmado = dados_json[semaforo_confirmado]
-                print(f"✓ Confirmação do semáforo VERDE: {semaforo_confirmado} ({tempo_confirmado}s)")
-        except json.JSONDecodeError:
-            if payload_str in ['A', 'B', 'C', 'D']:
-                semaforo_confirmado = payload_str
-                print(f"✓ Confirmação do semáforo VERMELHO: {semaforo_confirmado}")
-            else:
-                print(f"⚠ Formato de mensagem não reconhecido: {payload_str}")
-                return
+        semaforo_confirmado = interpreta_feedback(estado, payload_str)
+        if semaforo_confirmado is None:
+            metricas.incrementar('ml_feedback_ignorado_total', motivo='formato')
+            return
 
-        if semaforo_confirmado and semaforo_confirmado in semaforos:
-            feedbacks_recebidos.add(semaforo_confirmado)
-            print(f"📊 Status: {len(feedbacks_recebidos)}/4 semáforos confirmados {sorted(feedbacks_recebidos)}")
-
-            if len(feedbacks_recebidos) == 4:
-                print(f"✅ TODOS OS 4 SEMÁFOROS CONFIRMARAM!")
-
-                # Wait for the green light duration
-                time_since_command = time.time() - timestamp_comando
-                remaining_time = max(0, tempo_liberacao - time_since_command)
-                if remaining_time > 0:
-                    print(f"⏳ Aguardando duração restante do verde ({remaining_time:.1f}s)...")
-                    time.sleep(remaining_time)
-
-                # Update training data
-                if ultimo_record_id and dados_antes_comando:
-                    cars_antes_total = sum(dados_antes_comando.values())
-                    vias_dados_novos = get_vias_dados()
-                    if vias_dados_novos and sum(vias_dados_novos.values()) > 0:
-                        cars_depois = sum(vias_dados_novos.values())
-                        eficiencia = (cars_antes_total - cars_depois) / max(cars_antes_total, 1)
-                        eficiencia = min(max(eficiencia, 0.0), 9.9999)
-                        try:
-                            conn = psycopg2.connect(**MLDB_CONFIG)
-                            cursor = conn.cursor()
-                            cursor.execute("""
-                                UPDATE ml_training_data
-                                SET cars_depois = %s, eficiencia = %s, feedback_recebido = TRUE
-                                WHERE id = %s
-                            """, (cars_depois, eficiencia, ultimo_record_id))
-                            conn.commit()
-                            cursor.close()
-                            conn.close()
-
-                            print(f"✓ Registro {ultimo_record_id} atualizado:")
-                            print(f"  Carros antes: {cars_antes_total}")
-                            print(f"  Carros depois: {cars_depois}")
-                            print(f"  Eficiência: {eficiencia:.2f}")
-
-                        except Exception as e:
-                            print(f"✗ Erro ao atualizar registro: {e}")
-
-                esperando_feedback = False
-                feedbacks_recebidos.clear()
-                print("✓ Ciclo de feedback completo, pronto para próximo comando")
+        if semaforo_confirmado in estado.semaforos:
+            estado.confirmacoes.registrar(semaforo_confirmado)
+            if estado.confirmacoes.futuro.done() and estado.rastro_decisao is not None:
+                estado.rastro_decisao.confirmado(recebido_em)
         else:
             print(f"⚠ Semáforo confirmado inválido: {semaforo_confirmado}")
+            metricas.incrementar('ml_feedback_ignorado_total', motivo='semaforo_invalido')
 
     except Exception as e:
         print(f"✗ Erro ao processar feedback: {e}")
         traceback.print_exc()
 
-def on_subscribe(client, userdata, mid, granted_qos):
-    print(f"✓ Inscrição confirmada com QoS {granted_qos}")
+async def consome_mensagens(client, estados_por_topico):
+    while True:
+        topico, payload, recebido_em = await client.mensagens.get()
+        on_message(estados_por_topico, topico, payload, recebido_em)
 
-def on_publish(client, userdata, mid):
-    pass
+def atualiza_registro_treinamento(record_id, dados_antes, vias_dados_novos):
+    """Enfileira cars_depois/eficiencia do registro da fase encerrada"""
+    if not record_id or not dados_antes:
+        return
+    if not vias_dados_novos or sum(vias_dados_novos.values()) == 0:
+        return
+
+    cars_antes_total = sum(dados_antes.values())
+    cars_depois = sum(vias_dados_novos.values())
+    eficiencia = (cars_antes_total - cars_depois) / max(cars_antes_total, 1)
+    eficiencia = min(max(eficiencia, 0.0), 9.9999)
+    escritor_treinamento.atualizar(record_id, cars_depois, eficiencia)
+
+    print(f"✓ Registro {record_id} enfileirado para atualização:")
+    print(f"  Carros antes: {cars_antes_total}")
+    print(f"  Carros depois: {cars_depois}")
+    print(f"  Eficiência: {eficiencia:.2f}")
+
+def treinamento_periodico(primeiro):
+    """Executado fora do loop: treinamento inicial ou retreinamento.
+    Retorna se os modelos foram treinados"""
+    if primeiro:
+        if verificar_dados_coletados() < 10:
+            return False
+        print("\n=== PRIMEIRO TREINAMENTO ===")
+        return ml_controller.treinar_modelos()
 
-# Configurar cliente MQTT
-client = mqtt.Client()
-client.on_connect = on_connect
-client.on_message = on_message
-client.on_subscribe = on_subscribe
-client.on_publish = on_publish
+    print("\n=== RETREINAMENTO ===")
+    treinado = ml_controller.treinar_modelos()
+    if treinado:
+        print("✓ Modelos retreinados com dados mais recentes")
+    return treinado
+
+tarefa_treino = None
+
+def agenda_treinamento(n_cruzamentos):
+    """Dispara o treinamento periódico se nenhum estiver em andamento.
+
+    A contagem de ciclos é conferida e zerada aqui, no loop que a incrementa:
+    ciclos contados durante um retreinamento longo entram no próximo intervalo.
+    """
+    global tarefa_treino, ciclos_desde_treinamento
+    if tarefa_treino is not None and not tarefa_treino.done():
+        return
+    limite = CICLOS_RETREINO * n_cruzamentos if usar_ml else n_cruzamentos
+    if ciclos_desde_treinamento < limite:
+        return
+    ciclos_desde_treinamento = 0
+    loop = asyncio.get_running_loop()
+    tarefa_treino = loop.run_in_executor(executor_treino, treinamento_periodico, not usar_ml)
+    tarefa_treino.add_done_callback(fim_treinamento)
+
+def fim_treinamento(tarefa):
+    """No loop, quando o treinamento termina: ativa o ML após o primeiro"""
+    global usar_ml
+    if tarefa.cancelled():
+        return
+    if tarefa.exception() is not None:
+        print(f"✗ Erro no treinamento periódico: {tarefa.exception()}")
+    elif tarefa.result() and not usar_ml:
+        usar_ml = True
+        metricas.definir('ml_ativo', 1)
+        print("✓ ML Adaptativo ativado!")
+
+async def dorme_ate(instante):
+    """instante na base de relogio.monotonico(), a mesma do loop asyncio"""
+    await asyncio.sleep(max(0, instante - relogio.monotonico()))
+
+async def aguarda_fim_da_fase(estado, prazo):
+    """Aguarda as confirmações e o timer do verde; retorna se confirmou"""
+    confirmado = await estado.confirmacoes.aguardar(TEMPO_LIMITE_CONFIRMACAO)
+    if confirmado:
+        restante = prazo - relogio.monotonico()
+        if restante > 0:
+            print(f"⏳ [{estado.id}] Aguardando duração restante do verde ({restante:.1f}s)...")
+    # Timer do loop: acorda exatamente no fim do verde
+    await dorme_ate(prazo)
+    return confirmado
+
+async def proxima_decisao_pipeline(estado, lote, prazo):
+    """Prepara a próxima fase enquanto o verde atual ainda está aberto.
+
+    Uma decisão provisória é calculada ANTECEDENCIA_DECISAO segundos antes do
+    prazo; uma nova leitura das vias é disparada para terminar no prazo e, se
+    chegar a tempo, a decisão é refeita com ela.
+    Retorna (confirmado, vias, decisao).
+    """
+    fim_fase = asyncio.ensure_future(aguarda_fim_da_fase(estado, prazo))
+
+    await dorme_ate(prazo - ANTECEDENCIA_DECISAO)
+    print(f"\n=== [{estado.id}] DECISÃO PROVISÓRIA ({max(0, prazo - relogio.monotonico()):.1f}s antes do fim do verde) ===")
+    vias_dados, decisao = await lote.decidir(estado)
+
+    # Dispara a leitura de atualização para que termine perto do prazo
+    await dorme_ate(prazo - max(0.1, 1.5 * lote.latencia))
+    atualizacao = lote.decidir(estado)
+
+    confirmado = await fim_fase
+    if atualizacao.done() and not atualizacao.exception() and atualizacao.result()[0] is not None:
+        vias_dados, decisao = atualizacao.result()
+    else:
+        print(f"⚠ [{estado.id}] Telemetria atualizada não chegou no prazo, usando decisão provisória")
+        atualizacao.cancel()
+    return confirmado, vias_dados, decisao
+
+async def ciclo_cruzamento(client, estado, lote, n_cruzamentos):
+    """Uma fase por iteração: decide, publica e dorme até o prazo do verde"""
+    global ciclos_desde_treinamento
+
+    confirmado = False
+    vias_dados, decisao = await lote.decidir(estado)
+
+    while True:
+        ciclos_desde_treinamento += 1
+
+        record_id = estado.ultimo_record_id if confirmado else None
+        dados_antes = estado.dados_antes_comando
+        estado.timestamp_comando = None
+        publica_mensagem(client, estado, vias_dados, decisao)
+        agenda_treinamento(n_cruzamentos)
+
+        # Fase anterior: o mesmo snapshot das vias serve de "depois"
+        if usar_db_treino:
+            atualiza_registro_treinamento(record_id, dados_antes, vias_dados)
+
+        if estado.timestamp_comando is None:
+            # Comando não saiu: espera o tempo da fase e tenta de novo
+            confirmado = False
+            await asyncio.sleep(estado.tempo_liberacao)
+            vias_dados, decisao = await lote.decidir(estado)
+            continue
+
+        prazo = estado.timestamp_comando + estado.tempo_liberacao
+        if MODO_PIPELINE:
+            confirmado, vias_dados, decisao = await proxima_decisao_pipeline(estado, lote, prazo)
+        else:
+            confirmado = await aguarda_fim_da_fase(estado, prazo)
+
+        estado.confirmacoes.encerrar()
+        print(f"✓ [{estado.id}] Ciclo de feedback completo, pronto para próximo comando")
+        if not MODO_PIPELINE:
+            vias_dados, decisao = await lote.decidir(estado)
+
+def garantir_colunas_rastreamento():
+    """frame_ts/trace_id em veiculos, caso o detector ainda não as tenha criado"""
+    try:
+        conn = psycopg2.connect(**CAR_DETECTION_CONFIG)
+        cursor = conn.cursor()
+        cursor.execute("ALTER TABLE veiculos ADD COLUMN IF NOT EXISTS frame_ts DOUBLE PRECISION")
+        cursor.execute("ALTER TABLE veiculos ADD COLUMN IF NOT EXISTS trace_id VARCHAR(32)")
+        conn.commit()
+        cursor.close()
+        conn.close()
+    except Exception as e:
+        print(f"⚠ Não foi possível garantir as colunas de rastreamento em veiculos: {e}")
+
+def descrever_metricas():
+    metricas.descrever('ml_decisao_segundos', 'histogram', 'Do pedido de decisão à fase escolhida (leitura, predição e regras)')
+    metricas.descrever('ml_etapa_decisao_segundos', 'histogram', 'Duração de cada etapa de um lote de decisões')
+    metricas.descrever('ml_decisoes_total', 'counter', 'Fases decididas, por estratégia')
+    metricas.descrever('ml_espera_confirmacao_segundos', 'histogram', 'Do comando GREEN à última confirmação dos ESP32')
+    metricas.descrever('ml_confirmacoes_total', 'counter', 'Confirmações recebidas dos ESP32')
+    metricas.descrever('ml_timeouts_confirmacao_total', 'counter', 'Fases sem todas as confirmações no prazo')
+    metricas.descrever('ml_feedback_ignorado_total', 'counter', 'Mensagens de confirmação descartadas, por motivo')
+    metricas.descrever('ml_publicacao_mqtt_segundos', 'histogram', 'Do publish() ao PUBACK do broker')
+    metricas.descrever('ml_publicacoes_mqtt_total', 'counter', 'Publicações MQTT, por resultado')
+    metricas.descrever('ml_consulta_sql_segundos', 'histogram', 'Latência de cada statement SQL')
+    metricas.descrever('ml_erros_sql_total', 'counter', 'Falhas de acesso ao banco, por consulta')
+    metricas.descrever('ml_fila_escritor_treinamento', 'gauge', 'Operações de treinamento aguardando gravação')
+    metricas.descrever('ml_operacoes_treinamento_descartadas_total', 'counter', 'Operações de treinamento descartadas após as tentativas')
+    metricas.descrever('ml_treinamento_segundos', 'histogram', 'Duração de treinar_modelos, por resultado')
+    metricas.descrever('ml_treinamentos_total', 'counter', 'Execuções de treinar_modelos, por resultado')
+    metricas.descrever('ml_treinamento_registros', 'gauge', 'Fases lidas no último treinamento')
+    metricas.descrever('ml_treinamento_linhas', 'gauge', 'Linhas por faixa do último treinamento')
+    metricas.descrever('ml_precisao_semaforo', 'gauge', 'Precisão do classificador de semáforo no conjunto de teste')
+    metricas.descrever('ml_mse_tempo', 'gauge', 'MSE do regressor de tempo de verde no conjunto de teste')
+    metricas.descrever('ml_ultimo_treinamento_timestamp', 'gauge', 'Instante (epoch s) do último treinamento bem-sucedido')
+    metricas.descrever('ml_registros_treinamento', 'gauge', 'Registros em ml_training_data')
+    metricas.descrever('ml_idade_telemetria_segundos', 'gauge', 'Idade da contagem mais recente de veiculos por cruzamento')
+    metricas.descrever('ml_ativo', 'gauge', '1 quando as decisões usam o modelo ML')
+
+async def resumo_rastreamento_periodico():
+    while True:
+        await asyncio.sleep(INTERVALO_RESUMO_RASTREAMENTO)
+        print(f"\n=== LATÊNCIA POR ETAPA ===\n{rastreador.resumo()}")
 
 def inicializar_sistema():
     print("=== INICIALIZANDO SISTEMA DE CONTROLE DE TRÁFEGO ===")
     print("🚀 Versão: ML Adaptativo com Tempo Dinâmico e Rotação Forçada")
 
     criar_tabela_treinamento()
-
-    try:
-        client.connect("192.168.0.9", 1883, 60)
-        client.loop_start()
-        print("✓ Cliente MQTT iniciado")
-    except Exception as e:
-        print(f"✗ Erro ao conectar ao broker MQTT: {e}")
+    if rastreamento.usar_rastreamento:
+        garantir_colunas_rastreamento()
 
     dados_disponiveis = verificar_dados_coletados()
     print(f"=== VERIFICAÇÃO DE TREINAMENTO ===")
@@ -719,52 +1334,69 @@ def inicializar_sistema():
         print("Sistema funcionará com regras adaptativas até coletar mais dados")
 
     print(f"Status final: usar_ml={usar_ml}, is_trained={ml_controller.is_trained}")
+    metricas.definir('ml_ativo', int(usar_ml and ml_controller.is_trained))
     print("="*50)
 
-# Inicializar sistema
-inicializar_sistema()
+async def main():
+    descrever_metricas()
+    if METRICAS_PORTA:
+        try:
+            metricas.servir(METRICAS_PORTA, METRICAS_HOST, rotas={'/profile': perfilador.atende_pedido})
+            print(f"📈 Métricas em http://{METRICAS_HOST}:{METRICAS_PORTA}/metrics")
+        except OSError as e:
+            print(f"⚠ Endpoint de métricas desativado: {e}")
+    if perfilador.instalar_sinal():
+        print(f"🔬 Perfilador: kill -USR1 {os.getpid()} inicia/encerra uma captura")
 
-# Loop principal
-print("\n=== INICIANDO LOOP PRINCIPAL ===")
-print("💡 Sistema com tempo adaptativo e rotação forçada ativo!")
-print("   - Mais carros = Mais tempo verde")
-print("   - Menos carros = Menos tempo verde")
-print("   - Rotação garante todas as vias abertas por ciclo")
-print("="*50)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(executor_db, inicializar_sistema)
 
-try:
-    while True:
-        if not esperando_feedback:
-            ciclos_desde_treinamento += 1
-
-            # Small delay to prevent tight looping
-            time.sleep(0.5)
-
-            vias_dados = get_vias_dados()
-            publica_mensagem(client, vias_dados)
-
-            if not usar_ml and verificar_dados_coletados() >= 10:
-                print("\n=== PRIMEIRO TREINAMENTO ===")
-                if ml_controller.treinar_modelos():
-                    usar_ml = True
-                    print("✓ ML Adaptativo ativado!")
-
-            if usar_ml and ciclos_desde_treinamento >= 20:
-                print("\n=== RETREINAMENTO ===")
-                if ml_controller.treinar_modelos():
-                    print("✓ Modelos retreinados com dados mais recentes")
-                ciclos_desde_treinamento = 0
-        else:
-            # Minimal sleep to check for feedback frequently
-            time.sleep(0.1)
-
-except KeyboardInterrupt:
-    print("\n=== FINALIZANDO SISTEMA ===")
-    client.loop_stop()
-    client.disconnect()
-    print("✓ Sistema finalizado")
-except Exception as e:
-    print(f"✗ Erro no loop principal: {e}")
-    traceback.print_exc()
-    client.loop_stop()
-    client.disconnect()
+    estados = [EstadoCruzamento(config) for config in CRUZAMENTOS]
+    estados_por_topico = {estado.topico_recepcao: estado for estado in estados}
+    print(f"🚦 Cruzamentos controlados: {len(estados)}")
+
+    client = ClienteMQTTAsync(MQTT_BROKER, MQTT_PORTA, list(estados_por_topico))
+    try:
+        await client.conectar()
+        print("✓ Cliente MQTT iniciado")
+        await asyncio.wait_for(client.conectado.wait(), 10)
+    except asyncio.TimeoutError:
+        print("⚠ Broker MQTT ainda não respondeu, seguindo com reconexão em segundo plano")
+    except Exception as e:
+        print(f"✗ Erro ao conectar ao broker MQTT: {e}")
+
+    # Loop principal
+    print("\n=== INICIANDO LOOP PRINCIPAL ===")
+    print("💡 Sistema com tempo adaptativo e rotação forçada ativo!")
+    print("   - Mais carros = Mais tempo verde")
+    print("   - Menos carros = Menos tempo verde")
+    print("   - Rotação garante todas as vias abertas por ciclo")
+    print("="*50)
+
+    escritor_treinamento.iniciar()
+    lote = LoteDecisoes()
+    consumidor = asyncio.create_task(consome_mensagens(client, estados_por_topico))
+    resumo = asyncio.create_task(resumo_rastreamento_periodico())
+    try:
+        await asyncio.gather(*(ciclo_cruzamento(client, estado, lote, len(estados)) for estado in estados))
+    finally:
+        consumidor.cancel()
+        resumo.cancel()
+        client.desconectar()
+        escritor_treinamento.parar()
+        if perfilador.rodando:
+            perfilador.parar(aguardar=True)
+        metricas.parar()
+        if rastreamento.usar_rastreamento:
+            print(f"\n=== LATÊNCIA POR ETAPA ===\n{rastreador.resumo()}")
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+        print("\n=== FINALIZANDO SISTEMA ===")
+    except KeyboardInterrupt:
+        print("\n=== FINALIZANDO SISTEMA ===")
+        print("✓ Sistema finalizado")
+    except Exception as e:
+        print(f"✗ Erro no loop principal: {e}")
+        traceback.print_exc()
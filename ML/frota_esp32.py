@@ -0,0 +1,351 @@
+"""Frota de ESP32 simulados e gerador de carga MQTT.
+
+Cada semáforo vira uma conexão MQTT própria que se comporta como o sketch
+arduino/semaforo_*.ino: assina {cruzamento}/comando e, para cada comando,
+responde em {cruzamento}/confirmacao com {"X": t} quando a sua via recebeu
+{"V": t}, ou com "X" caso contrário. Atraso, jitter, perda e duplicação das
+confirmações são configuráveis.
+
+Modos:
+    frota  emula os semáforos dos cruzamentos de CRUZAMENTOS (ou --ids) para o
+           controlador real se conectar a um broker local:
+               python broker_local.py &
+               python frota_esp32.py frota --broker 127.0.0.1 --jitter 0.2 --perda 0.01 &
+               MQTT_BROKER=127.0.0.1 python firebase_e_broker.py
+    carga  faz o papel do controlador: publica RED-ALL + GREEN para N cruzamentos
+           e mede o tempo do comando até a última confirmação, subindo N em rampa:
+               python frota_esp32.py carga --broker-embutido --cruzamentos 1,10,50,100,200
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from collections import Counter
+
+import numpy as np
+
+from broker_local import (BrokerLocal, CONNACK, PUBLISH, SUBACK, le_pacote, le_publish,
+                          pacote_connect, pacote_publish, pacote_subscribe)
+
+TOPICO_COMANDO = '{cruzamento}/comando'
+TOPICO_CONFIRMACAO = '{cruzamento}/confirmacao'
+VIAS_PADRAO = ['A', 'B', 'C', 'D']
+
+
+class ConexaoMQTT:
+    """Cliente MQTT mínimo sobre asyncio; milhares cabem num processo"""
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.reader = None
+        self.writer = None
+        self.proximo_id = 0
+
+    async def conectar(self, host, porta):
+        self.reader, self.writer = await asyncio.open_connection(host, porta)
+        self.writer.write(pacote_connect(self.client_id))
+        tipo, _, corpo = await le_pacote(self.reader)
+        if tipo != CONNACK or corpo[1] != 0:
+            raise ConnectionError(f"CONNACK inválido para {self.client_id}: {corpo!r}")
+
+    async def assinar(self, *topicos):
+        self.proximo_id += 1
+        self.writer.write(pacote_subscribe(self.proximo_id, topicos))
+        while True:
+            tipo, _, _ = await le_pacote(self.reader)
+            if tipo == SUBACK:
+                return
+
+    def publicar(self, topico, payload, qos=0):
+        packet_id = 0
+        if qos:
+            self.proximo_id = self.proximo_id % 65535 + 1
+            packet_id = self.proximo_id
+        self.writer.write(pacote_publish(topico, payload, qos, packet_id))
+
+    async def recebe(self, callback):
+        """Chama callback(topico, payload) para cada PUBLISH até a conexão cair"""
+        try:
+            while True:
+                tipo, flags, corpo = await le_pacote(self.reader)
+                if tipo == PUBLISH:
+                    topico, payload, _, _ = le_publish(flags, corpo)
+                    callback(topico, payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    def fechar(self):
+        if self.writer:
+            self.writer.close()
+
+
+def resposta_esp32(letra, payload):
+    """O que o sketch publica ao receber um comando"""
+    try:
+        comando = json.loads(payload)
+    except (ValueError, UnicodeDecodeError):
+        return letra
+    via = comando.get(letra) if isinstance(comando, dict) else None
+    if isinstance(via, dict) and 'V' in via:
+        return f'{{"{letra}": {float(via["V"]):.2f}}}'
+    return letra
+
+
+class NoSemaforo:
+    """Um ESP32: uma via de um cruzamento"""
+
+    def __init__(self, cruzamento, letra, atraso, jitter, perda, duplicacao, rng):
+        self.cruzamento = cruzamento
+        self.letra = letra
+        self.atraso = atraso
+        self.jitter = jitter
+        self.perda = perda
+        self.duplicacao = duplicacao
+        self.rng = rng
+        self.conexao = ConexaoMQTT(f"Semaforo{letra}_{cruzamento}")
+        self.topico_confirmacao = TOPICO_CONFIRMACAO.format(cruzamento=cruzamento)
+        self.comandos = 0
+        self.perdidas = 0
+        self.duplicadas = 0
+        self.inscrito = asyncio.Event()
+
+    async def executar(self, host, porta):
+        await self.conexao.conectar(host, porta)
+        await self.conexao.assinar(TOPICO_COMANDO.format(cruzamento=self.cruzamento))
+        self.inscrito.set()
+        self.conexao.publicar(self.topico_confirmacao, self.letra)  # como o reconnect() do sketch
+        await self.conexao.recebe(self._on_comando)
+
+    def _on_comando(self, topico, payload):
+        self.comandos += 1
+        if self.rng.random() < self.perda:
+            self.perdidas += 1
+            return
+        resposta = resposta_esp32(self.letra, payload)
+        copias = 1
+        if self.rng.random() < self.duplicacao:
+            copias = 2
+            self.duplicadas += 1
+        atraso = self.atraso + self.rng.uniform(0, self.jitter)
+        loop = asyncio.get_running_loop()
+        for i in range(copias):
+            loop.call_later(atraso * (1 + i), self.conexao.publicar, self.topico_confirmacao, resposta)
+
+
+async def inicia_frota(host, porta, cruzamentos, args):
+    """cruzamentos: {id: [letras]}. Retorna os nós e suas tarefas.
+
+    Espera todos os nós se inscreverem antes do primeiro comando; levanta
+    ConnectionError se algum falhar ou não se inscrever em args.tempo_conexao s.
+    """
+    rng = random.Random(args.semente)
+    nos = [NoSemaforo(cid, letra, args.atraso, args.jitter, args.perda, args.duplicacao, rng)
+           for cid, letras in cruzamentos.items() for letra in letras]
+    tarefas = [asyncio.ensure_future(no.executar(host, porta)) for no in nos]
+    inscritos = asyncio.ensure_future(asyncio.gather(*(no.inscrito.wait() for no in nos)))
+    await asyncio.wait([inscritos, *tarefas], timeout=args.tempo_conexao,
+                       return_when=asyncio.FIRST_COMPLETED)
+    if not inscritos.done():
+        inscritos.cancel()
+        faltam = sum(not no.inscrito.is_set() for no in nos)
+        erros = [t.exception() for t in tarefas if t.done() and not t.cancelled() and t.exception()]
+        if erros:
+            motivo = repr(erros[0])
+        elif any(t.done() for t in tarefas):
+            motivo = "conexão encerrada pelo broker"
+        else:
+            motivo = f"sem resposta em {args.tempo_conexao}s"
+        for no, tarefa in zip(nos, tarefas):
+            no.conexao.fechar()
+            tarefa.cancel()
+        await asyncio.gather(inscritos, *tarefas, return_exceptions=True)
+        raise ConnectionError(f"{faltam} de {len(nos)} semáforos não se conectaram ({motivo})")
+    print(f"🚦 Frota: {len(nos)} semáforos em {len(cruzamentos)} cruzamentos")
+    return nos, tarefas
+
+
+def cruzamentos_configurados(ids):
+    if ids:
+        if '-' in ids:  # faixa, como os ids gerados pelo modo carga: 10000-10099
+            inicio, fim = (int(x) for x in ids.split('-'))
+            return {str(cid): list(VIAS_PADRAO) for cid in range(inicio, fim + 1)}
+        return {cid: list(VIAS_PADRAO) for cid in ids.split(',')}
+    from firebase_e_broker import CRUZAMENTOS
+    return {c['id']: list(dict.fromkeys(c['lane_mapping'].values())) for c in CRUZAMENTOS}
+
+
+# ==================== GERADOR DE CARGA ====================
+
+class GeradorCarga:
+    """Faz o papel do controlador e mede comando -> última confirmação"""
+
+    def __init__(self, cruzamentos, intervalo, tempo_limite):
+        self.cruzamentos = cruzamentos
+        self.intervalo = intervalo
+        self.tempo_limite = tempo_limite
+        self.conexao = ConexaoMQTT(f"carga_{int(time.time())}")
+        self.pendentes = {}
+        self.rtts = []
+        self.timeouts = 0
+        self.duplicadas = 0
+
+    async def conectar(self, host, porta):
+        await self.conexao.conectar(host, porta)
+        await self.conexao.assinar(TOPICO_CONFIRMACAO.format(cruzamento='+'))
+        asyncio.ensure_future(self.conexao.recebe(self._on_confirmacao))
+
+    def _on_confirmacao(self, topico, payload):
+        cruzamento = topico.split('/')[0]
+        pendente = self.pendentes.get(cruzamento)
+        if pendente is None:
+            return
+        texto = payload.decode().strip()
+        try:
+            dados = json.loads(texto)
+            letra = next(iter(dados)) if isinstance(dados, dict) and len(dados) == 1 else None
+            resposta = ('verde', letra)
+        except ValueError:
+            letra = texto
+            resposta = ('L', letra)
+        # Cada resposta esperada é consumida uma vez; só o que passar disso é duplicata
+        if pendente['esperadas'][resposta] <= 0:
+            self.duplicadas += 1
+            return
+        pendente['esperadas'][resposta] -= 1
+        # Confirma a via: o verde pelo {"X": t}, as outras pelo primeiro "X"
+        if (resposta[0] == 'verde') == (letra == pendente['verde']) and letra in pendente['faltam']:
+            pendente['faltam'].discard(letra)
+            if not pendente['faltam'] and not pendente['futuro'].done():
+                pendente['futuro'].set_result(time.perf_counter() - pendente['t0'])
+
+    async def _ciclo(self, cruzamento, letras, fim):
+        topico = TOPICO_COMANDO.format(cruzamento=cruzamento)
+        loop = asyncio.get_running_loop()
+        rng = random.Random(cruzamento)
+        while loop.time() < fim:
+            verde = rng.choice(letras)
+            comando = {s: "L" for s in letras}
+            futuro = loop.create_future()
+            # Respostas de um ciclo: RED-ALL -> "X" de cada via; GREEN -> {"X": t}
+            # da via verde e "X" de novo das outras
+            esperadas = Counter({('L', s): 2 for s in letras})
+            esperadas[('L', verde)] = 1
+            esperadas[('verde', verde)] = 1
+            self.pendentes[cruzamento] = {'t0': time.perf_counter(), 'faltam': set(letras),
+                                          'verde': verde, 'futuro': futuro, 'esperadas': esperadas}
+            self.conexao.publicar(topico, json.dumps(comando), qos=1)
+            comando[verde] = {"V": 10}
+            self.conexao.publicar(topico, json.dumps(comando), qos=1)
+            try:
+                self.rtts.append(await asyncio.wait_for(futuro, self.tempo_limite))
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+            # O ciclo fica pendente até o próximo comando: respostas atrasadas
+            # ainda são conferidas contra as esperadas
+            await asyncio.sleep(self.intervalo)
+
+    async def executar(self, duracao):
+        fim = asyncio.get_running_loop().time() + duracao
+        await asyncio.gather(*(self._ciclo(cid, letras, fim) for cid, letras in self.cruzamentos.items()))
+
+    def resultado(self):
+        rtts = np.array(self.rtts) * 1000 if self.rtts else np.full(1, np.nan)
+        return {
+            'comandos': len(self.rtts) + self.timeouts,
+            'confirmados': len(self.rtts),
+            'timeouts': self.timeouts,
+            'duplicadas': self.duplicadas,
+            'rtt_p50_ms': float(np.percentile(rtts, 50)),
+            'rtt_p95_ms': float(np.percentile(rtts, 95)),
+            'rtt_p99_ms': float(np.percentile(rtts, 99)),
+        }
+
+
+async def executa_carga(args):
+    host, porta = args.broker, args.porta
+    broker = None
+    if args.broker_embutido:
+        broker = BrokerLocal('127.0.0.1', 0)
+        await broker.iniciar()
+        host, porta = broker.host, broker.porta
+
+    niveis = [int(n) for n in args.cruzamentos.split(',')]
+    print(f"\n{'cruz.':>6} {'cmd/s':>8} {'ok':>7} {'timeout':>8} {'dup':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for n in niveis:
+        cruzamentos = {str(10000 + i): list(VIAS_PADRAO) for i in range(n)}
+        tarefas = []
+        if not args.sem_frota:
+            nos, tarefas = await inicia_frota(host, porta, cruzamentos, args)
+        gerador = GeradorCarga(cruzamentos, args.intervalo, args.tempo_limite)
+        await asyncio.wait_for(gerador.conectar(host, porta), args.tempo_conexao)
+        await gerador.executar(args.duracao)
+        r = gerador.resultado()
+        print(f"{n:>6} {r['comandos'] / args.duracao:>8.1f} {r['confirmados']:>7} {r['timeouts']:>8} "
+              f"{r['duplicadas']:>5} {r['rtt_p50_ms']:>8.1f} {r['rtt_p95_ms']:>8.1f} {r['rtt_p99_ms']:>8.1f}")
+
+        gerador.conexao.fechar()
+        if not args.sem_frota:
+            for no in nos:
+                no.conexao.fechar()
+        await asyncio.gather(*tarefas, return_exceptions=True)
+        if r['rtt_p99_ms'] > args.limite_p99_ms or r['timeouts'] > 0.01 * max(r['comandos'], 1):
+            print(f"⚠️  Limite atingido com {n} cruzamentos (p99 > {args.limite_p99_ms}ms ou >1% de timeouts)")
+            break
+
+    if broker:
+        await broker.parar()
+
+
+async def executa_frota(args):
+    cruzamentos = cruzamentos_configurados(args.ids)
+    nos, tarefas = await inicia_frota(args.broker, args.porta, cruzamentos, args)
+    while True:
+        await asyncio.sleep(args.estatisticas)
+        print(f"📊 Comandos: {sum(n.comandos for n in nos)}, perdidas: {sum(n.perdidas for n in nos)}, "
+              f"duplicadas: {sum(n.duplicadas for n in nos)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ESP32 simulados e gerador de carga MQTT")
+    sub = parser.add_subparsers(dest='modo', required=True)
+
+    for nome in ('frota', 'carga'):
+        p = sub.add_parser(nome)
+        p.add_argument('--broker', default='127.0.0.1')
+        p.add_argument('--porta', type=int, default=1883)
+        p.add_argument('--atraso', type=float, default=0.02, help="s até a confirmação")
+        p.add_argument('--jitter', type=float, default=0.05, help="s aleatórios somados ao atraso")
+        p.add_argument('--perda', type=float, default=0.0, help="probabilidade de não confirmar")
+        p.add_argument('--duplicacao', type=float, default=0.0, help="probabilidade de confirmar duas vezes")
+        p.add_argument('--semente', type=int, default=42)
+        p.add_argument('--tempo-conexao', type=float, default=10,
+                       help="s para todas as conexões se inscreverem")
+
+    frota = sub.choices['frota']
+    frota.add_argument('--ids', help="ids separados por vírgula ou faixa 10000-10099 (padrão: CRUZAMENTOS)")
+    frota.add_argument('--estatisticas', type=float, default=10)
+
+    carga = sub.choices['carga']
+    carga.add_argument('--cruzamentos', default='1,10,50,100', help="rampa de cruzamentos simultâneos")
+    carga.add_argument('--duracao', type=float, default=10, help="s em cada nível da rampa")
+    carga.add_argument('--intervalo', type=float, default=0.5, help="s entre fases de um cruzamento")
+    carga.add_argument('--tempo-limite', type=float, default=5)
+    carga.add_argument('--limite-p99-ms', type=float, default=1000)
+    carga.add_argument('--broker-embutido', action='store_true', help="sobe um BrokerLocal no mesmo processo")
+    carga.add_argument('--sem-frota', action='store_true',
+                       help="a frota roda em outro processo (frota --ids 10000-<N-1+10000>)")
+
+    args = parser.parse_args()
+    try:
+        asyncio.run(executa_carga(args) if args.modo == 'carga' else executa_frota(args))
+    except KeyboardInterrupt:
+        print("\n🔌 Encerrado")
+    except (OSError, asyncio.TimeoutError) as e:
+        print(f"✗ Erro de conexão: {e or 'tempo limite'}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""Métricas do controlador em texto Prometheus, servidas por HTTP local.
+
+Mesmo esquema de CV/metrics.py: contadores, gauges e histogramas de baldes
+fixos. Cada histograma tem uma cópia acumulada (para histogram_quantile no
+Prometheus) e uma janela deslizante de JANELA_SEGUNDOS exportada como gauges
+p50/p95/p99, para quem olha o endpoint direto.
+
+    curl http://localhost:9109/metrics
+"""
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+from threading import Lock, Thread
+
+LIMITES_S = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+             1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 60.0, 120.0, 300.0)
+JANELA_SEGUNDOS = 300
+FATIAS_JANELA = 10
+QUANTIS = (0.5, 0.95, 0.99)
+
+
+class HistogramaJanela:
+    def __init__(self, limites=LIMITES_S, janela=JANELA_SEGUNDOS, fatias=FATIAS_JANELA):
+        self.limites = limites
+        self.contagens = [0] * (len(limites) + 1)
+        self.soma = 0.0
+        self.total = 0
+        self.largura_fatia = janela / fatias
+        self.fatias = [[0] * (len(limites) + 1) for _ in range(fatias)]
+        self.ids_fatias = [-1] * fatias
+
+    def observar(self, valor, agora=None):
+        i = bisect_left(self.limites, valor)
+        self.contagens[i] += 1
+        self.soma += valor
+        self.total += 1
+
+        id_fatia = int((agora or time.monotonic()) / self.largura_fatia)
+        k = id_fatia % len(self.fatias)
+        if self.ids_fatias[k] != id_fatia:
+            self.fatias[k] = [0] * (len(self.limites) + 1)
+            self.ids_fatias[k] = id_fatia
+        self.fatias[k][i] += 1
+
+    def quantis_janela(self, quantis=QUANTIS, agora=None):
+        mais_antiga = int((agora or time.monotonic()) / self.largura_fatia) - len(self.fatias) + 1
+        janela = [0] * (len(self.limites) + 1)
+        for id_fatia, contagens in zip(self.ids_fatias, self.fatias):
+            if id_fatia >= mais_antiga:
+                janela = [a + b for a, b in zip(janela, contagens)]
+        total = sum(janela)
+        if not total:
+            return {q: 0.0 for q in quantis}
+
+        resultado = {}
+        for q in quantis:
+            alvo, acumulado = q * total, 0
+            for i, n in enumerate(janela):
+                if acumulado + n >= alvo and n:
+                    baixo = self.limites[i - 1] if i > 0 else 0.0
+                    alto = self.limites[i] if i < len(self.limites) else self.limites[-1] * 2
+                    resultado[q] = baixo + (alto - baixo) * (alvo - acumulado) / n
+                    break
+                acumulado += n
+        return resultado
+
+
+def _rotulos(rotulos):
+    return tuple(sorted(rotulos.items()))
+
+
+def _formata_rotulos(rotulos, extras=()):
+    pares = list(rotulos) + list(extras)
+    if not pares:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pares) + '}'
+
+
+class RegistroMetricas:
+    """Contadores, gauges e histogramas por nome e rótulos; seguro entre threads"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.ajuda = {}
+        self.contadores = {}
+        self.gauges = {}
+        self.histogramas = {}
+        self.servidor = None
+
+    def descrever(self, nome, tipo, texto):
+        self.ajuda[nome] = (tipo, texto)
+
+    def incrementar(self, nome, quantidade=1, **rotulos):
+        chave = (nome, _rotulos(rotulos))
+        with self.lock:
+            self.contadores[chave] = self.contadores.get(chave, 0) + quantidade
+
+    def definir(self, nome, valor, **rotulos):
+        with self.lock:
+            self.gauges[(nome, _rotulos(rotulos))] = valor
+
+    def observar(self, nome, segundos, **rotulos):
+        chave = (nome, _rotulos(rotulos))
+        with self.lock:
+            histograma = self.histogramas.get(chave)
+            if histograma is None:
+                histograma = self.histogramas[chave] = HistogramaJanela()
+            histograma.observar(segundos)
+
+    @contextmanager
+    def cronometro(self, nome, **rotulos):
+        """Observa a duração do bloco, inclusive quando ele levanta exceção"""
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(nome, time.perf_counter() - inicio, **rotulos)
+
+    def renderizar(self):
+        linhas = []
+        with self.lock:
+            contadores = dict(self.contadores)
+            gauges = dict(self.gauges)
+            histogramas = {k: (list(h.contagens), h.soma, h.total, h.quantis_janela())
+                           for k, h in self.histogramas.items()}
+
+        def cabecalho(nome, tipo_padrao):
+            tipo, texto = self.ajuda.get(nome, (tipo_padrao, nome))
+            linhas.append(f"# HELP {nome} {texto}")
+            linhas.append(f"# TYPE {nome} {tipo}")
+
+        for familia in sorted({k[0] for k in contadores}):
+            cabecalho(familia, 'counter')
+            for (nome, rotulos), valor in sorted(contadores.items()):
+                if nome == familia:
+                    linhas.append(f"{nome}{_formata_rotulos(rotulos)} {valor}")
+
+        for familia in sorted({k[0] for k in gauges}):
+            cabecalho(familia, 'gauge')
+            for (nome, rotulos), valor in sorted(gauges.items()):
+                if nome == familia:
+                    linhas.append(f"{nome}{_formata_rotulos(rotulos)} {valor}")
+
+        for familia in sorted({k[0] for k in histogramas}):
+            cabecalho(familia, 'histogram')
+            for (nome, rotulos), (contagens, soma, total, _) in sorted(histogramas.items()):
+                if nome != familia:
+                    continue
+                acumulado = 0
+                for limite, n in zip(LIMITES_S, contagens):
+                    acumulado += n
+                    linhas.append(f"{nome}_bucket{_formata_rotulos(rotulos, [('le', limite)])} {acumulado}")
+                linhas.append(f"{nome}_bucket{_formata_rotulos(rotulos, [('le', '+Inf')])} {total}")
+                linhas.append(f"{nome}_sum{_formata_rotulos(rotulos)} {soma:.6f}")
+                linhas.append(f"{nome}_count{_formata_rotulos(rotulos)} {total}")
+
+            nome_janela = f"{familia}_janela"
+            linhas.append(f"# HELP {nome_janela} quantis de {familia} nos últimos {JANELA_SEGUNDOS}s")
+            linhas.append(f"# TYPE {nome_janela} gauge")
+            for (nome, rotulos), (_, _, _, quantis) in sorted(histogramas.items()):
+                if nome == familia:
+                    for q, valor in quantis.items():
+                        linhas.append(f"{nome_janela}{_formata_rotulos(rotulos, [('quantile', q)])} {valor:.6f}")
+
+        return "\n".join(linhas) + "\n"
+
+    def servir(self, porta, host='127.0.0.1', rotas=None):
+        """Atende /metrics numa thread daemon.
+
+        rotas mapeia caminhos extras para funções que recebem o dict da query
+        string e retornam texto; só respondem a pedidos vindos de localhost.
+        """
+        registro = self
+        rotas = rotas or {}
+
+        class Atendente(BaseHTTPRequestHandler):
+            def do_GET(self):
+                caminho, _, query = self.path.partition('?')
+                if caminho == '/metrics':
+                    texto = registro.renderizar()
+                elif caminho in rotas:
+                    if self.client_address[0] not in ('127.0.0.1', '::1'):
+                        self.send_error(403)
+                        return
+                    texto = rotas[caminho](dict(parse_qsl(query))) + "\n"
+                else:
+                    self.send_error(404)
+                    return
+                corpo = texto.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(corpo)))
+                self.end_headers()
+                self.wfile.write(corpo)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.servidor = ThreadingHTTPServer((host, porta), Atendente)
+        Thread(target=self.servidor.serve_forever, name='metricas', daemon=True).start()
+        return self.servidor
+
+    def parar(self):
+        if self.servidor:
+            self.servidor.shutdown()
+            self.servidor = None
+
+
+metricas = RegistroMetricas()
@@ -10,6 +10,7 @@ from sklearn.model_selection import train_test_split
 from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
 from sklearn.metrics import accuracy_score, mean_squared_error
 import os
+from faixas import argmax_por_grupo, monta_features_faixas, prob_escolha
 
 # Configurações dos DOIS Firebase diferentes
 FIREBASE_TRAINING_URL = "https://projetedb-2224f-default-rtdb.firebaseio.com/"  # Base de treinamento
@@ -18,6 +19,21 @@ FIREBASE_TRAINING_KEY = "chaveml.json"  # Chave para base de treinamento
 FIREBASE_SEMAFORO_URL = "https://SEU-PROJETO-SEMAFOROS-default-rtdb.firebaseio.com/"  # Base dos semáforos  
 FIREBASE_SEMAFORO_KEY = "chaveFirebase.json"  # Chave para base dos semáforos
 
+# Faixas deste cruzamento: lane_id da detecção -> letra do semáforo.
+# O modelo é por faixa (faixas.py) e atende qualquer número de vias; FAIXAS só
+# diz quais vias ler e comandar aqui.
+FAIXAS = {'lane_1': 'A', 'lane_2': 'B', 'lane_3': 'C', 'lane_4': 'D'}
+semaforos = list(FAIXAS.values())
+
+# Máximo de carros por via nos dados simulados (sem Firebase dos semáforos);
+# vias fora daqui usam MAX_CARS_SIMULADOS_PADRAO
+MAX_CARS_SIMULADOS = {'A': 8, 'B': 6, 'C': 7, 'D': 5}
+MAX_CARS_SIMULADOS_PADRAO = 8
+
+def coluna_cars(semaforo):
+    """Coluna de contagem dos registros antigos, anteriores a cars_por_faixa"""
+    return f'semaforo_{semaforo.lower()}_cars'
+
 # Flags de controle
 usar_db_treino = False
 usar_db_semaforo = False
@@ -95,17 +111,16 @@ def enviardadosfirebase(dados):
     if usar_db_treino and firebase_training:
         try:
             ref = db.reference('/ml_training_data', app=firebase_training)
+            timestamp, cars_por_faixa, hora_dia, dia_semana, escolhido, tempo_verde, cars_antes = dados
             record = {
-                'timestamp': dados[0],
-                'semaforo_a_cars': dados[1],
-                'semaforo_b_cars': dados[2],
-                'semaforo_c_cars': dados[3],
-                'semaforo_d_cars': dados[4],
-                'hora_dia': dados[5],
-                'dia_semana': dados[6],
-                'semaforo_escolhido': dados[7],
-                'tempo_verde': dados[8],
-                'cars_antes': dados[9]
+                'timestamp': timestamp,
+                'faixas': semaforos,
+                'cars_por_faixa': cars_por_faixa,
+                'hora_dia': hora_dia,
+                'dia_semana': dia_semana,
+                'semaforo_escolhido': escolhido,
+                'tempo_verde': tempo_verde,
+                'cars_antes': cars_antes
             }
             new_record_ref = ref.push(record)
             print(f"✓ Dados salvos no Firebase TREINAMENTO: {record['semaforo_escolhido']} - {record['tempo_verde']}s")
@@ -143,16 +158,18 @@ def pegardadostreinamento(limitefirebase=None):
             dados = []
             for key, value in resultados.items():
                 if isinstance(value, dict) and 'cars_depois' in value:
+                    # Registros antigos não têm faixas/cars_por_faixa: eram do
+                    # cruzamento fixo A-D, com uma coluna por semáforo
+                    faixas = value.get('faixas') or ['A', 'B', 'C', 'D']
+                    cars = value.get('cars_por_faixa') or [value.get(coluna_cars(s), 0) for s in faixas]
                     dados.append([
                         key,
                         value.get('timestamp', 0),
-                        value.get('semaforo_a_cars', 0),
-                        value.get('semaforo_b_cars', 0),
-                        value.get('semaforo_c_cars', 0),
-                        value.get('semaforo_d_cars', 0),
+                        faixas,
+                        cars,
                         value.get('hora_dia', 0),
                         value.get('dia_semana', 0),
-                        value.get('semaforo_escolhido', 'A'),
+                        value.get('semaforo_escolhido', faixas[0]),
                         value.get('tempo_verde', 5),
                         value.get('cars_antes', 0),
                         value.get('cars_depois', 0),
@@ -187,13 +204,12 @@ def verificar_dados_coletados():
             return 0
     return 0
 
-def obter_dados_4_lanes():
-    """Obtém dados das 4 lanes do Firebase dos semáforos"""
+def obter_dados_lanes():
+    """Obtém dados das lanes configuradas em FAIXAS do Firebase dos semáforos"""
     if usar_db_semaforo and firebase_semaforo:
         try:
             vias_dados = {}
-            semaforos = ["A", "B", "C", "D"]
-            lanes = ["lane_1", "lane_2", "lane_3", "lane_4"]
+            lanes = list(FAIXAS)
             
             print("Buscando dados no Firebase SEMÁFOROS...")
             
@@ -271,12 +287,8 @@ def obter_dados_4_lanes():
         else:
             multiplicador = 1.0
         
-        vias = {
-            'A': int(random.randint(0, 8) * multiplicador),
-            'B': int(random.randint(0, 6) * multiplicador),
-            'C': int(random.randint(0, 7) * multiplicador),
-            'D': int(random.randint(0, 5) * multiplicador)
-        }
+        vias = {s: int(random.randint(0, MAX_CARS_SIMULADOS.get(s, MAX_CARS_SIMULADOS_PADRAO)) * multiplicador)
+                for s in semaforos}
         
         print(f"Dados simulados: {vias}")
         return vias
@@ -284,50 +296,68 @@ def obter_dados_4_lanes():
 # Resto do código (TrafficMLController, decisao_baseada_regras, etc.) permanece igual...
 
 class TrafficMLController:
+    """Uma linha por faixa (monta_features_faixas): o classificador estima a
+    chance de cada faixa ser a escolhida e o regressor o tempo de verde da
+    escolhida, para cruzamentos com qualquer número de vias"""
+
     def __init__(self):
         self.semaforo_model = None
         self.tempo_model = None
         self.is_trained = False
-        self.feature_columns = ['semaforo_a_cars', 'semaforo_b_cars', 'semaforo_c_cars', 
-                              'semaforo_d_cars', 'hora_dia', 'dia_semana', 'cars_antes']
+        self.feature_columns = ['cars_faixa', 'cars_antes', 'n_faixas', 'relative_density',
+                                'cars_media_outras', 'hora_dia', 'dia_semana']
         
     def preparar_dados_treinamento(self):
         dados_completos = pegardadostreinamento()
         if len(dados_completos) < 10:
             print(f"Poucos dados para treinamento: {len(dados_completos)} (mínimo: 10)")
-            return None, None, None, None
+            return None, None
             
-        colunas = ['id', 'timestamp', 'semaforo_a_cars', 'semaforo_b_cars', 
-                  'semaforo_c_cars', 'semaforo_d_cars', 'hora_dia', 'dia_semana',
-                  'semaforo_escolhido', 'tempo_verde', 'cars_antes', 'cars_depois', 'eficiencia']
+        colunas = ['id', 'timestamp', 'faixas', 'cars_por_faixa', 'hora_dia', 'dia_semana',
+                   'semaforo_escolhido', 'tempo_verde', 'cars_antes', 'cars_depois', 'eficiencia']
         
         df = pd.DataFrame(dados_completos, columns=colunas)
         
-        X = df[self.feature_columns]
-        semaforo_map = {'A': 0, 'B': 1, 'C': 2, 'D': 3}
-        y_semaforo = df['semaforo_escolhido'].map(semaforo_map)
-        y_tempo = df['tempo_verde']
-        
-        return train_test_split(X, y_semaforo, y_tempo, test_size=0.2, random_state=42)
+        treino, teste = train_test_split(df, test_size=0.2, random_state=42)
+        return self._linhas_por_faixa(treino), self._linhas_por_faixa(teste)
+    
+    def _features(self, cars, inicio, horas, dias):
+        # ml.py não acompanha ciclos desde a abertura: a coluna fica de fora
+        return monta_features_faixas(cars, inicio, horas, dias, np.zeros(len(cars)))[self.feature_columns]
+    
+    def _linhas_por_faixa(self, df):
+        n_faixas = df['faixas'].map(len).to_numpy()
+        inicio = np.concatenate([[0], np.cumsum(n_faixas)[:-1]])
+        X = self._features(np.concatenate(df['cars_por_faixa'].to_list()), inicio,
+                           df['hora_dia'].to_numpy(), df['dia_semana'].to_numpy())
+        faixas = np.concatenate(df['faixas'].to_list())
+        escolhida = (faixas == np.repeat(df['semaforo_escolhido'].to_numpy(), n_faixas)).astype(int)
+        tempo = np.repeat(df['tempo_verde'].to_numpy(), n_faixas)
+        return X, escolhida, tempo, inicio
         
     def treinar_modelos(self):
-        data = self.preparar_dados_treinamento()
-        if data[0] is None:
+        treino, teste = self.preparar_dados_treinamento()
+        if treino is None:
             return False
             
-        X_train, X_test, y_sem_train, y_sem_test, y_tempo_train, y_tempo_test = data
+        X_train, y_sem_train, y_tempo_train, _ = treino
+        X_test, y_sem_test, y_tempo_test, inicio_test = teste
         
         self.semaforo_model = RandomForestClassifier(n_estimators=50, random_state=42)
         self.semaforo_model.fit(X_train, y_sem_train)
         
+        escolhidas = y_sem_train == 1
         self.tempo_model = RandomForestRegressor(n_estimators=50, random_state=42)
-        self.tempo_model.fit(X_train, y_tempo_train)
+        self.tempo_model.fit(X_train[escolhidas], y_tempo_train[escolhidas])
         
-        sem_pred = self.semaforo_model.predict(X_test)
-        tempo_pred = self.tempo_model.predict(X_test)
+        # Precisão por fase: a faixa de maior probabilidade é a escolhida?
+        sem_pred = argmax_por_grupo(prob_escolha(self.semaforo_model, X_test), inicio_test)
+        sem_real = argmax_por_grupo(y_sem_test.astype(float), inicio_test)
+        escolhidas_test = y_sem_test == 1
+        tempo_pred = self.tempo_model.predict(X_test[escolhidas_test])
         
-        sem_accuracy = accuracy_score(y_sem_test, sem_pred)
-        tempo_mse = mean_squared_error(y_tempo_test, tempo_pred)
+        sem_accuracy = accuracy_score(sem_real, sem_pred)
+        tempo_mse = mean_squared_error(y_tempo_test[escolhidas_test], tempo_pred)
         
         print(f"ML Treinado - Precisão: {sem_accuracy:.2f}, Erro: {tempo_mse:.2f}")
         
@@ -338,28 +368,20 @@ class TrafficMLController:
         if not self.is_trained:
             return None, None
             
-        features = np.array([[
-            vias_dados.get('A', 0),
-            vias_dados.get('B', 0),
-            vias_dados.get('C', 0),
-            vias_dados.get('D', 0),
-            hora_atual,
-            dia_semana,
-            sum(vias_dados.values())
-        ]])
+        faixas = list(vias_dados)
+        features = self._features([vias_dados[s] for s in faixas], [0], [hora_atual], [dia_semana])
         
-        sem_pred = self.semaforo_model.predict(features)[0]
-        tempo_pred = self.tempo_model.predict(features)[0]
+        indice = int(np.argmax(prob_escolha(self.semaforo_model, features)))
+        tempo_pred = self.tempo_model.predict(features.iloc[[indice]])[0]
         
-        semaforo_map = {0: 'A', 1: 'B', 2: 'C', 3: 'D'}
-        semaforo_escolhido = semaforo_map[sem_pred]
+        semaforo_escolhido = faixas[indice]
         tempo_escolhido = max(5, min(20, int(tempo_pred)))
         
         return semaforo_escolhido, tempo_escolhido
 
 def decisao_baseada_regras(vias_dados):
     max_cars = 0
-    melhor_semaforo = 'A'
+    melhor_semaforo = semaforos[0]
     
     for semaforo, cars in vias_dados.items():
         if cars > max_cars:
@@ -412,12 +434,11 @@ porta = 1883
 topico_envia = "3105/comando"
 topico_recepcao = "3105/confirmacao"
 tempo_liberacao = 5
-semaforos = ["A", "B", "C", "D"]
 mensagem_recebida = ""
 mensagem_final = ""
 contador = 0
-semaforo_escolhido_anterior = "A"
-semaforo_escolhido = "C"
+semaforo_escolhido_anterior = semaforos[0]
+semaforo_escolhido = semaforos[-1]
 
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
@@ -430,12 +451,7 @@ def publica_mensagem(client, vias_dados):
     global semaforo_escolhido, semaforo_escolhido_anterior
     global ultimo_record_id, estado_anterior, usar_ml, tempo_liberacao
 
-    estado_anterior = {
-        'A': vias_dados.get('A', 0),
-        'B': vias_dados.get('B', 0),
-        'C': vias_dados.get('C', 0),
-        'D': vias_dados.get('D', 0)
-    }
+    estado_anterior = {s: vias_dados.get(s, 0) for s in semaforos}
 
     if usar_ml and ml_controller.is_trained:
         agora = datetime.now()
@@ -468,8 +484,7 @@ def publica_mensagem(client, vias_dados):
     agora = datetime.fromtimestamp(timestamp)
     
     dados_treinamento = (
-        timestamp, estado_anterior['A'], estado_anterior['B'],
-        estado_anterior['C'], estado_anterior['D'], agora.hour,
+        timestamp, [estado_anterior[s] for s in semaforos], agora.hour,
         agora.weekday(), semaforo_escolhido, tempo_liberacao,
         sum(estado_anterior.values())
     )
@@ -477,7 +492,7 @@ def publica_mensagem(client, vias_dados):
     
     # Publicar MQTT
     mensagem_liberacao = {"V": tempo_liberacao}
-    modelo_mensagem = {"A": "AV", "B": "BV", "C": "CV", "D": "DV"}
+    modelo_mensagem = {s: f"{s}V" for s in semaforos}
 
     for semaforo in semaforos:
         if semaforo == semaforo_escolhido:
@@ -534,16 +549,11 @@ while True:
     print(f"\n=== CICLO {ciclo_contador} ===")
     
     # Obter dados (do Firebase dos semáforos ou simulados)
-    vias = obter_dados_4_lanes()
+    vias = obter_dados_lanes()
     
     if vias is None or sum(vias.values()) == 0:
         print("Usando dados simulados...")
-        vias = {
-            'A': random.randint(0, 8), 
-            'B': random.randint(0, 8), 
-            'C': random.randint(0, 8), 
-            'D': random.randint(0, 8)
-        }
+        vias = {s: random.randint(0, 8) for s in semaforos}
     
     print(f"DADOS DAS VIAS: {vias}")
 
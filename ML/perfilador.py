@@ -0,0 +1,152 @@
+"""Perfilador por amostragem sob demanda para processos de longa duração.
+
+SIGUSR1 (ou GET /profile na porta de métricas) inicia uma captura; o próximo
+SIGUSR1 a encerra, senão ela para sozinha após max_segundos. Enquanto roda,
+uma thread amostra as pilhas de todas as threads com sys._current_frames():
+o loop asyncio, os executores de banco/ML/treino, o escritor de treinamento
+e a thread de rede do paho, sem o custo do cProfile em cada chamada.
+
+Cada captura grava dois arquivos em diretorio:
+    <prefixo>_<instante>.folded   uma linha "thread;externa;...;interna n" por
+                                  pilha, para flamegraph.pl ou speedscope
+    <prefixo>_<instante>.top.txt  top-N funções por amostras próprias e totais
+
+    kill -USR1 <pid>        # inicia
+    kill -USR1 <pid>        # encerra e grava
+"""
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+
+class PerfiladorAmostragem:
+    def __init__(self, diretorio='perfis', prefixo='perfil', intervalo=0.005, max_segundos=60, top_n=30):
+        self.diretorio = diretorio
+        self.prefixo = prefixo
+        self.intervalo = intervalo
+        self.max_segundos = max_segundos
+        self.top_n = top_n
+        self.lock = threading.Lock()
+        self.thread = None
+        self.parar_evento = threading.Event()
+        self.ultima_saida = None
+        self._rotulos = {}
+
+    @property
+    def rodando(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def instalar_sinal(self, sinal=getattr(signal, 'SIGUSR1', None)):
+        """Alterna com um sinal; retorna False onde o sinal não existe (Windows).
+        O handler só troca o estado; quem imprime é a thread de amostragem."""
+        if sinal is None:
+            return False
+        signal.signal(sinal, lambda *_: self.alternar())
+        return True
+
+    def alternar(self, segundos=None):
+        return self.parar() if self.rodando else self.iniciar(segundos)
+
+    def iniciar(self, segundos=None):
+        with self.lock:
+            if self.rodando:
+                return "Perfilador já está rodando"
+            segundos = min(segundos or self.max_segundos, self.max_segundos)
+            self.parar_evento.clear()
+            self.thread = threading.Thread(target=self._executa, args=(segundos,), name='perfilador', daemon=True)
+            self.thread.start()
+            return f"Captura iniciada (amostras a cada {self.intervalo * 1000:.0f}ms, para após {segundos:g}s)"
+
+    def parar(self, aguardar=False):
+        """Pede para a amostragem parar; os arquivos são gravados na saída dela"""
+        with self.lock:
+            if not self.rodando:
+                return "Perfilador não está rodando"
+            self.parar_evento.set()
+            thread = self.thread
+        if aguardar:
+            thread.join()
+            return f"Captura encerrada, gravada em {self.ultima_saida}"
+        return "Encerrando captura e gravando"
+
+    def atende_pedido(self, parametros):
+        """/profile?acao=iniciar|parar|alternar&segundos=N, para o endpoint de métricas"""
+        acao = parametros.get('acao', 'alternar')
+        try:
+            segundos = float(parametros['segundos']) if 'segundos' in parametros else None
+        except ValueError:
+            return f"segundos inválido: {parametros['segundos']}"
+        if acao == 'iniciar':
+            return self.iniciar(segundos)
+        if acao == 'parar':
+            return self.parar(aguardar=True)
+        return self.alternar(segundos)
+
+    def _rotulo(self, codigo):
+        rotulo = self._rotulos.get(codigo)
+        if rotulo is None:
+            rotulo = f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{codigo.co_firstlineno})"
+            self._rotulos[codigo] = rotulo
+        return rotulo
+
+    def _executa(self, segundos):
+        propria = threading.get_ident()
+        pilhas = Counter()
+        amostras = 0
+        inicio = time.perf_counter()
+        prazo = inicio + segundos
+        print(f"🔬 Captura iniciada (amostras a cada {self.intervalo * 1000:.0f}ms, para após {segundos:g}s)")
+
+        while not self.parar_evento.is_set() and time.perf_counter() < prazo:
+            nomes = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == propria:
+                    continue
+                pilha = []
+                while frame is not None:
+                    pilha.append(self._rotulo(frame.f_code))
+                    frame = frame.f_back
+                pilha.append(nomes.get(thread_id, str(thread_id)))
+                pilhas[';'.join(reversed(pilha))] += 1
+            amostras += 1
+            self.parar_evento.wait(self.intervalo)
+
+        duracao = time.perf_counter() - inicio
+        try:
+            self.ultima_saida = self._grava(pilhas, amostras, duracao)
+            print(f"🔬 Perfil gravado: {self.ultima_saida}.folded / .top.txt ({amostras} amostras, {duracao:.1f}s)")
+        except OSError as e:
+            print(f"✗ Não foi possível gravar o perfil: {e}")
+
+    def _grava(self, pilhas, amostras, duracao):
+        os.makedirs(self.diretorio, exist_ok=True)
+        base = os.path.join(self.diretorio, f"{self.prefixo}_{datetime.now():%Y%m%d_%H%M%S}")
+
+        with open(base + '.folded', 'w', encoding='utf-8') as f:
+            for pilha, n in pilhas.most_common():
+                f.write(f"{pilha} {n}\n")
+
+        proprias, totais = Counter(), Counter()
+        for pilha, n in pilhas.items():
+            funcoes = pilha.split(';')[1:]
+            if funcoes:
+                proprias[funcoes[-1]] += n
+            for nome in set(funcoes):
+                totais[nome] += n
+
+        # Uma amostra por thread a cada tique: percentuais sobre amostras-thread
+        amostras_thread = sum(pilhas.values()) or 1
+        periodo = duracao / max(amostras, 1)
+        with open(base + '.top.txt', 'w', encoding='utf-8') as f:
+            f.write(f"{amostras} amostras em {duracao:.1f}s, intervalo de {self.intervalo * 1000:.0f}ms, "
+                    f"{amostras_thread} amostras-thread\n")
+            for titulo, contador in (('próprias', proprias), ('totais', totais)):
+                f.write(f"\nTop {self.top_n} por amostras {titulo}\n")
+                f.write(f"{'amostras':>8} {'%':>6} {'~s':>7}  função\n")
+                for nome, n in contador.most_common(self.top_n):
+                    f.write(f"{n:>8} {n / amostras_thread:>6.1%} {n * periodo:>7.2f}  {nome}\n")
+        return base
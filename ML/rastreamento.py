@@ -0,0 +1,212 @@
+"""Rastreamento de latência de ponta a ponta: do frame da câmera à confirmação do ESP32.
+
+O detector (CV/semaforos.py) grava em veiculos o instante de captura do frame
+(frame_ts) e um trace_id por escrita de telemetria. O controlador lê os dois
+em get_vias_dados e abre um Rastro por decisão, que liga essa telemetria ao
+comando MQTT e às confirmações. Cada etapa vira um span numa linha JSONL e
+alimenta um histograma por etapa.
+
+Relatório combinando os logs dos dois processos:
+    python rastreamento.py rastros/spans_ml.jsonl ../CV/traces/spans_cv.jsonl
+"""
+import argparse
+import json
+import os
+import time
+import uuid
+from threading import Lock
+
+# Limites superiores (ms) dos baldes dos histogramas
+LIMITES_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+RASTREAMENTO_DIRETORIO = os.environ.get('RASTREAMENTO_DIRETORIO', 'rastros')
+RASTREAMENTO_ARQUIVO = os.environ.get('RASTREAMENTO_ARQUIVO', os.path.join(RASTREAMENTO_DIRETORIO, 'spans_ml.jsonl'))
+usar_rastreamento = True
+
+
+class HistogramaLatencia:
+    def __init__(self, limites=LIMITES_MS):
+        self.limites = limites
+        self.contagens = [0] * (len(limites) + 1)
+        self.total = 0
+        self.soma = 0.0
+        self.maximo = 0.0
+
+    def registrar(self, ms):
+        i = 0
+        while i < len(self.limites) and ms > self.limites[i]:
+            i += 1
+        self.contagens[i] += 1
+        self.total += 1
+        self.soma += ms
+        self.maximo = max(self.maximo, ms)
+
+    def percentil(self, p):
+        """Limite superior do balde que contém o percentil p (0-100)"""
+        if not self.total:
+            return 0.0
+        alvo = p / 100 * self.total
+        acumulado = 0
+        for limite, n in zip(self.limites, self.contagens):
+            acumulado += n
+            if acumulado >= alvo:
+                return float(limite)
+        return self.maximo
+
+    def barras(self, largura=40):
+        linhas = []
+        maior = max(self.contagens) or 1
+        rotulos = [f"<= {l}ms" for l in self.limites] + [f"> {self.limites[-1]}ms"]
+        for rotulo, n in zip(rotulos, self.contagens):
+            if n:
+                linhas.append(f"   {rotulo:>11} {'█' * max(1, round(n / maior * largura))} {n}")
+        return "\n".join(linhas)
+
+
+class Rastreador:
+    """Grava spans em JSONL e mantém um histograma por etapa; seguro entre threads"""
+
+    def __init__(self, arquivo=None):
+        self.arquivo = arquivo
+        self.histogramas = {}
+        self.lock = Lock()
+        self._saida = None
+
+    def span(self, trace_id, nome, inicio, fim, **atributos):
+        duracao_ms = (fim - inicio) * 1000
+        registro = {'trace_id': trace_id, 'span': nome, 'inicio': inicio, 'fim': fim,
+                    'duracao_ms': round(duracao_ms, 3), **atributos}
+        with self.lock:
+            self.histogramas.setdefault(nome, HistogramaLatencia()).registrar(duracao_ms)
+            if self.arquivo:
+                try:
+                    if self._saida is None:
+                        os.makedirs(os.path.dirname(self.arquivo) or '.', exist_ok=True)
+                        self._saida = open(self.arquivo, 'a', encoding='utf-8')
+                    self._saida.write(json.dumps(registro) + "\n")
+                    self._saida.flush()
+                except OSError as e:
+                    print(f"⚠ Falha ao gravar span em {self.arquivo}: {e}")
+                    self.arquivo = None
+
+    def resumo(self):
+        with self.lock:
+            histogramas = dict(self.histogramas)
+        return formata_resumo(histogramas)
+
+
+def formata_resumo(histogramas):
+    linhas = [f"{'etapa':<34} {'n':>6} {'média':>9} {'p50':>8} {'p95':>8} {'p99':>8} {'máx':>9}"]
+    for nome, h in sorted(histogramas.items()):
+        if not h.total:
+            continue
+        linhas.append(f"{nome:<34} {h.total:>6} {h.soma / h.total:>8.1f}ms {h.percentil(50):>6.0f}ms "
+                      f"{h.percentil(95):>6.0f}ms {h.percentil(99):>6.0f}ms {h.maximo:>8.1f}ms")
+    return "\n".join(linhas)
+
+
+rastreador = Rastreador(RASTREAMENTO_ARQUIVO if usar_rastreamento else None)
+
+
+class Rastro:
+    """Uma decisão de fase, da telemetria lida até a última confirmação.
+
+    telemetria é a lista de (lane_id, frame_ts, trace_id) das linhas de
+    veiculos usadas; frame_ts e trace_id vêm do detector e podem faltar em
+    linhas antigas.
+    """
+
+    def __init__(self, cruzamento_id, telemetria=None):
+        self.id = uuid.uuid4().hex
+        self.cruzamento_id = cruzamento_id
+        self.telemetria = [t for t in (telemetria or []) if t[1] is not None]
+        self.frame_ts = max((t[1] for t in self.telemetria), default=None)
+        self.frame_ts_mais_antigo = min((t[1] for t in self.telemetria), default=None)
+        self.decidido_em = None
+        self.publicado_em = None
+        self.encerrado = False
+
+    def _atributos(self):
+        return {'cruzamento': self.cruzamento_id, 'traces_cv': [t[2] for t in self.telemetria if t[2]]}
+
+    def etapa(self, nome, inicio, fim):
+        if usar_rastreamento:
+            rastreador.span(self.id, nome, inicio, fim, **self._atributos())
+
+    def lido(self, inicio_leitura, fim_leitura):
+        self.etapa('leitura_telemetria', inicio_leitura, fim_leitura)
+        if self.frame_ts is not None:
+            self.etapa('idade_telemetria', self.frame_ts, fim_leitura)
+
+    def publicado(self, instante=None):
+        self.publicado_em = instante or time.time()
+        if self.decidido_em is not None:
+            self.etapa('espera_publicacao', self.decidido_em, self.publicado_em)
+        if self.frame_ts is not None:
+            self.etapa('frame_ate_publicacao', self.frame_ts, self.publicado_em)
+
+    def confirmado(self, instante=None):
+        """Chamado quando a última confirmação da fase chegou; conta só uma vez"""
+        if self.encerrado or self.publicado_em is None:
+            return
+        self.encerrado = True
+        instante = instante or time.time()
+        self.etapa('confirmacao', self.publicado_em, instante)
+        if self.frame_ts is not None:
+            self.etapa('frame_ate_confirmacao', self.frame_ts, instante)
+            if usar_rastreamento:
+                rastreador.span(self.id, 'frame_mais_antigo_ate_confirmacao', self.frame_ts_mais_antigo,
+                                instante, **self._atributos())
+
+
+# ==================== RELATÓRIO ====================
+
+def le_spans(caminhos):
+    spans = []
+    for caminho in caminhos:
+        with open(caminho, encoding='utf-8') as f:
+            for linha in f:
+                linha = linha.strip()
+                if linha:
+                    spans.append(json.loads(linha))
+    return spans
+
+
+def relatorio(caminhos, piores=5):
+    spans = le_spans(caminhos)
+    histogramas = {}
+    por_trace = {}
+    for s in spans:
+        histogramas.setdefault(s['span'], HistogramaLatencia()).registrar(s['duracao_ms'])
+        por_trace.setdefault(s['trace_id'], []).append(s)
+
+    print(f"📊 {len(spans)} spans de {len(caminhos)} arquivo(s)\n")
+    print(formata_resumo(histogramas))
+    for nome, h in sorted(histogramas.items()):
+        print(f"\n{nome}:")
+        print(h.barras())
+
+    # Cadeias completas: decisões mais lentas com os spans do detector ligados a elas
+    finais = sorted((s for s in spans if s['span'] == 'frame_ate_confirmacao'),
+                    key=lambda s: s['duracao_ms'], reverse=True)[:piores]
+    if finais:
+        print(f"\n🐢 {len(finais)} decisões mais lentas (frame -> confirmação):")
+    for final in finais:
+        print(f"\n  trace {final['trace_id']} [{final.get('cruzamento')}]: {final['duracao_ms']:.0f}ms")
+        etapas = list(por_trace.get(final['trace_id'], []))
+        for trace_cv in final.get('traces_cv', []):
+            etapas.extend(por_trace.get(trace_cv, []))
+        for s in sorted(etapas, key=lambda s: s['inicio']):
+            print(f"     {s['span']:<34} {s['duracao_ms']:>9.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Histogramas por etapa a partir dos logs de spans")
+    parser.add_argument('arquivos', nargs='+', help="spans_ml.jsonl e/ou spans_cv.jsonl")
+    parser.add_argument('--piores', type=int, default=5, help="cadeias completas a mostrar")
+    args = parser.parse_args()
+    relatorio(args.arquivos, args.piores)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Relógios do controlador.
+
+RelogioReal é o de produção. RelogioSimulado é usado pelo simulador, pelo
+benchmark e por replays de logs; com LoopTempoVirtual, as próprias corrotinas
+do controlador (timers do verde, prazos de confirmação, janelas de lote) rodam
+em tempo simulado, mais rápido que o real e sem mudar o resultado.
+
+agora() é a hora de parede (registros, hora do dia); monotonico() é a base
+dos prazos. No RelogioReal, monotonico() é a mesma base do loop asyncio.
+"""
+import asyncio
+import math
+import selectors
+import time
+from datetime import datetime
+
+
+class RelogioReal:
+    """Relógio de parede: o que o controlador usa em produção"""
+
+    def agora(self):
+        return time.time()
+
+    def agora_datetime(self):
+        return datetime.now()
+
+    def monotonico(self):
+        return time.monotonic()
+
+    def dormir(self, segundos):
+        time.sleep(max(0, segundos))
+
+
+class RelogioSimulado:
+    """Relógio controlado pelo simulador.
+
+    O tempo só anda quando alguém chama avancar_para() ou dormir(); uma
+    semana simulada passa em segundos de CPU.
+    """
+
+    def __init__(self, inicio=None):
+        if inicio is None:
+            inicio = datetime(2024, 1, 1).timestamp()  # segunda-feira, 00:00
+        self.instante = float(inicio)
+        self.origem = self.instante
+
+    def agora(self):
+        return self.instante
+
+    def agora_datetime(self):
+        return datetime.fromtimestamp(self.instante)
+
+    def monotonico(self):
+        # Segundos desde a criação: perto de zero o float tem resolução de
+        # sobra para os timers do asyncio; num timestamp de época não
+        return self.instante - self.origem
+
+    def dormir(self, segundos):
+        self.instante += max(0, segundos)
+
+    def avancar_para(self, instante):
+        if instante < self.instante:
+            raise ValueError(f"Relógio simulado não volta no tempo: {instante} < {self.instante}")
+        self.instante = instante
+
+
+class SeletorTempoVirtual(selectors.DefaultSelector):
+    """Em vez de bloquear até o próximo timer, avança o relógio até ele.
+
+    Enquanto há trabalho num executor (banco, predição, treino) o relógio
+    fica parado e a espera é real: o tempo de CPU não conta como tempo
+    simulado, então o resultado não depende da velocidade da máquina.
+    """
+
+    def __init__(self, relogio):
+        super().__init__()
+        self.relogio = relogio
+        self.pendentes_executor = 0
+
+    def select(self, timeout=None):
+        eventos = super().select(0)
+        if eventos or timeout == 0:
+            return eventos
+        if timeout is None or self.pendentes_executor:
+            return super().select(None)
+        antes = self.relogio.agora()
+        self.relogio.dormir(timeout)
+        if self.relogio.agora() <= antes:
+            # Restos menores que a precisão do float num timestamp de época
+            # somem na soma; anda ao menos um ulp para o timer vencer
+            self.relogio.avancar_para(math.nextafter(antes, math.inf))
+        return []
+
+
+class LoopTempoVirtual(asyncio.SelectorEventLoop):
+    """Loop asyncio cujo tempo é o de um RelogioSimulado"""
+
+    def __init__(self, relogio):
+        self.relogio = relogio
+        self.seletor = SeletorTempoVirtual(relogio)
+        super().__init__(self.seletor)
+
+    def time(self):
+        return self.relogio.monotonico()
+
+    def run_in_executor(self, executor, func, *args):
+        futuro = super().run_in_executor(executor, func, *args)
+        self.seletor.pendentes_executor += 1
+
+        def concluido(_):
+            self.seletor.pendentes_executor -= 1
+        futuro.add_done_callback(concluido)
+        return futuro
+
+
+def executar_em_tempo_virtual(corrotina, relogio):
+    """Como asyncio.run, mas com o tempo do loop dado por relogio"""
+    loop = LoopTempoVirtual(relogio)
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(corrotina)
+    finally:
+        try:
+            pendentes = asyncio.all_tasks(loop)
+            for tarefa in pendentes:
+                tarefa.cancel()
+            loop.run_until_complete(asyncio.gather(*pendentes, return_exceptions=True))
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
@@ -0,0 +1,360 @@
+"""Simulador de eventos discretos de um cruzamento.
+
+Roda as mesmas funções de decisão do controlador (decide_fase, com
+decisao_baseada_regras ou TrafficMLController.prever_melhor_acao) contra
+filas simuladas, sem MQTT, banco ou sleep: uma semana de tráfego passa em
+segundos de CPU.
+
+Modelo:
+- chegadas de Poisson por faixa, com taxa média por hora modulada pelo
+  perfil do dia (picos de manhã e fim de tarde);
+- durante o verde a fila descarrega a TAXA_SATURACAO veículos/s, depois de
+  TEMPO_PERDIDO s de arrancada;
+- entre duas fases há TEMPO_ENTRE_FASES s de vermelho geral (RED-ALL e
+  confirmação dos ESP32);
+- o controlador enxerga o tamanho das filas no instante da decisão, como a
+  contagem current_cars da câmera.
+
+Uso:
+    python simulador.py --dias 7 --politica regras
+    python simulador.py --dias 7 --politica ambas --dias-aquecimento 1 --replicas 16
+"""
+import argparse
+import heapq
+import os
+import random
+import time
+from collections import deque
+from contextlib import redirect_stdout
+from datetime import datetime
+
+import numpy as np
+
+import firebase_e_broker as controlador
+from relogio import RelogioSimulado
+
+TAXA_SATURACAO = 0.5  # veículos/s saindo da fila durante o verde
+TEMPO_PERDIDO = 2.0  # s de arrancada no início do verde
+TEMPO_ENTRE_FASES = 3.0  # s de vermelho geral entre fases
+
+# Veículos por hora em cada faixa fora do pico
+CHEGADAS_POR_HORA = {'A': 300, 'B': 220, 'C': 260, 'D': 180}
+
+# Multiplicador da taxa de chegada por hora do dia
+PERFIL_HORARIO = [0.2, 0.15, 0.1, 0.1, 0.15, 0.4, 0.8, 1.5, 1.6, 1.1, 0.9, 1.0,
+                  1.1, 1.0, 0.9, 1.0, 1.2, 1.6, 1.5, 1.1, 0.8, 0.6, 0.4, 0.3]
+
+# Tipos de evento, na ordem de desempate para o mesmo instante
+FIM_VERDE, SAIDA, CHEGADA = 0, 1, 2
+
+
+class Simulacao:
+    """Um cruzamento simulado, controlado por decide_fase"""
+
+    def __init__(self, chegadas_por_hora=None, semente=42, relogio=None, coletar_treino=False):
+        self.chegadas_por_hora = dict(chegadas_por_hora or CHEGADAS_POR_HORA)
+        self.faixas = list(self.chegadas_por_hora)
+        self.rng = random.Random(semente)
+        self.relogio = relogio or RelogioSimulado()
+        self.inicio = self.relogio.agora()
+
+        self.estado = controlador.EstadoCruzamento({
+            'id': 'sim',
+            'lane_mapping': {f'lane_{i + 1}': s for i, s in enumerate(self.faixas)},
+        })
+        self.filas = {s: deque() for s in self.faixas}
+        self.eventos = []
+        self.seq = 0
+
+        self.verde = None
+        self.tempo_fase = 0.0
+        self.fim_verde = 0.0
+        self.decisao_pendente = None
+        self.saida_agendada = False
+        self.proxima_saida_livre = 0.0
+
+        self.coletar_treino = coletar_treino
+        self.registros = []
+        self.registro_aberto = None
+
+        # Métricas
+        self.t = 0.0
+        self.ciclos = 0
+        self.estrategias = {}
+        self.chegadas = 0
+        self.atendidos = 0
+        self.fila_total = 0
+        self.esperas = []
+        self.area_fila = 0.0
+        self.fila_maxima = 0
+        self.tempo_verde_total = 0.0
+
+    def _agenda(self, instante, tipo, faixa=None):
+        self.seq += 1
+        heapq.heappush(self.eventos, (instante, tipo, self.seq, faixa))
+
+    def _proxima_chegada(self, t, faixa):
+        """Poisson com taxa constante por hora; o sorteio recomeça na virada da hora.
+
+        A hora é local, como em RelogioSimulado.agora_datetime(), que dá a
+        hora_dia vista pelo controlador
+        """
+        base = self.chegadas_por_hora[faixa] / 3600.0
+        while True:
+            local = datetime.fromtimestamp(self.inicio + t)
+            hora = local.hour
+            fim_hora = t + 3600 - (local.minute * 60 + local.second + local.microsecond / 1e6)
+            taxa = base * PERFIL_HORARIO[hora]
+            if taxa > 0:
+                proxima = t + self.rng.expovariate(taxa)
+                if proxima <= fim_hora:
+                    return proxima
+            t = fim_hora
+
+    def _agenda_saida(self, t):
+        inicio_descarga = max(t, self.fim_verde - self.tempo_fase + TEMPO_PERDIDO, self.proxima_saida_livre)
+        if inicio_descarga < self.fim_verde:
+            self._agenda(inicio_descarga, SAIDA, self.verde)
+            self.saida_agendada = True
+
+    def _contagem(self):
+        return {s: len(self.filas[s]) for s in self.faixas}
+
+    def _fecha_registro(self, vias):
+        antes = self.registro_aberto
+        cars_depois = sum(vias.values())
+        eficiencia = (antes[10] - cars_depois) / max(antes[10], 1)
+        antes[11], antes[12] = cars_depois, min(max(eficiencia, 0.0), 9.9999)
+        self.registros.append(tuple(antes))
+        self.registro_aberto = None
+
+    def pedido_ml(self):
+        """Pedido no formato de prever_melhor_acao_lote, ou None sem telemetria"""
+        vias = self._contagem()
+        if sum(vias.values()) == 0:
+            return None
+        agora = self.relogio.agora_datetime()
+        exclude, candidates = controlador.contexto_decisao(self.estado)
+        return (vias, agora.hour, agora.weekday(), exclude, candidates, self.estado.ciclos_por_via())
+
+    def decidir(self, previsao_ml=None):
+        """Decide a fase pendente com decide_fase e começa o verde"""
+        t = self.decisao_pendente
+        self.decisao_pendente = None
+        vias = self._contagem()
+        estado = self.estado
+
+        if self.registro_aberto is not None:
+            self._fecha_registro(vias)
+
+        controlador.relogio = self.relogio
+        semaforo, tempo, estrategia = controlador.decide_fase(estado, vias, previsao_ml)
+        self.estrategias[estrategia] = self.estrategias.get(estrategia, 0) + 1
+
+        if self.coletar_treino and sum(vias.values()) > 0:
+            agora = self.relogio.agora_datetime()
+            self.registro_aberto = [
+                len(self.registros), agora, None, None, None, None,   # semaforo_a..d_cars: só registros antigos
+                agora.hour, agora.weekday(), semaforo, tempo, sum(vias.values()), None, None,
+                list(estado.semaforos), [vias[s] for s in estado.semaforos],
+                estado.last_opened_cycles.tolist(),
+            ]
+
+        controlador.avanca_rotacao(estado, semaforo)
+        self.ciclos += 1
+
+        inicio_verde = t + TEMPO_ENTRE_FASES
+        self.verde = semaforo
+        self.tempo_fase = tempo
+        self.fim_verde = inicio_verde + tempo
+        self.proxima_saida_livre = 0.0
+        self.saida_agendada = False
+        self.tempo_verde_total += tempo
+        self._agenda(self.fim_verde, FIM_VERDE)
+        if self.filas[semaforo]:
+            self._agenda_saida(inicio_verde)
+
+    def iniciar(self):
+        for faixa in self.faixas:
+            self._agenda(self._proxima_chegada(0.0, faixa), CHEGADA, faixa)
+        self.decisao_pendente = 0.0
+
+    def avancar(self, segundos):
+        """Processa eventos até a próxima decisão.
+
+        Retorna True quando há uma decisão pendente (chame decidir()) e False
+        quando a simulação chegou em `segundos`.
+        """
+        if self.decisao_pendente is not None:
+            self.relogio.avancar_para(self.inicio + self.decisao_pendente)
+            return True
+
+        while self.eventos:
+            t, tipo, _, faixa = heapq.heappop(self.eventos)
+            if t > segundos:
+                break
+            self.area_fila += self.fila_total * (t - self.t)
+            self.t = t
+
+            if tipo == CHEGADA:
+                self.filas[faixa].append(t)
+                self.chegadas += 1
+                self.fila_total += 1
+                self.fila_maxima = max(self.fila_maxima, self.fila_total)
+                self._agenda(self._proxima_chegada(t, faixa), CHEGADA, faixa)
+                if faixa == self.verde and not self.saida_agendada:
+                    self._agenda_saida(t)
+
+            elif tipo == SAIDA:
+                self.saida_agendada = False
+                fila = self.filas[faixa]
+                if faixa == self.verde and t < self.fim_verde and fila:
+                    self.esperas.append(t - fila.popleft())
+                    self.atendidos += 1
+                    self.fila_total -= 1
+                    self.proxima_saida_livre = t + 1.0 / TAXA_SATURACAO
+                    if fila:
+                        self._agenda_saida(self.proxima_saida_livre)
+
+            else:  # FIM_VERDE
+                self.verde = None
+                self.decisao_pendente = t
+                self.relogio.avancar_para(self.inicio + t)
+                return True
+
+        self.area_fila += self.fila_total * (segundos - self.t)
+        self.t = segundos
+        return False
+
+
+def executar_lote(simulacoes, segundos, politica):
+    """Avança várias simulações em conjunto.
+
+    A cada rodada, as decisões pendentes de todas as réplicas vão num único
+    prever_melhor_acao_lote, como o LoteDecisoes faz com os cruzamentos reais.
+    Com as florestas avaliadas em numpy (arvores.py), a política ML passa de
+    alguns milhares de ciclos/s e uma semana cabe num job de CI.
+    """
+    for sim in simulacoes:
+        sim.iniciar()
+    ativas = [sim for sim in simulacoes if sim.avancar(segundos)]
+
+    while ativas:
+        previsoes = [None] * len(ativas)
+        if politica == 'ml' and controlador.ml_controller.is_trained:
+            pedidos = [(i, sim.pedido_ml()) for i, sim in enumerate(ativas)]
+            pedidos = [(i, p) for i, p in pedidos if p is not None]
+            if pedidos:
+                resultados = controlador.ml_controller.prever_melhor_acao_lote([p for _, p in pedidos])
+                for (i, _), resultado in zip(pedidos, resultados):
+                    previsoes[i] = resultado
+
+        for sim, previsao in zip(ativas, previsoes):
+            sim.decidir(previsao)
+        ativas = [sim for sim in ativas if sim.avancar(segundos)]
+
+
+def agrega_metricas(simulacoes, segundos, duracao_cpu):
+    esperas = np.concatenate([np.array(s.esperas) for s in simulacoes if s.esperas] or [np.zeros(1)])
+    ciclos = sum(s.ciclos for s in simulacoes)
+    estrategias = {}
+    for s in simulacoes:
+        for nome, n in s.estrategias.items():
+            estrategias[nome] = estrategias.get(nome, 0) + n
+
+    return {
+        'replicas': len(simulacoes),
+        'segundos_simulados': segundos,
+        'segundos_cpu': duracao_cpu,
+        'ciclos': ciclos,
+        'ciclos_por_segundo': ciclos / max(duracao_cpu, 1e-9),
+        'estrategias': estrategias,
+        'chegadas': sum(s.chegadas for s in simulacoes),
+        'atendidos': sum(s.atendidos for s in simulacoes),
+        'na_fila_no_fim': sum(s.fila_total for s in simulacoes),
+        'espera_media': float(esperas.mean()),
+        'espera_p95': float(np.percentile(esperas, 95)),
+        'fila_media': sum(s.area_fila for s in simulacoes) / (segundos * len(simulacoes)),
+        'fila_maxima': max(s.fila_maxima for s in simulacoes),
+        'verde_medio': sum(s.tempo_verde_total for s in simulacoes) / max(ciclos, 1),
+    }
+
+
+def simular(segundos, politica='regras', semente=42, replicas=1, chegadas_por_hora=None,
+            coletar_treino=False, silencioso=True):
+    """Roda `replicas` cruzamentos independentes (sementes semente, semente+1, ...).
+
+    politica 'ml' usa o ml_controller do controlador, que já deve estar
+    treinado; 'regras' usa só decisao_baseada_regras. Retorna as métricas
+    agregadas e os registros de treinamento coletados.
+    """
+    relogio_original, usar_ml_original = controlador.relogio, controlador.usar_ml
+    controlador.usar_ml = politica == 'ml'
+    simulacoes = [Simulacao(chegadas_por_hora, semente=semente + i, coletar_treino=coletar_treino)
+                  for i in range(replicas)]
+    inicio_cpu = time.perf_counter()
+    try:
+        if silencioso:
+            with open(os.devnull, 'w') as nulo, redirect_stdout(nulo):
+                executar_lote(simulacoes, segundos, politica)
+        else:
+            executar_lote(simulacoes, segundos, politica)
+    finally:
+        controlador.relogio, controlador.usar_ml = relogio_original, usar_ml_original
+    duracao_cpu = time.perf_counter() - inicio_cpu
+
+    registros = [r for s in simulacoes for r in s.registros]
+    return agrega_metricas(simulacoes, segundos, duracao_cpu), registros
+
+
+def treinar_com_simulacao(segundos, semente=42, replicas=1, chegadas_por_hora=None):
+    """Treina o ml_controller com registros de uma simulação sob as regras"""
+    _, registros = simular(segundos, 'regras', semente=semente, replicas=replicas,
+                           chegadas_por_hora=chegadas_por_hora, coletar_treino=True)
+    with open(os.devnull, 'w') as nulo, redirect_stdout(nulo):
+        treinado = controlador.ml_controller.treinar_modelos(dados=registros)
+    return treinado, len(registros)
+
+
+def imprime_metricas(nome, m):
+    print(f"\n📊 Política: {nome}")
+    print(f"   Simulado: {m['replicas']} x {m['segundos_simulados'] / 86400:.2f} dias em {m['segundos_cpu']:.2f}s de CPU "
+          f"({m['ciclos']} ciclos, {m['ciclos_por_segundo']:.0f} ciclos/s)")
+    print(f"   Estratégias: {m['estrategias']}")
+    print(f"   Veículos: {m['chegadas']} chegaram, {m['atendidos']} atendidos, {m['na_fila_no_fim']} na fila no fim")
+    print(f"   Espera: média {m['espera_media']:.1f}s, p95 {m['espera_p95']:.1f}s")
+    print(f"   Fila: média {m['fila_media']:.1f}, máxima {m['fila_maxima']}")
+    print(f"   Verde médio: {m['verde_medio']:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulador de eventos discretos do cruzamento")
+    parser.add_argument('--dias', type=float, default=7, help="dias simulados por política")
+    parser.add_argument('--politica', choices=['regras', 'ml', 'ambas'], default='ambas')
+    parser.add_argument('--dias-aquecimento', type=float, default=1,
+                        help="dias simulados sob as regras para treinar o ML")
+    parser.add_argument('--replicas', type=int, default=16,
+                        help="cruzamentos independentes simulados juntos (decisões ML em lote)")
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--verbose', action='store_true', help="mostra os prints do controlador")
+    args = parser.parse_args()
+
+    segundos = args.dias * 86400
+    politicas = ['regras', 'ml'] if args.politica == 'ambas' else [args.politica]
+
+    if 'ml' in politicas:
+        print(f"🧠 Treinando ML com {args.dias_aquecimento} dia(s) simulados sob as regras...")
+        treinado, n = treinar_com_simulacao(args.dias_aquecimento * 86400, semente=args.semente + args.replicas)
+        if not treinado:
+            print(f"✗ Treinamento falhou ({n} registros); a política ML cairá nas regras")
+        else:
+            print(f"✓ ML treinado com {n} registros simulados")
+
+    for politica in politicas:
+        metricas, _ = simular(segundos, politica, semente=args.semente, replicas=args.replicas,
+                              silencioso=not args.verbose)
+        imprime_metricas(politica, metricas)
+
+
+if __name__ == "__main__":
+    main()